@@ -5,17 +5,62 @@
 import logging
 import os
 
+from cardstate import CardStateStore
+from redispool import RedisPool
 from teams.v1.bot import Bot
+from teams.v1.cache import RedisCacheBackend, TTLCache
+from teams.v1.identity import IdentityCache
+from teams.v1.ratelimit import RedisRateLimiter
 
 logger = logging.getLogger(__name__)
 
-# create Bot class instance
-bot = Bot()
-
 # redis parameter, see ./conf/redis6399.conf
 redis_port = 6399
 redis_url = os.environ.get('bot_redis_url') if os.environ.get('bot_redis_url') is not None else 'redis://localhost:{}'.format(str(redis_port))
 
+# one redis connection pool shared by everything in this process
+redis_pool = RedisPool(
+  redis_url,
+  max_connections=int(os.environ.get('bot_redis_max_connections', 50)),
+  timeout=float(os.environ.get('bot_redis_timeout', 5.0)),
+  health_check_interval=int(os.environ.get('bot_redis_health_check_interval', 30)))
+
+
+def get_redis():
+  """redis client on the shared connection pool"""
+  return redis_pool.get_client()
+
+
+# state of adaptive cards sent by the bot
+card_state = CardStateStore(get_redis(), ttl=int(os.environ.get('bot_card_ttl', 600)))
+
+# ./data directory
+data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+
+# create Bot class instance
+bot = Bot()
+
+# share the rate limit of the bot token among all gunicorn workers and hosts
+if os.environ.get('bot_global_rate_limit', '0') == '1':
+  bot.scheduler.global_limiter = RedisRateLimiter(get_redis(), token=bot.auth_token)
+
+# cache the result of /people/me in redis or file, and refresh it in background
+identity_cache_type = os.environ.get('bot_identity_cache', 'file')
+if identity_cache_type in ['redis', 'file']:
+  bot.identity_cache = IdentityCache(
+    bot.fetch_me,
+    token=bot.auth_token,
+    conn=get_redis() if identity_cache_type == 'redis' else None,
+    path=data_dir,
+    ttl=int(os.environ.get('bot_identity_ttl', 86400)))
+  bot.identity_cache.start()
+
+# cache people, rooms and messages in process memory, and optionally in redis
+if os.environ.get('bot_cache', '1') == '1':
+  bot.cache = TTLCache(
+    maxsize=int(os.environ.get('bot_cache_size', 4096)),
+    backend=RedisCacheBackend(get_redis()) if os.environ.get('bot_cache_redis', '0') == '1' else None)
+
 
 @bot.on_message('あ')
 def respond_to_a(room_id=None):
@@ -0,0 +1,727 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Scheduled weather broadcast to many rooms
+
+- jobs have a cron expression (minute hour day month weekday), e.g. '0 7 * * *'
+- jobs, subscriptions (room -> city code), and the next fire time are kept in redis
+- every worker polls the schedule, the fire time is locked with SET NX, so only one worker fires the job
+- the forecast of each distinct city is fetched once and its card is rendered once
+- messages are sent by a bounded pool of threads, Bot.send_message() waits for the rate limit budget
+  and retries 429, so the fan-out never exceeds the limit of the bot token
+- the status of every room and the summary of the run (sent, failed, elapsed) are kept in redis
+- the lock of the fire time is short and renewed while the job runs, if the worker stops or dies,
+  another worker resumes the fire and sends to the rooms which have not been sent yet
+
+Redis keys (prefix is 'bot:broadcast'):
+  {prefix}:jobs                      hash, job id -> json of the job
+  {prefix}:schedule                  sorted set, job id scored by the next fire time
+  {prefix}:rooms:{job}               hash, room id -> city code
+  {prefix}:lock:{job}:{fire time}    string, worker which fires the job
+  {prefix}:pending:{job}             sorted set, fire times without summary, i.e. running or interrupted
+  {prefix}:status:{job}:{fire time}  hash, room id -> status of the delivery
+  {prefix}:runs:{job}                list, json of the summaries of the recent runs
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class CronSchedule:
+
+  # (min, max) of minute, hour, day of month, month, day of week (0 is Sunday, 7 is also Sunday)
+  RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+  def __init__(self, expr):
+    """constructor for CronSchedule
+
+    Arguments:
+        expr {str} -- 5 fields of cron, each field is '*', 'n', 'n-m', 'a,b,c' with optional '/step'
+
+    Raises:
+        ValueError -- invalid expression
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+      raise ValueError("cron expression must have 5 fields: {!r}".format(expr))
+    self.expr = expr
+    parsed = [self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self.RANGES)]
+    self.minutes, self.hours, self.days, self.months, weekdays = parsed
+    self.weekdays = {d % 7 for d in weekdays}
+    # if both day of month and day of week are restricted, either of them matches
+    self.any_day = fields[2] == '*'
+    self.any_weekday = fields[4] == '*'
+
+
+  @staticmethod
+  def _parse(field, lo, hi):
+    values = set()
+    for part in field.split(','):
+      step = 1
+      if '/' in part:
+        part, step = part.split('/', 1)
+        step = int(step)
+        if step < 1:
+          raise ValueError("invalid step: {!r}".format(field))
+      if part == '*':
+        start, end = lo, hi
+      elif '-' in part:
+        start, end = (int(v) for v in part.split('-', 1))
+      else:
+        start = int(part)
+        end = hi if step > 1 else start
+      if not lo <= start <= end <= hi:
+        raise ValueError("out of range {}-{}: {!r}".format(lo, hi, field))
+      values.update(range(start, end + 1, step))
+    return values
+
+
+  def _day_matches(self, dt):
+    day = dt.day in self.days
+    weekday = (dt.isoweekday() % 7) in self.weekdays
+    if self.any_day and self.any_weekday:
+      return True
+    if self.any_day:
+      return weekday
+    if self.any_weekday:
+      return day
+    return day or weekday
+
+
+  def next_after(self, dt):
+    """Returns:
+        datetime -- the first time after dt which matches, in the same timezone as dt
+    """
+    dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = dt + timedelta(days=366 * 5)
+    while dt < limit:
+      if dt.month not in self.months:
+        dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+        continue
+      if not self._day_matches(dt):
+        dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+        continue
+      if dt.hour not in self.hours:
+        dt = dt.replace(minute=0) + timedelta(hours=1)
+        continue
+      if dt.minute not in self.minutes:
+        dt += timedelta(minutes=1)
+        continue
+      return dt
+    raise ValueError("cron expression never matches: {!r}".format(self.expr))
+
+
+  def next_time(self, now=None):
+    """Returns:
+        float -- unix time of the next fire after now, in local time
+    """
+    now = time.time() if now is None else now
+    return self.next_after(datetime.fromtimestamp(now)).timestamp()
+
+
+def render_weather(city_code):
+  """fetch the forecast of the city, and render its card
+
+  Returns:
+      tuple -- (text, attachment), attachment is json bytes or dict, None if the forecast is not available
+  """
+  # pylint: disable=import-outside-toplevel
+  from cardbuilder import get_builder
+  from cardengine import get_engine
+  from cardstore import CONTENT_TYPE
+  from forecast import get_forecast_cache
+
+  data = get_forecast_cache().get(city_code)
+  if not data:
+    return None
+  builder = get_builder('weather.j2')
+  if builder is not None:
+    card = builder.build_attachment_bytes(data)
+  else:
+    card = {'contentType': CONTENT_TYPE, 'content': get_engine().render_json('weather.j2', data)}
+  return data.get('title') or "weather", card
+
+
+class BroadcastScheduler:
+
+  # extend the lock only if this worker still holds it
+  RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+  RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+  # move the schedule to the next fire time and mark this one pending, only if the score is
+  # still this fire time, add_job(), enable_job() or disable_job() may change it meanwhile
+  # KEYS: schedule, pending, ARGV: job id, fire time, next fire time
+  ADVANCE_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or math.floor(tonumber(score)) ~= tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+  def __init__(self, conn, bot, render=render_weather, prefix='bot:broadcast', interval=10.0, concurrency=8, misfire_grace=3600, history=30, lock_ttl=30):
+    """constructor for BroadcastScheduler
+
+    Arguments:
+        conn {redis.StrictRedis} -- redis client, created with decode_responses=True
+        bot {Bot} -- bot to send the messages
+
+    Keyword Arguments:
+        render {func} -- called with the city code, returns (text, attachment) or None (default: {render_weather})
+        prefix {str} -- prefix of redis keys (default: {'bot:broadcast'})
+        interval {float} -- seconds between polls of the schedule (default: {10.0})
+        concurrency {int} -- number of messages sent at the same time (default: {8})
+        misfire_grace {int} -- seconds to fire the job late, e.g. all workers were down (default: {3600})
+        history {int} -- number of the summaries kept per job (default: {30})
+        lock_ttl {int} -- seconds of the lock of the fire time, renewed while the job runs (default: {30})
+    """
+    self.conn = conn
+    self.bot = bot
+    self.render = render
+    self.prefix = prefix
+    self.interval = interval
+    self.concurrency = concurrency
+    self.misfire_grace = misfire_grace
+    self.history = history
+    self.lock_ttl = lock_ttl
+
+    self._renew = conn.register_script(self.RENEW_SCRIPT)
+    self._release = conn.register_script(self.RELEASE_SCRIPT)
+    self._advance = conn.register_script(self.ADVANCE_SCRIPT)
+
+    self.node = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+    self._lock = threading.Lock()
+    self._pid = None
+    self._stopped = threading.Event()
+    self._thread = None
+
+    # metrics
+    self.fired = 0
+    self.resumed = 0
+    self.interrupted = 0
+    self.sent = 0
+    self.failed = 0
+    self.last_run = None
+
+
+  def _key(self, *parts):
+    return ':'.join((self.prefix,) + tuple(str(p) for p in parts))
+
+
+  #
+  # jobs and subscriptions
+  #
+
+  def add_job(self, job_id, cron, text=None):
+    """create or update the job, the next fire time is kept if the cron expression is not changed
+
+    A new job is enabled, an existing job keeps its state, see enable_job() and disable_job().
+
+    Raises:
+        ValueError -- invalid cron expression
+    """
+    schedule = CronSchedule(cron)
+    current = self.get_job(job_id)
+    enabled = current is None or current.get('enabled', True)
+    job = {'id': job_id, 'cron': cron, 'text': text, 'enabled': enabled}
+    pipe = self.conn.pipeline(transaction=True)
+    pipe.hset(self._key('jobs'), job_id, json.dumps(job, ensure_ascii=False))
+    if enabled:
+      changed = current is None or current.get('cron') != cron
+      pipe.zadd(self._key('schedule'), {job_id: schedule.next_time()}, nx=not changed)
+    pipe.execute()
+    return job
+
+
+  def enable_job(self, job_id):
+    """fire the job again from the next fire time, called by the administrator (see msg.py --broadcast)
+
+    Returns:
+        bool -- True if the job exists
+    """
+    job = self.get_job(job_id)
+    if job is None:
+      return False
+    job['enabled'] = True
+    pipe = self.conn.pipeline(transaction=True)
+    pipe.hset(self._key('jobs'), job_id, json.dumps(job, ensure_ascii=False))
+    pipe.zadd(self._key('schedule'), {job_id: CronSchedule(job['cron']).next_time()}, nx=True)
+    pipe.execute()
+    return True
+
+
+  def disable_job(self, job_id):
+    """stop firing the job, the subscriptions are kept until enable_job(),
+    called by the administrator (see msg.py --broadcast)
+
+    Returns:
+        bool -- True if the job exists
+    """
+    job = self.get_job(job_id)
+    if job is None:
+      return False
+    job['enabled'] = False
+    pipe = self.conn.pipeline(transaction=True)
+    pipe.hset(self._key('jobs'), job_id, json.dumps(job, ensure_ascii=False))
+    pipe.zrem(self._key('schedule'), job_id)
+    pipe.execute()
+    return True
+
+
+  def is_enabled(self, job_id):
+    job = self.get_job(job_id)
+    return job is not None and job.get('enabled', True)
+
+
+  def remove_job(self, job_id):
+    pipe = self.conn.pipeline(transaction=True)
+    pipe.hdel(self._key('jobs'), job_id)
+    pipe.zrem(self._key('schedule'), job_id)
+    pipe.delete(self._key('rooms', job_id), self._key('runs', job_id), self._key('pending', job_id))
+    pipe.execute()
+
+
+  def get_job(self, job_id):
+    value = self.conn.hget(self._key('jobs'), job_id)
+    return None if value is None else json.loads(value)
+
+
+  def get_jobs(self):
+    """Returns:
+        list -- jobs with their next fire time
+    """
+    jobs = []
+    schedule = dict(self.conn.zrange(self._key('schedule'), 0, -1, withscores=True))
+    for value in self.conn.hvals(self._key('jobs')):
+      job = json.loads(value)
+      job['next'] = schedule.get(job['id'])
+      jobs.append(job)
+    return sorted(jobs, key=lambda j: j['id'])
+
+
+  def subscribe(self, job_id, room_id, city_code):
+    self.conn.hset(self._key('rooms', job_id), room_id, city_code)
+
+
+  def unsubscribe(self, job_id, room_id):
+    return self.conn.hdel(self._key('rooms', job_id), room_id) > 0
+
+
+  def get_subscriptions(self, job_id):
+    """Returns:
+        dict -- room id -> city code
+    """
+    return self.conn.hgetall(self._key('rooms', job_id))
+
+
+  def get_runs(self, job_id, count=10):
+    """Returns:
+        list -- summaries of the recent runs, newest first
+    """
+    return [json.loads(v) for v in self.conn.lrange(self._key('runs', job_id), 0, count - 1)]
+
+
+  def get_status(self, job_id, fire_at):
+    """Returns:
+        dict -- room id -> status of the delivery, 'sent', 'failed' or 'no_forecast'
+    """
+    return self.conn.hgetall(self._key('status', job_id, int(fire_at)))
+
+
+  #
+  # firing
+  #
+
+  def try_lock(self, job_id, fire_at):
+    """Returns:
+        bool -- True if this worker holds the lock of the fire time
+    """
+    return bool(self.conn.set(self._key('lock', job_id, int(fire_at)), self.node, nx=True, ex=self.lock_ttl))
+
+
+  def release_lock(self, job_id, fire_at):
+    self._release(keys=[self._key('lock', job_id, int(fire_at))], args=[self.node])
+
+
+  def _hold_lock(self, job_id, fire_at, done, lost):
+    # pylint: disable=broad-except
+    lock_key = self._key('lock', job_id, int(fire_at))
+    while not done.wait(self.lock_ttl / 3.0):
+      try:
+        renewed = self._renew(keys=[lock_key], args=[self.node, self.lock_ttl])
+      except redis.exceptions.RedisError as e:
+        logger.error("broadcast %s: failed to renew the lock: %s", job_id, e)
+        continue
+      if not renewed:
+        logger.error("broadcast %s: lost the lock of %s", job_id, datetime.fromtimestamp(fire_at))
+        lost.set()
+        return
+
+
+  def try_fire(self, job_id, fire_at):
+    """lock the fire time of the job, mark it pending, and schedule the next one
+
+    Returns:
+        bool -- True if this worker fires the job, False if another worker does or the job is changed
+    """
+    if not self.try_lock(job_id, fire_at):
+      return False
+
+    job = self.get_job(job_id)
+    if job is None:
+      self.conn.zrem(self._key('schedule'), job_id)
+      self.release_lock(job_id, fire_at)
+      return False
+    next_time = CronSchedule(job['cron']).next_time(max(fire_at, time.time()))
+    if not self._advance(keys=[self._key('schedule'), self._key('pending', job_id)], args=[job_id, int(fire_at), next_time]):
+      # the job is changed or disabled after zrangebyscore
+      self.release_lock(job_id, fire_at)
+      return False
+    return True
+
+
+  def render_cities(self, city_codes):
+    """render the card of each city once, concurrently
+
+    Returns:
+        dict -- city code -> (text, attachment) or None
+    """
+    # pylint: disable=broad-except
+    def render(code):
+      try:
+        return self.render(code)
+      except Exception as e:
+        logger.exception(e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(city_codes))), thread_name_prefix='broadcast-render') as executor:
+      return dict(zip(city_codes, executor.map(render, city_codes)))
+
+
+  def deliver(self, job_id, fire_at, subscriptions, rendered, text=None, cancelled=None):
+    """send the rendered cards to the rooms, and record the status of each room
+
+    Keyword Arguments:
+        cancelled {threading.Event} -- stop sending when it is set, in addition to stop() (default: {None})
+
+    Returns:
+        dict -- status -> number of rooms, rooms not sent because of stop are counted as 'interrupted'
+    """
+    # pylint: disable=broad-except
+    status_key = self._key('status', job_id, int(fire_at))
+    stopped = self._stopped
+
+    def send(item):
+      room_id, city_code = item
+      if stopped.is_set() or (cancelled is not None and cancelled.is_set()):
+        return room_id, 'interrupted'
+      message = rendered.get(city_code)
+      if message is None:
+        return room_id, 'no_forecast'
+      title, card = message
+      try:
+        result = self.bot.send_message(room_id=room_id, text=text or title, attachments=[card])
+      except Exception as e:
+        logger.exception(e)
+        result = None
+      return room_id, 'sent' if result else 'failed'
+
+    counts = {}
+    statuses = {}
+    flushed = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(subscriptions))), thread_name_prefix='broadcast-send') as executor:
+      for room_id, status in executor.map(send, subscriptions.items()):
+        counts[status] = counts.get(status, 0) + 1
+        if status == 'interrupted':
+          continue
+        statuses[room_id] = status
+        # written in batches, not per message, but at least every second to resume without duplicates
+        if len(statuses) >= 100 or time.monotonic() - flushed >= 1.0:
+          self.conn.hset(status_key, mapping=statuses)
+          statuses = {}
+          flushed = time.monotonic()
+    pipe = self.conn.pipeline(transaction=False)
+    if statuses:
+      pipe.hset(status_key, mapping=statuses)
+    pipe.expire(status_key, 86400 * 7)
+    pipe.execute()
+    return counts
+
+
+  def run_job(self, job_id, fire_at=None):
+    """fetch and render the forecasts once per city, and deliver them to every subscribed room
+    which has not been sent at this fire time yet
+
+    The caller holds the lock of the fire time, it is renewed while the job runs and released at the end.
+
+    Returns:
+        dict -- summary of the run, None if the run is interrupted and left to another worker
+    """
+    fire_at = time.time() if fire_at is None else fire_at
+    job = self.get_job(job_id) or {}
+    start = time.monotonic()
+
+    done = threading.Event()
+    lost = threading.Event()
+    holder = threading.Thread(target=self._hold_lock, args=(job_id, fire_at, done, lost), name='broadcast-lock', daemon=True)
+    holder.start()
+    try:
+      subscriptions = self.get_subscriptions(job_id)
+      already_sent = {room_id for room_id, status in self.get_status(job_id, fire_at).items() if status == 'sent'}
+      subscriptions = {room_id: code for room_id, code in subscriptions.items() if room_id not in already_sent}
+      city_codes = sorted(set(subscriptions.values()))
+      rendered = self.render_cities(city_codes) if city_codes else {}
+      render_elapsed = time.monotonic() - start
+
+      counts = self.deliver(job_id, fire_at, subscriptions, rendered, text=job.get('text'), cancelled=lost) if subscriptions else {}
+    finally:
+      done.set()
+      holder.join()
+
+    if counts.get('interrupted'):
+      # the pending fire time is resumed by this or another worker once the lock is released
+      if not lost.is_set():
+        self.release_lock(job_id, fire_at)
+      with self._lock:
+        self.interrupted += 1
+        self.sent += counts.get('sent', 0)
+      logger.warning("broadcast %s: interrupted, %d rooms are left", job_id, counts['interrupted'])
+      return None
+
+    summary = {
+      'job': job_id,
+      'fire_at': int(fire_at),
+      'node': self.node,
+      'rooms': len(subscriptions) + len(already_sent),
+      'cities': len(city_codes),
+      'sent': counts.get('sent', 0) + len(already_sent),
+      'resumed': len(already_sent),
+      'failed': counts.get('failed', 0),
+      'no_forecast': counts.get('no_forecast', 0),
+      'render_elapsed': round(render_elapsed, 3),
+      'elapsed': round(time.monotonic() - start, 3)
+    }
+    pipe = self.conn.pipeline(transaction=True)
+    pipe.lpush(self._key('runs', job_id), json.dumps(summary))
+    pipe.ltrim(self._key('runs', job_id), 0, self.history - 1)
+    pipe.zrem(self._key('pending', job_id), int(fire_at))
+    pipe.execute()
+    self.release_lock(job_id, fire_at)
+
+    with self._lock:
+      self.fired += 1
+      self.sent += counts.get('sent', 0)
+      self.failed += summary['failed'] + summary['no_forecast']
+      self.last_run = summary
+    logger.info("broadcast %s: %d rooms, %d cities, %d sent in %.2f sec", job_id, summary['rooms'], summary['cities'], summary['sent'], summary['elapsed'])
+    return summary
+
+
+  def get_pending(self, job_id):
+    """Returns:
+        list -- fire times which are running or interrupted
+    """
+    return [int(score) for _, score in self.conn.zrange(self._key('pending', job_id), 0, -1, withscores=True)]
+
+
+  def resume(self, now=None):
+    """resume the interrupted fires, whose lock is expired or released
+
+    Returns:
+        list -- summaries of the runs finished by this worker
+    """
+    now = time.time() if now is None else now
+    summaries = []
+    for job in self.get_jobs():
+      if not job.get('enabled', True):
+        continue
+      job_id = job['id']
+      for fire_at in self.get_pending(job_id):
+        if self._stopped.is_set():
+          return summaries
+        if now - fire_at > self.misfire_grace:
+          logger.warning("broadcast %s at %s is not resumed, it is too late", job_id, datetime.fromtimestamp(fire_at))
+          self.conn.zrem(self._key('pending', job_id), fire_at)
+          continue
+        if not self.try_lock(job_id, fire_at):
+          continue
+        # the owner may have finished it between zrange and the lock
+        if self.conn.zscore(self._key('pending', job_id), fire_at) is None:
+          self.release_lock(job_id, fire_at)
+          continue
+        logger.info("broadcast %s at %s is resumed", job_id, datetime.fromtimestamp(fire_at))
+        with self._lock:
+          self.resumed += 1
+        summary = self.run_job(job_id, fire_at)
+        if summary is not None:
+          summaries.append(summary)
+    return summaries
+
+
+  def poll(self, now=None):
+    """fire the jobs due, which are not fired by other workers, and resume the interrupted fires
+
+    Returns:
+        list -- summaries of the runs finished by this worker
+    """
+    now = time.time() if now is None else now
+    summaries = self.resume(now=now)
+    for job_id, fire_at in self.conn.zrangebyscore(self._key('schedule'), '-inf', now, withscores=True):
+      if self._stopped.is_set():
+        break
+      if not self.try_fire(job_id, fire_at):
+        continue
+      if now - fire_at > self.misfire_grace:
+        logger.warning("broadcast %s at %s is skipped, it is too late", job_id, datetime.fromtimestamp(fire_at))
+        self.conn.zrem(self._key('pending', job_id), int(fire_at))
+        continue
+      summary = self.run_job(job_id, fire_at)
+      if summary is not None:
+        summaries.append(summary)
+    return summaries
+
+
+  def _run(self, stopped):
+    # pylint: disable=broad-except
+    while not stopped.is_set():
+      try:
+        self.poll()
+      except redis.exceptions.RedisError as e:
+        logger.error("broadcast: %s", e)
+      except Exception as e:
+        logger.exception(e)
+      stopped.wait(self.interval)
+
+
+  def start(self):
+    """start the polling thread in this process, again in the forked worker"""
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self.node = '{}-{}'.format(socket.gethostname(), os.getpid())
+      self._stopped = threading.Event()
+      self._thread = threading.Thread(target=self._run, args=(self._stopped,), name='broadcast', daemon=True)
+      self._thread.start()
+
+
+  def stop(self, timeout=None):
+    self._stopped.set()
+    if self._thread is not None:
+      self._thread.join(timeout)
+    with self._lock:
+      self._pid = None
+      self._thread = None
+
+
+  def get_stats(self):
+    stats = {}
+    try:
+      stats['jobs'] = self.get_jobs()
+    except redis.exceptions.RedisError as e:
+      stats['error'] = str(e)
+    with self._lock:
+      stats.update({
+        'running': self._pid == os.getpid(),
+        'fired': self.fired,
+        'resumed': self.resumed,
+        'interrupted': self.interrupted,
+        'sent': self.sent,
+        'failed': self.failed,
+        'last_run': self.last_run
+      })
+    return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_broadcast_scheduler():
+  """broadcast scheduler shared by the process, on the redis and the bot of botscript"""
+  # pylint: disable=global-statement
+  global _scheduler
+  if _scheduler is None:
+    with _scheduler_lock:
+      if _scheduler is None:
+        from botscript import bot, get_redis  # pylint: disable=import-outside-toplevel
+        _scheduler = BroadcastScheduler(
+          get_redis(),
+          bot,
+          interval=float(os.environ.get('bot_broadcast_interval', 10.0)),
+          concurrency=int(os.environ.get('bot_broadcast_concurrency', 8)))
+  return _scheduler
+
+
+if __name__ == '__main__':
+
+  logging.basicConfig(level=logging.INFO)
+
+  class FakeBot:
+    """bot which takes 50 msec to send a message"""
+
+    def __init__(self):
+      self.messages = []
+      self._lock = threading.Lock()
+
+    def send_message(self, room_id=None, text=None, attachments=None):
+      time.sleep(0.05)
+      with self._lock:
+        self.messages.append(room_id)
+      return {'id': 'message-{}'.format(len(self.messages))}
+
+  def main():
+    redis_url = os.environ.get('bot_redis_url', 'redis://localhost:6399')
+    conn = redis.StrictRedis.from_url(redis_url, decode_responses=True)
+
+    renders = []
+
+    def render(city_code):
+      renders.append(city_code)
+      return 'forecast of {}'.format(city_code), b'{"contentType":"application/vnd.microsoft.card.adaptive","content":{}}'
+
+    # two workers share the schedule in redis
+    bot = FakeBot()
+    workers = [BroadcastScheduler(conn, bot, render=render, prefix='test:broadcast', concurrency=16) for _ in range(2)]
+    workers[0].add_job('morning', '0 7 * * *')
+    for n in range(500):
+      workers[0].subscribe('morning', 'room-{}'.format(n), ['130010', '270000', '016010', '140010'][n % 4])
+
+    # it is 7 o'clock
+    fire_at = conn.zscore('test:broadcast:schedule', 'morning')
+    summaries = [s for w in workers for s in w.poll(now=fire_at + 1)]
+    print('fired {} times, rendered {} cards, sent {} messages'.format(len(summaries), len(renders), len(bot.messages)))
+    print(summaries[0])
+    print('next', datetime.fromtimestamp(conn.zscore('test:broadcast:schedule', 'morning')))
+
+    workers[0].remove_job('morning')
+    for key in conn.scan_iter('test:broadcast:*'):
+      conn.delete(key)
+    return 0
+
+  sys.exit(main())
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Bulk send of messages to a list of recipients in CSV or JSONL
+
+- recipients are read one by one from the file, the file is never loaded at once
+- a recipient has one of to_person_email, to_person_id or room_id, other columns are template variables
+- text and .j2 cards are filled with {{ name }} of the recipient, see cardbuilder.py
+- messages are sent by a bounded pool of threads, at most concurrency * 2 recipients are in memory
+- failed sends are retried with full jitter exponential backoff
+- progress is saved in the checkpoint file, an interrupted run resumes after the last recipient done
+- recipients failed after all retries are appended to the failed file, which is JSONL to be sent again
+- throughput and failures are reported every report_interval seconds
+
+Bot.send_message() waits for the rate limit budget of messages, and retries 429,
+so the concurrency only hides the latency of the api.
+"""
+
+import csv
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cardbuilder import SLOT, get_builder, lookup
+from cardstore import get_repository
+
+logger = logging.getLogger(__name__)
+
+
+# columns of the recipient, the first one found is used
+RECIPIENT_KEYS = ('to_person_email', 'email', 'to_person_id', 'room_id')
+
+
+def iter_recipients(path, file_format=None):
+  """read the recipients one by one
+
+  Arguments:
+      path {str} -- CSV with a header line, or JSONL
+
+  Keyword Arguments:
+      file_format {str} -- 'csv' or 'jsonl', guessed by the extension if None (default: {None})
+
+  Yields:
+      dict -- variables of the recipient, broken lines of JSONL are yielded as {}
+  """
+  if file_format is None:
+    file_format = 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.json', '.ndjson') else 'csv'
+  with open(path, encoding='utf-8-sig', newline='') as f:
+    if file_format == 'csv':
+      for row in csv.DictReader(f):
+        yield row
+      return
+    for line in f:
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        row = json.loads(line)
+      except ValueError:
+        row = {}
+      yield row if isinstance(row, dict) else {}
+
+
+def render_text(template, variables):
+  """fill {{ name }} in the text, a missing variable is an empty string"""
+  return SLOT.sub(lambda m: lookup(variables, m.group(1).split('.')), template)
+
+
+def recipient_of(variables):
+  """Returns:
+      dict -- keyword arguments of Bot.send_message() for the recipient, None if not found
+  """
+  for key in RECIPIENT_KEYS:
+    value = variables.get(key)
+    if value:
+      return {'to_person_email' if key == 'email' else key: value}
+  return None
+
+
+class Checkpoint:
+
+  def __init__(self, path):
+    """progress of the bulk send, saved in a json file
+
+    done is the number of the recipients from the beginning of the file, which are sent or failed,
+    finished is the index of the recipients done after the first one not done
+    """
+    self.path = path
+    self.done = 0
+    self.finished = set()
+    self.sent = 0
+    self.failed = 0
+
+
+  def load(self):
+    if self.path is None or not os.path.exists(self.path):
+      return self
+    with open(self.path, encoding='utf-8') as f:
+      data = json.load(f)
+    self.done = data.get('done', 0)
+    self.finished = set(data.get('finished', []))
+    self.sent = data.get('sent', 0)
+    self.failed = data.get('failed', 0)
+    return self
+
+
+  def save(self):
+    if self.path is None:
+      return
+    data = {'done': self.done, 'finished': sorted(self.finished), 'sent': self.sent, 'failed': self.failed, 'saved': time.time()}
+    # atomic, a crash while writing never breaks the checkpoint
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.checkpoint-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+      json.dump(data, f)
+    os.replace(tmp, self.path)
+
+
+  def remove(self):
+    if self.path is not None and os.path.exists(self.path):
+      os.remove(self.path)
+
+
+class BulkSender:
+
+  def __init__(self, bot, text=None, card_name=None, concurrency=8, retries=3, backoff_base=1.0, backoff_cap=30.0,
+               checkpoint_path=None, failed_path=None, checkpoint_interval=1.0, report_interval=5.0):
+    """constructor for BulkSender
+
+    Arguments:
+        bot {Bot} -- bot to send the messages
+
+    Keyword Arguments:
+        text {str} -- template of the text, with {{ name }} (default: {None})
+        card_name {str} -- card in ./static/cards, .j2 is filled with the variables of the recipient (default: {None})
+        concurrency {int} -- number of messages sent at the same time (default: {8})
+        retries {int} -- max retries of a failed send (default: {3})
+        backoff_base {float} -- seconds of the first backoff (default: {1.0})
+        backoff_cap {float} -- max seconds of the backoff (default: {30.0})
+        checkpoint_path {str} -- file to save the progress, not saved if None (default: {None})
+        failed_path {str} -- JSONL file to append the failed recipients (default: {None})
+        checkpoint_interval {float} -- seconds between saves of the checkpoint (default: {1.0})
+        report_interval {float} -- seconds between progress reports (default: {5.0})
+    """
+    if not text and not card_name:
+      raise ValueError("text or card_name is required")
+    self.bot = bot
+    self.text = text
+    self.card_name = card_name
+    self.concurrency = concurrency
+    self.retries = retries
+    self.backoff_base = backoff_base
+    self.backoff_cap = backoff_cap
+    self.checkpoint = Checkpoint(checkpoint_path)
+    self.failed_path = failed_path
+    self.checkpoint_interval = checkpoint_interval
+    self.report_interval = report_interval
+
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+
+    # metrics of this run
+    self.started = None
+    self.completed = False
+    self.sent = 0
+    self.failed = 0
+    self.retried = 0
+    self.skipped = 0
+
+
+  def build_message(self, variables):
+    """Returns:
+        dict -- keyword arguments of Bot.send_message(), None if the recipient is not found
+    """
+    recipient = recipient_of(variables)
+    if recipient is None:
+      return None
+    kwargs = dict(recipient)
+    if self.text:
+      kwargs['text'] = render_text(self.text, variables)
+    if self.card_name:
+      if self.card_name.endswith('.j2'):
+        builder = get_builder(self.card_name)
+        card = None if builder is None else builder.build_attachment_bytes(variables)
+      else:
+        # same bytes for every recipient
+        card = get_repository().get_bytes(self.card_name)
+      if card is None:
+        raise ValueError("card is not found: {}".format(self.card_name))
+      kwargs['attachments'] = [card]
+    return kwargs
+
+
+  def backoff(self, attempt):
+    """full jitter exponential backoff"""
+    return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+
+  @staticmethod
+  def is_transient(status):
+    """Returns:
+        bool -- True if the failure may succeed later, no response, 408, 429 or 5xx
+    """
+    return status is None or status in (408, 429) or status >= 500
+
+
+  def send(self, variables):
+    """send the message to the recipient, with retries of transient failures
+
+    Permanent failures, e.g. 400 for a bad email address or 404, are not retried.
+
+    Returns:
+        bool -- True if sent, None if stopped while waiting for the retry
+    """
+    # pylint: disable=broad-except
+    kwargs = self.build_message(variables)
+    if kwargs is None:
+      logger.error("recipient is not found: %s", variables)
+      return False
+    for attempt in range(self.retries + 1):
+      if attempt > 0:
+        with self._lock:
+          self.retried += 1
+        if self._stopped.wait(self.backoff(attempt - 1)):
+          return None
+      try:
+        if self.bot.send_message(**kwargs):
+          return True
+      except Exception as e:
+        logger.error("failed to send to %s: %s", variables, e)
+        continue
+      status = self.bot.last_status() if hasattr(self.bot, 'last_status') else None
+      if not self.is_transient(status):
+        logger.error("failed to send to %s: status %s", variables, status)
+        return False
+    return False
+
+
+  def _record_failure(self, variables):
+    if self.failed_path is None:
+      return
+    with open(self.failed_path, 'a', encoding='utf-8') as f:
+      f.write(json.dumps(variables, ensure_ascii=False) + '\n')
+
+
+  def _finish(self, index, variables, ok):
+    with self._lock:
+      if ok:
+        self.sent += 1
+        self.checkpoint.sent += 1
+      else:
+        self.failed += 1
+        self.checkpoint.failed += 1
+        self._record_failure(variables)
+      # move the checkpoint forward while the recipients are done without a gap
+      finished = self.checkpoint.finished
+      finished.add(index)
+      while self.checkpoint.done in finished:
+        finished.remove(self.checkpoint.done)
+        self.checkpoint.done += 1
+
+
+  def get_stats(self):
+    with self._lock:
+      elapsed = time.monotonic() - self.started if self.started else 0.0
+      return {
+        'done': self.checkpoint.done,
+        'sent': self.sent,
+        'failed': self.failed,
+        'retried': self.retried,
+        'skipped': self.skipped,
+        'completed': self.completed,
+        'total_sent': self.checkpoint.sent,
+        'total_failed': self.checkpoint.failed,
+        'elapsed': round(elapsed, 3),
+        'rate': round((self.sent + self.failed) / elapsed, 1) if elapsed > 0 else 0.0
+      }
+
+
+  def report(self):
+    stats = self.get_stats()
+    logger.info("done %d, sent %d, failed %d, retried %d, %.1f msg/sec",
+                stats['done'], stats['sent'], stats['failed'], stats['retried'], stats['rate'])
+
+
+  def run(self, recipients, resume=True):
+    """send the messages to the recipients
+
+    Arguments:
+        recipients {iterable} -- dicts of the variables, e.g. iter_recipients()
+
+    Keyword Arguments:
+        resume {bool} -- skip the recipients done in the checkpoint (default: {True})
+
+    Returns:
+        dict -- stats of this run
+    """
+    # pylint: disable=broad-except
+    if resume:
+      self.checkpoint.load()
+    else:
+      self.checkpoint.done = self.checkpoint.sent = self.checkpoint.failed = 0
+      self.checkpoint.finished = set()
+    self.skipped = self.checkpoint.done + len(self.checkpoint.finished)
+    finished = set(self.checkpoint.finished)
+    self.started = time.monotonic()
+    self.completed = False
+    self._stopped.clear()
+
+    # bounds the recipients read ahead, the file is not loaded at once
+    slots = threading.BoundedSemaphore(self.concurrency * 2)
+    last_save = last_report = time.monotonic()
+
+    def task(index, variables):
+      try:
+        ok = self.send(variables)
+      except Exception as e:
+        logger.exception(e)
+        ok = False
+      finally:
+        slots.release()
+      if ok is not None:
+        # not done if stopped, sent again when resumed
+        self._finish(index, variables, ok)
+
+    executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='bulksend')
+    try:
+      for index, variables in enumerate(recipients):
+        if index < self.checkpoint.done or index in finished:
+          continue
+        if self._stopped.is_set():
+          break
+        while not slots.acquire(timeout=0.5):
+          pass
+        executor.submit(task, index, variables)
+
+        now = time.monotonic()
+        if now - last_save >= self.checkpoint_interval:
+          last_save = now
+          with self._lock:
+            self.checkpoint.save()
+        if now - last_report >= self.report_interval:
+          last_report = now
+          self.report()
+      executor.shutdown(wait=True)
+      # a stopped run leaves recipients not done, even when it is stopped during the last sends
+      self.completed = not self._stopped.is_set()
+    except KeyboardInterrupt:
+      # messages in flight are finished, their retries are given up
+      self._stopped.set()
+      executor.shutdown(wait=True)
+      raise
+    finally:
+      with self._lock:
+        self.checkpoint.save()
+      self.report()
+    return self.get_stats()
+
+
+def send_file(bot, path, text=None, card_name=None, file_format=None, resume=True, **kwargs):
+  """send the messages to the recipients in the file
+
+  The checkpoint is saved to {path}.checkpoint and removed only after every recipient is done,
+  a stopped run keeps it and resumes from it. The failed recipients are appended to {path}.failed.jsonl.
+
+  Returns:
+      dict -- stats of the run
+  """
+  sender = BulkSender(
+    bot,
+    text=text,
+    card_name=card_name,
+    checkpoint_path='{}.checkpoint'.format(path),
+    failed_path='{}.failed.jsonl'.format(path),
+    **kwargs)
+  stats = sender.run(iter_recipients(path, file_format=file_format), resume=resume)
+  if stats['completed']:
+    sender.checkpoint.remove()
+  return stats
+
+
+if __name__ == '__main__':
+
+  logging.basicConfig(level=logging.INFO)
+
+  class FakeBot:
+    """bot which takes 20 msec to send a message, and fails 10%"""
+
+    def __init__(self):
+      self.count = 0
+      self._lock = threading.Lock()
+
+    def send_message(self, **kwargs):
+      time.sleep(0.02)
+      if random.random() < 0.1:
+        return None
+      with self._lock:
+        self.count += 1
+      return {'id': str(self.count)}
+
+  def main():
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'recipients.csv')
+      with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['email', 'name'])
+        for n in range(2000):
+          writer.writerow(['user{}@example.com'.format(n), 'user {}'.format(n)])
+
+      # interrupted after about 1 sec
+      bot = FakeBot()
+      sender = BulkSender(bot, text='こんにちは {{ name }}さん', concurrency=32, backoff_base=0.01,
+                          checkpoint_path=path + '.checkpoint', failed_path=path + '.failed.jsonl', report_interval=0.5)
+      threading.Timer(1.0, sender._stopped.set).start()  # pylint: disable=protected-access
+      print('first run', sender.run(iter_recipients(path)))
+
+      # resumed where it left off
+      stats = send_file(bot, path, text='こんにちは {{ name }}さん', concurrency=32, backoff_base=0.01, report_interval=0.5)
+      print('resumed', stats)
+      print('messages sent {} to 2000 recipients, failed {}'.format(bot.count, stats['total_failed']))
+    return 0
+
+  sys.exit(main())
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Card builder, fills the slots of a card template without jinja2 and json.loads
+
+A template is a valid json card whose strings have slots, e.g. "最高気温 {{ today.temp_max }} 度".
+The template is compiled once into
+
+- a tree of functions which builds the card dict, static parts are shared between the cards
+- byte chunks of the serialized card, the request body is made by joining the chunks and the values
+
+Escaping rules, the value of a slot
+- is looked up by the dotted path in the data, a missing value is an empty string and None is 'None'
+  (as jinja2 does)
+- is converted with str(), and escaped as the content of a json string,
+  so quotes, backslashes, and control characters in the value can not break the card
+
+Only {{ dotted.path }} is supported, templates with other jinja2 syntax are rejected.
+"""
+
+import json
+import logging
+import re
+import sys
+import threading
+
+from cardstore import CONTENT_TYPE, get_repository
+
+logger = logging.getLogger(__name__)
+
+
+SLOT = re.compile(r'\{\{\s*([A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z0-9_]+)*)\s*\}\}')
+
+# sentinel of the slot in the serialized template, private use characters of unicode
+_SENTINEL = '\ue000{}\ue001'
+_SENTINEL_SPLIT = re.compile('\ue000(\\d+)\ue001')
+
+
+_MISSING = object()
+
+
+def lookup(data, path):
+  value = data
+  for key in path:
+    if isinstance(value, dict):
+      value = value.get(key, _MISSING)
+    else:
+      value = getattr(value, key, _MISSING)
+    if value is _MISSING:
+      return ''
+  return str(value)
+
+
+def escape(value):
+  """escape the str as the content of a json string, without quotes"""
+  return json.dumps(value, ensure_ascii=False)[1:-1]
+
+
+class CardBuilder:
+
+  def __init__(self, template):
+    """constructor for CardBuilder
+
+    Arguments:
+        template {dict} -- structure of the card template, e.g. CardRepository.get_template('weather.j2')
+
+    Raises:
+        ValueError -- the template uses jinja2 syntax other than {{ dotted.path }}
+    """
+    self.template = template
+    self.slots = []  # dotted paths split by '.'
+    self._build = self._compile(template)
+    self._chunks = self._serialize(template)
+
+
+  def _compile_string(self, text):
+    parts = []
+    pos = 0
+    for m in SLOT.finditer(text):
+      if m.start() > pos:
+        parts.append(text[pos:m.start()])
+      parts.append(tuple(m.group(1).split('.')))
+      pos = m.end()
+    if pos < len(text):
+      parts.append(text[pos:])
+    for part in parts:
+      if isinstance(part, str) and ('{{' in part or '{%' in part or '{#' in part):
+        raise ValueError("unsupported template syntax: {!r}".format(text))
+    return parts
+
+
+  def _compile(self, node):
+    """Returns:
+        tuple -- (True, function of data) if the node has slots, or (False, node)
+    """
+    if isinstance(node, str):
+      parts = self._compile_string(node)
+      if all(isinstance(p, str) for p in parts):
+        return False, node
+      self.slots.extend(p for p in parts if isinstance(p, tuple))
+      if len(parts) == 1:
+        path = parts[0]
+        return True, lambda data: lookup(data, path)
+      return True, lambda data: ''.join(p if isinstance(p, str) else lookup(data, p) for p in parts)
+
+    if isinstance(node, dict):
+      for key in node:
+        if '{{' in key or '{%' in key:
+          raise ValueError("slot in the key is not supported: {!r}".format(key))
+      children = [(k,) + self._compile(v) for k, v in node.items()]
+      if not any(dynamic for _, dynamic, _ in children):
+        return False, node
+      static = {k: v for k, dynamic, v in children if not dynamic}
+      dynamic = [(k, f) for k, d, f in children if d]
+      keys = list(node.keys())
+
+      def build_dict(data):
+        values = dict(static)
+        for k, f in dynamic:
+          values[k] = f(data)
+        # keep the order of the keys in the template
+        return {k: values[k] for k in keys}
+      return True, build_dict
+
+    if isinstance(node, list):
+      children = [self._compile(v) for v in node]
+      if not any(dynamic for dynamic, _ in children):
+        return False, node
+      return True, lambda data: [f(data) if dynamic else f for dynamic, f in children]
+
+    return False, node
+
+
+  def _serialize(self, template):
+    """Returns:
+        list -- bytes of the static parts and dotted paths of the slots, in order
+    """
+    slots = []
+
+    def replace(node):
+      if isinstance(node, str):
+        parts = self._compile_string(node)
+        if all(isinstance(p, str) for p in parts):
+          return node
+        result = []
+        for p in parts:
+          if isinstance(p, str):
+            result.append(p)
+          else:
+            result.append(_SENTINEL.format(len(slots)))
+            slots.append(p)
+        return ''.join(result)
+      if isinstance(node, dict):
+        return {k: replace(v) for k, v in node.items()}
+      if isinstance(node, list):
+        return [replace(v) for v in node]
+      return node
+
+    text = json.dumps(replace(template), ensure_ascii=False, separators=(',', ':'))
+    chunks = []
+    pieces = _SENTINEL_SPLIT.split(text)
+    for i, piece in enumerate(pieces):
+      if i % 2 == 0:
+        if piece:
+          chunks.append(piece.encode('utf-8'))
+      else:
+        chunks.append(slots[int(piece)])
+    return chunks
+
+
+  def build(self, data):
+    """build the card dict
+
+    Static parts of the template are shared between the cards, do not modify the result.
+
+    Arguments:
+        data {dict} -- values of the slots
+
+    Returns:
+        dict -- card
+    """
+    dynamic, f = self._build
+    return f(data) if dynamic else f
+
+
+  def build_bytes(self, data):
+    """Returns:
+        bytes -- json of the card
+    """
+    return b''.join(c if isinstance(c, bytes) else escape(lookup(data, c)).encode('utf-8') for c in self._chunks)
+
+
+  def build_attachment(self, data):
+    return {'contentType': CONTENT_TYPE, 'content': self.build(data)}
+
+
+  def build_attachment_bytes(self, data):
+    """Returns:
+        bytes -- json of the attachment, can be passed to Bot.send_message(attachments=[...])
+    """
+    return b''.join([b'{"contentType":"', CONTENT_TYPE.encode('utf-8'), b'","content":', self.build_bytes(data), b'}'])
+
+
+_builders = {}
+_builders_lock = threading.Lock()
+
+
+def get_builder(name):
+  """builder of the template in ./static/cards, compiled again when the template file is changed
+
+  Arguments:
+      name {str} -- file name of the template, e.g. 'weather.j2'
+
+  Returns:
+      CardBuilder -- builder, None if the template is not found or not supported
+  """
+  template = get_repository().get_template(name)
+  if template is None:
+    return None
+  builder = _builders.get(name)
+  if builder is not None and builder.template is template:
+    return builder
+  with _builders_lock:
+    try:
+      builder = CardBuilder(template)
+    except ValueError as e:
+      logger.error("failed to compile card template %s: %s", name, e)
+      return None
+    _builders[name] = builder
+  return builder
+
+
+if __name__ == '__main__':
+
+  import time
+
+  from cardengine import get_engine
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    data = {
+      'city': '横浜 "quoted" \\ and \n newline',
+      'today': {'date': '2020-01-01', 'telop': '晴れ', 'temp_min': None, 'temp_max': 11, 'img_url': 'http://example.com/1.gif'}
+    }
+    builder = get_builder('weather.j2')
+    card = json.loads(builder.build_attachment_bytes(data))['content']
+    assert card == builder.build(data)
+    print(card['body'][0]['text'])
+
+    safe = dict(data, city='横浜')
+    assert get_engine().render_json('weather.j2', safe) == builder.build(safe)
+
+    rounds = 10000
+    engine = get_engine()
+    benchmarks = [
+      ('jinja2 render + json.loads + json.dumps', lambda: json.dumps({'attachments': [{'contentType': CONTENT_TYPE, 'content': engine.render_json('weather.j2', safe)}]})),
+      ('builder dict + json.dumps', lambda: json.dumps({'attachments': [builder.build_attachment(safe)]})),
+      ('builder bytes', lambda: builder.build_attachment_bytes(safe))
+    ]
+    for label, func in benchmarks:
+      start = time.perf_counter()
+      for _ in range(rounds):
+        func()
+      print('{:42s} {:6.1f} usec/card'.format(label, (time.perf_counter() - start) / rounds * 1e6))
+    return 0
+
+  sys.exit(main())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Template engine of adaptive cards in ./static/cards
+
+- one jinja2 Environment per process, templates are compiled once
+- compiled bytecode is saved in ./data/jinja, new workers skip the compile
+- the template file is checked at most every check_interval seconds,
+  and compiled again only when it is changed
+- precompile() compiles every *.j2 at startup
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+logger = logging.getLogger(__name__)
+
+def here(path=''):
+  return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+
+
+class CardTemplateEngine:
+
+  def __init__(self, card_dir, cache_dir=None, check_interval=2.0):
+    """constructor for CardTemplateEngine
+
+    Arguments:
+        card_dir {str} -- directory of the templates
+
+    Keyword Arguments:
+        cache_dir {str} -- directory of the bytecode cache, not cached if None (default: {None})
+        check_interval {float} -- seconds between checks of the template file (default: {2.0})
+    """
+    self.card_dir = card_dir
+    self.check_interval = check_interval
+
+    bytecode_cache = None
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+      bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    # auto_reload of jinja2 stats the file on every get_template(), it is done by get_template() of this class instead
+    self.env = Environment(
+      loader=FileSystemLoader(card_dir),
+      bytecode_cache=bytecode_cache,
+      auto_reload=False,
+      cache_size=-1)
+
+    self._templates = {}  # name -> (template, mtime, checked)
+    self._lock = threading.Lock()
+
+    # metrics
+    self.compiles = 0
+    self.renders = 0
+
+
+  def _mtime(self, name):
+    try:
+      return os.path.getmtime(os.path.join(self.card_dir, name))
+    except OSError:
+      return None
+
+
+  def get_template(self, name):
+    now = time.monotonic()
+    entry = self._templates.get(name)
+    if entry is not None:
+      template, mtime, checked = entry
+      if now - checked < self.check_interval:
+        return template
+      current = self._mtime(name)
+      if current == mtime:
+        self._templates[name] = (template, mtime, now)
+        return template
+
+    with self._lock:
+      mtime = self._mtime(name)
+      if entry is not None:
+        # jinja2 caches the template by name, the changed one is compiled only after it is removed
+        self.env.cache.clear()
+      template = self.env.get_template(name)
+      self._templates[name] = (template, mtime, now)
+      self.compiles += 1
+    return template
+
+
+  def precompile(self):
+    """compile all templates in card_dir
+
+    Returns:
+        list -- names of the templates
+    """
+    names = self.env.list_templates(extensions=['j2'])
+    for name in names:
+      self.get_template(name)
+    return names
+
+
+  def render(self, name, data):
+    """Returns:
+        str -- rendered text
+    """
+    self.renders += 1
+    return self.get_template(name).render(data)
+
+
+  def render_json(self, name, data):
+    """Returns:
+        dict -- rendered card
+    """
+    return json.loads(self.render(name, data))
+
+
+  def get_stats(self):
+    return {
+      'templates': len(self._templates),
+      'compiles': self.compiles,
+      'renders': self.renders
+    }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+  """template engine shared by the process, for ./static/cards"""
+  # pylint: disable=global-statement
+  global _engine
+  if _engine is None:
+    with _engine_lock:
+      if _engine is None:
+        _engine = CardTemplateEngine(
+          here('../static/cards'),
+          cache_dir=here('../data/jinja'),
+          check_interval=float(os.environ.get('bot_card_check_interval', 2.0)))
+        _engine.precompile()
+  return _engine
+
+
+if __name__ == '__main__':
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    card_dir = here('../static/cards')
+    data = {
+      'city': '横浜',
+      'today': {'date': '2020-01-01', 'telop': '晴れ', 'temp_min': '5', 'temp_max': '11', 'img_url': 'http://example.com/1.gif'}
+    }
+    rounds = 1000
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+      env = Environment(loader=FileSystemLoader(card_dir))
+      json.loads(env.get_template('weather.j2').render(data))
+    print('new Environment per card: {:8.1f} usec/card'.format((time.perf_counter() - start) / rounds * 1e6))
+
+    engine = get_engine()
+    start = time.perf_counter()
+    for _ in range(rounds):
+      engine.render_json('weather.j2', data)
+    print('shared engine:            {:8.1f} usec/card'.format((time.perf_counter() - start) / rounds * 1e6))
+    print(engine.get_stats())
+    return 0
+
+  sys.exit(main())
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""State of adaptive cards sent by the bot, stored in redis
+
+- store_card() saves the result of send_message() with its time to live, in one round trip (MULTI)
+- claim_submission() decides the first person who submitted the card, atomically (lua script)
+- every submission is recorded in the history list of the card
+- cards are indexed by the time sent, iter_cards() pages through them with ZREVRANGEBYSCORE
+  and pipelined HGETALL, never KEYS
+
+keys:
+  card:{message_id}              hash, the message sent
+  card:{message_id}:submissions  list, json of each submission
+  card:index                     sorted set, message id scored by the time sent
+"""
+
+import json
+import logging
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CardStateStore:
+
+  # result of claim_submission()
+  CLAIMED = 'claimed'
+  ALREADY_SUBMITTED = 'already_submitted'
+  UNKNOWN_CARD = 'unknown_card'
+
+  # KEYS[1]: card hash, KEYS[2]: submission list
+  # ARGV[1]: person id, ARGV[2]: submitted time, ARGV[3]: json of the submission
+  # returns {status, person id who owns the card}
+  CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return {0, ''}
+end
+redis.call('RPUSH', KEYS[2], ARGV[3])
+local pttl = redis.call('PTTL', KEYS[1])
+if pttl > 0 then
+  redis.call('PEXPIRE', KEYS[2], pttl)
+end
+local owner = redis.call('HGET', KEYS[1], 'submitted_by')
+if owner then
+  return {2, owner}
+end
+redis.call('HSET', KEYS[1], 'submitted_by', ARGV[1], 'submitted_at', ARGV[2])
+return {1, ARGV[1]}
+"""
+
+  def __init__(self, conn, prefix='card', ttl=600):
+    """constructor for CardStateStore
+
+    Arguments:
+        conn {redis.StrictRedis} -- redis client, created with decode_responses=True
+
+    Keyword Arguments:
+        prefix {str} -- prefix of redis keys (default: {'card'})
+        ttl {int} -- seconds to keep the card (default: {600})
+    """
+    self.conn = conn
+    self.prefix = prefix
+    self.ttl = ttl
+    self._claim = conn.register_script(self.CLAIM_SCRIPT)
+
+
+  def card_key(self, message_id):
+    return '{}:{}'.format(self.prefix, message_id)
+
+
+  def submissions_key(self, message_id):
+    return '{}:{}:submissions'.format(self.prefix, message_id)
+
+
+  def index_key(self):
+    return '{}:index'.format(self.prefix)
+
+
+  @staticmethod
+  def _flatten(mapping):
+    """redis hash accepts only str, int and float"""
+    result = {}
+    for k, v in mapping.items():
+      if v is None:
+        continue
+      if isinstance(v, (str, int, float)) and not isinstance(v, bool):
+        result[k] = v
+      else:
+        result[k] = json.dumps(v, ensure_ascii=False)
+    return result
+
+
+  def store_card(self, message_id, mapping, ttl=None):
+    """store the card with time to live, in one round trip
+
+    Arguments:
+        message_id {str} -- id of the message which has the card
+        mapping {dict} -- result of send_message()
+
+    Keyword Arguments:
+        ttl {int} -- seconds to keep the card (default: {None})
+    """
+    ttl = self.ttl if ttl is None else ttl
+    key = self.card_key(message_id)
+    now = time.time()
+    pipe = self.conn.pipeline(transaction=True)
+    pipe.hset(key, mapping=self._flatten(mapping))
+    pipe.expire(key, ttl)
+    pipe.zadd(self.index_key(), {message_id: now})
+    # entries older than the longest time to live point to expired cards
+    pipe.zremrangebyscore(self.index_key(), '-inf', now - max(ttl, self.ttl))
+    pipe.execute()
+
+
+  def get_card(self, message_id):
+    return self.conn.hgetall(self.card_key(message_id))
+
+
+  def claim_submission(self, message_id, person_id, inputs=None, submitted_at=None):
+    """claim the card for the person, only the first submission wins
+
+    Arguments:
+        message_id {str} -- id of the message which has the card
+        person_id {str} -- id of the person who submitted
+
+    Keyword Arguments:
+        inputs {dict} -- values of the inputs in the card (default: {None})
+        submitted_at {str} -- time of the submission (default: {None})
+
+    Returns:
+        tuple -- (CLAIMED, ALREADY_SUBMITTED or UNKNOWN_CARD, person id who owns the card)
+    """
+    submitted_at = submitted_at or '{:.3f}'.format(time.time())
+    submission = json.dumps({'personId': person_id, 'created': submitted_at, 'inputs': inputs}, ensure_ascii=False)
+    status, owner = self._claim(
+      keys=[self.card_key(message_id), self.submissions_key(message_id)],
+      args=[person_id, submitted_at, submission])
+    status = int(status)
+    if status == 0:
+      return self.UNKNOWN_CARD, None
+    if status == 1:
+      return self.CLAIMED, owner
+    return self.ALREADY_SUBMITTED, owner
+
+
+  def count_cards(self):
+    return self.conn.zcard(self.index_key())
+
+
+  def iter_cards(self, batch_size=100, max_items=None, before=None):
+    """iterate over the cards, newest first
+
+    Each batch costs one ZREVRANGEBYSCORE and one pipelined HGETALL of the batch,
+    so the listing never blocks redis like KEYS does. Index entries of expired cards
+    are removed on the way.
+
+    Keyword Arguments:
+        batch_size {int} -- number of cards fetched per round trip (default: {100})
+        max_items {int} -- stop after this number of cards (default: {None})
+        before {float} -- start from cards sent before this unix time, for paging (default: {None})
+
+    Yields:
+        tuple -- (message id, unix time sent, dict of the card)
+    """
+    count = 0
+    max_score = '+inf' if before is None else '({}'.format(before)
+    offset = 0
+    while True:
+      entries = self.conn.zrevrangebyscore(self.index_key(), max_score, '-inf', start=offset, num=batch_size, withscores=True)
+      if not entries:
+        return
+
+      pipe = self.conn.pipeline(transaction=False)
+      for message_id, _ in entries:
+        pipe.hgetall(self.card_key(message_id))
+      cards = pipe.execute()
+
+      expired = []
+      for (message_id, score), card in zip(entries, cards):
+        if not card:
+          expired.append(message_id)
+          continue
+        yield message_id, score, card
+        count += 1
+        if max_items is not None and count >= max_items:
+          break
+      if expired:
+        self.conn.zrem(self.index_key(), *expired)
+
+      if max_items is not None and count >= max_items:
+        return
+      if len(entries) < batch_size:
+        return
+      # continue from the oldest score of this batch, skipping the entries
+      # with that score already yielded (expired ones are removed from the index)
+      last_score = entries[-1][1]
+      expired = set(expired)
+      same = sum(1 for message_id, score in entries if score == last_score and message_id not in expired)
+      offset = offset + same if max_score == last_score else same
+      max_score = last_score
+
+
+  def scan_card_ids(self, count=500):
+    """iterate over message ids of all cards in redis with SCAN, including cards not in the index
+
+    Keyword Arguments:
+        count {int} -- hint of the number of keys per SCAN (default: {500})
+
+    Yields:
+        str -- message id
+    """
+    head = '{}:'.format(self.prefix)
+    for key in self.conn.scan_iter(match='{}*'.format(head), count=count):
+      if key == self.index_key() or key.endswith(':submissions'):
+        continue
+      yield key[len(head):]
+
+
+  def get_submissions(self, message_id):
+    """Returns:
+        list -- submissions in the order received
+    """
+    return [json.loads(s) for s in self.conn.lrange(self.submissions_key(message_id), 0, -1)]
+
+
+if __name__ == '__main__':
+
+  import os
+  from concurrent.futures import ThreadPoolExecutor
+
+  import redis
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    redis_url = os.environ.get('bot_redis_url', 'redis://localhost:6399')
+    conn = redis.StrictRedis(connection_pool=redis.BlockingConnectionPool.from_url(redis_url, max_connections=50, decode_responses=True))
+    store = CardStateStore(conn, prefix='test:card', ttl=60)
+
+    cards = 200
+    people = 10
+    for i in range(cards):
+      store.store_card('m{}'.format(i), {'id': 'm{}'.format(i), 'roomId': 'room', 'created': '2020-01-01T00:00:00.000Z'})
+
+    # every person submits every card at the same time
+    tasks = [('m{}'.format(i), 'p{}'.format(p)) for i in range(cards) for p in range(people)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=50) as executor:
+      results = list(executor.map(lambda t: store.claim_submission(*t), tasks))
+    elapsed = time.perf_counter() - start
+
+    claimed = [r for r in results if r[0] == CardStateStore.CLAIMED]
+    print('{} claims in {:.2f} sec, {:.0f} claims/sec'.format(len(tasks), elapsed, len(tasks) / elapsed))
+    print('winners: {} (expected {})'.format(len(claimed), cards))
+    print('history of m0: {}'.format(len(store.get_submissions('m0'))))
+
+    start = time.perf_counter()
+    listed = sum(1 for _ in store.iter_cards(batch_size=50))
+    print('listed {} cards in {:.3f} sec'.format(listed, time.perf_counter() - start))
+
+    for i in range(cards):
+      conn.delete(store.card_key('m{}'.format(i)), store.submissions_key('m{}'.format(i)))
+    conn.delete(store.index_key())
+    return 0
+
+  sys.exit(main())
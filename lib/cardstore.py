@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Repository of adaptive cards in ./static/cards
+
+- every *.json and *.j2 is loaded and validated once at startup, server.py calls get_repository()
+  when it starts, so broken cards are logged at boot
+- *.json is kept as the attachment dict, and as its json bytes ready to be embedded in the request,
+  see Bot.encode_payload()
+- *.j2 is valid json whose strings have {{ }}, its structure is validated and kept for the card builder
+- files starting with '_' are fragments of a card, e.g. a Column, and validated as an element
+- the file is checked at most every check_interval seconds, and loaded again only when it is changed
+
+Validation covers the structure of the Adaptive Card schema used by Webex Teams
+(types of the elements and actions, and their required properties), not every property.
+"""
+
+import copy
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+def here(path=''):
+  return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+
+
+CONTENT_TYPE = "application/vnd.microsoft.card.adaptive"
+
+
+class CardValidationError(ValueError):
+  pass
+
+
+# element type -> required properties
+ELEMENTS = {
+  'TextBlock': ('text',),
+  'RichTextBlock': ('inlines',),
+  'Image': ('url',),
+  'ImageSet': ('images',),
+  'Media': ('sources',),
+  'FactSet': ('facts',),
+  'Container': ('items',),
+  'ColumnSet': (),
+  'Column': (),
+  'ActionSet': ('actions',),
+  'Input.Text': ('id',),
+  'Input.Number': ('id',),
+  'Input.Date': ('id',),
+  'Input.Time': ('id',),
+  'Input.Toggle': ('id', 'title'),
+  'Input.ChoiceSet': ('id', 'choices')
+}
+
+# action type -> required properties
+ACTIONS = {
+  'Action.Submit': (),
+  'Action.OpenUrl': ('url',),
+  'Action.ShowCard': ('card',),
+  'Action.ToggleVisibility': ('targetElements',)
+}
+
+# property -> kind of the children
+CHILDREN = {
+  'body': 'element',
+  'items': 'element',
+  'columns': 'column',
+  'images': 'image',
+  'actions': 'action'
+}
+
+
+def _check_list(value, where):
+  if not isinstance(value, list):
+    raise CardValidationError("{}: must be a list".format(where))
+
+
+def validate_element(element, where='$', kind='element'):
+  """validate the element and its children
+
+  Raises:
+      CardValidationError -- the element is broken
+  """
+  if not isinstance(element, dict):
+    raise CardValidationError("{}: must be an object".format(where))
+  element_type = element.get('type')
+
+  if kind == 'action':
+    if element_type not in ACTIONS:
+      raise CardValidationError("{}: unknown action type {!r}".format(where, element_type))
+    required = ACTIONS[element_type]
+  else:
+    if element_type not in ELEMENTS:
+      raise CardValidationError("{}: unknown element type {!r}".format(where, element_type))
+    if kind == 'column' and element_type != 'Column':
+      raise CardValidationError("{}: ColumnSet accepts only Column, not {!r}".format(where, element_type))
+    if kind == 'image' and element_type != 'Image':
+      raise CardValidationError("{}: ImageSet accepts only Image, not {!r}".format(where, element_type))
+    required = ELEMENTS[element_type]
+
+  for name in required:
+    if name not in element:
+      raise CardValidationError("{}: {} requires {!r}".format(where, element_type, name))
+
+  for name, child_kind in CHILDREN.items():
+    if name not in element:
+      continue
+    _check_list(element[name], '{}.{}'.format(where, name))
+    for i, child in enumerate(element[name]):
+      validate_element(child, '{}.{}[{}]'.format(where, name, i), child_kind)
+
+  if element_type == 'Action.ShowCard':
+    validate_card(element['card'], '{}.card'.format(where))
+  if element_type == 'Input.ChoiceSet':
+    _check_list(element['choices'], '{}.choices'.format(where))
+
+
+def validate_card(card, where='$'):
+  """validate the adaptive card
+
+  Raises:
+      CardValidationError -- the card is broken
+  """
+  if not isinstance(card, dict):
+    raise CardValidationError("{}: must be an object".format(where))
+  if card.get('type') != 'AdaptiveCard':
+    raise CardValidationError("{}: type must be 'AdaptiveCard'".format(where))
+  if not re.match(r'^\d+\.\d+$', str(card.get('version', ''))):
+    raise CardValidationError("{}: invalid version {!r}".format(where, card.get('version')))
+  for name in ['body', 'actions']:
+    if name not in card:
+      continue
+    _check_list(card[name], '{}.{}'.format(where, name))
+    for i, child in enumerate(card[name]):
+      validate_element(child, '{}.{}[{}]'.format(where, name, i), CHILDREN[name])
+
+
+class Card:
+
+  __slots__ = ('name', 'path', 'mtime', 'content', 'attachment', 'data', 'template')
+
+  def __init__(self, name, path, mtime, content, template=False):
+    self.name = name
+    self.path = path
+    self.mtime = mtime
+    self.content = content      # dict of the card, or of the template with {{ }}
+    self.template = template
+    if template:
+      self.attachment = None
+      self.data = None
+    else:
+      self.attachment = {'contentType': CONTENT_TYPE, 'content': content}
+      self.data = json.dumps(self.attachment, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class CardRepository:
+
+  EXTENSIONS = ('.json', '.j2')
+
+  def __init__(self, card_dir, check_interval=2.0):
+    """constructor for CardRepository
+
+    Arguments:
+        card_dir {str} -- directory of the cards
+
+    Keyword Arguments:
+        check_interval {float} -- seconds between checks of the card file (default: {2.0})
+    """
+    self.card_dir = card_dir
+    self.check_interval = check_interval
+    self._cards = {}    # name -> Card
+    self._checked = {}  # name -> monotonic time of the last check
+    self._lock = threading.Lock()
+
+    # metrics
+    self.loads = 0
+    self.errors = {}    # name -> message of the validation error
+
+
+  def _load_file(self, path):
+    """Returns:
+        Card -- loaded card, None if the file is broken
+    """
+    name = path.name
+    try:
+      mtime = path.stat().st_mtime
+      with open(str(path), encoding='utf-8') as f:
+        content = json.load(f)
+      if name.startswith('_'):
+        validate_element(content, where=name)
+      else:
+        validate_card(content, where=name)
+    except (IOError, OSError, ValueError) as e:
+      # ValueError includes json.JSONDecodeError and CardValidationError
+      logger.error("invalid card %s: %s", name, e)
+      self.errors[name] = str(e)
+      return None
+    self.errors.pop(name, None)
+    self.loads += 1
+    return Card(name, str(path), mtime, content, template=path.suffix == '.j2')
+
+
+  def load(self):
+    """load every card in card_dir
+
+    Returns:
+        list -- names of the cards loaded
+    """
+    p = Path(self.card_dir)
+    if not p.is_dir():
+      return []
+    now = time.monotonic()
+    cards = {}
+    for path in sorted(p.iterdir()):
+      if path.suffix not in self.EXTENSIONS:
+        continue
+      card = self._load_file(path)
+      if card is not None:
+        cards[card.name] = card
+    with self._lock:
+      self._cards = cards
+      self._checked = {name: now for name in cards}
+    return sorted(cards.keys())
+
+
+  def _get(self, name):
+    now = time.monotonic()
+    card = self._cards.get(name)
+    if card is not None and now - self._checked.get(name, 0) < self.check_interval:
+      return card
+
+    path = Path(self.card_dir, name)
+    try:
+      mtime = path.stat().st_mtime
+    except OSError:
+      mtime = None
+    self._checked[name] = now
+
+    if card is not None and mtime == card.mtime:
+      return card
+    if mtime is None:
+      if card is not None:
+        with self._lock:
+          self._cards = {k: v for k, v in self._cards.items() if k != name}
+      return None
+    if path.suffix not in self.EXTENSIONS or path.resolve().parent != Path(self.card_dir).resolve():
+      return None
+
+    # new or changed, the old card is kept if the new one is broken
+    loaded = self._load_file(path)
+    if loaded is None:
+      return card
+    with self._lock:
+      self._cards = dict(self._cards, **{name: loaded})
+    return loaded
+
+
+  def get(self, name, copy_content=False):
+    """get the attachment of the card
+
+    The dict is shared, do not modify it unless copy_content is True.
+
+    Arguments:
+        name {str} -- file name of the card, e.g. 'choice.json'
+
+    Keyword Arguments:
+        copy_content {bool} -- return a deep copy (default: {False})
+
+    Returns:
+        dict -- attachment, None if not found
+    """
+    card = self._get(name)
+    if card is None or card.template:
+      return None
+    return copy.deepcopy(card.attachment) if copy_content else card.attachment
+
+
+  def get_bytes(self, name):
+    """Returns:
+        bytes -- json of the attachment, None if not found
+    """
+    card = self._get(name)
+    if card is None or card.template:
+      return None
+    return card.data
+
+
+  def get_template(self, name):
+    """Returns:
+        dict -- structure of the template with {{ }} in its strings, None if not found
+    """
+    card = self._get(name)
+    if card is None or not card.template:
+      return None
+    return card.content
+
+
+  def names(self):
+    return sorted(self._cards.keys())
+
+
+  def get_stats(self):
+    return {
+      'cards': len(self._cards),
+      'loads': self.loads,
+      'errors': dict(self.errors)
+    }
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def get_repository():
+  """card repository shared by the process, for ./static/cards"""
+  # pylint: disable=global-statement
+  global _repository
+  if _repository is None:
+    with _repository_lock:
+      if _repository is None:
+        repository = CardRepository(
+          here('../static/cards'),
+          check_interval=float(os.environ.get('bot_card_check_interval', 2.0)))
+        repository.load()
+        _repository = repository
+  return _repository
+
+
+if __name__ == '__main__':
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    card_dir = here('../static/cards')
+    repository = get_repository()
+    print(repository.names(), repository.get_stats())
+
+    rounds = 10000
+    start = time.perf_counter()
+    for _ in range(rounds):
+      with open(os.path.join(card_dir, 'choice.json')) as f:
+        json.dumps({'attachments': [{'contentType': CONTENT_TYPE, 'content': json.load(f)}]})
+    print('json.load per send:  {:6.1f} usec/card'.format((time.perf_counter() - start) / rounds * 1e6))
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+      repository.get_bytes('choice.json')
+    print('preloaded bytes:     {:6.1f} usec/card'.format((time.perf_counter() - start) / rounds * 1e6))
+    return 0
+
+  sys.exit(main())
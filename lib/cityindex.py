@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Index of the cities of the weather forecast
+
+The cities are the areas of livedoor weather hacks (primary_area.xml),
+the prefecture is taken from the first two digits of the area code.
+
+The index is built once at import,
+
+- exact lookup by the area code, the name, the reading in kana and the romaji, in one dict
+- prefix lookup on the sorted keys, e.g. '横' -> 横浜, 横手
+- fuzzy lookup with difflib for misspelled romaji or kana, e.g. 'yokohma' -> 横浜
+- the prefecture name returns its cities, e.g. '沖縄' -> 那覇, 名護, ...
+- the text of '/tenki list' grouped by prefecture
+
+Queries are normalized with NFKC, case folded, katakana are converted to hiragana, and
+long vowels of romaji are shortened, so 'Tokyo', 'toukyou', 'トウキョウ' and 'とうきょう' are the same key.
+"""
+
+import bisect
+import difflib
+import re
+import sys
+import unicodedata
+from collections import namedtuple
+
+City = namedtuple('City', ['code', 'name', 'kana', 'romaji', 'prefecture'])
+
+
+# JIS X 0401, index is the first two digits of the area code
+PREFECTURES = (
+  None,
+  '北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県',
+  '茨城県', '栃木県', '群馬県', '埼玉県', '千葉県', '東京都', '神奈川県',
+  '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県', '岐阜県',
+  '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県',
+  '奈良県', '和歌山県', '鳥取県', '島根県', '岡山県', '広島県', '山口県',
+  '徳島県', '香川県', '愛媛県', '高知県', '福岡県', '佐賀県', '長崎県',
+  '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県'
+)
+
+
+# area code, name, kana, romaji
+# http://weather.livedoor.com/forecast/rss/primary_area.xml
+CITIES = (
+  ('011000', '稚内', 'わっかない', 'wakkanai'),
+  ('012010', '旭川', 'あさひかわ', 'asahikawa'),
+  ('012020', '留萌', 'るもい', 'rumoi'),
+  ('013010', '網走', 'あばしり', 'abashiri'),
+  ('013020', '北見', 'きたみ', 'kitami'),
+  ('013030', '紋別', 'もんべつ', 'monbetsu'),
+  ('014010', '根室', 'ねむろ', 'nemuro'),
+  ('014020', '釧路', 'くしろ', 'kushiro'),
+  ('014030', '帯広', 'おびひろ', 'obihiro'),
+  ('015010', '室蘭', 'むろらん', 'muroran'),
+  ('015020', '浦河', 'うらかわ', 'urakawa'),
+  ('016010', '札幌', 'さっぽろ', 'sapporo'),
+  ('016020', '岩見沢', 'いわみざわ', 'iwamizawa'),
+  ('016030', '倶知安', 'くっちゃん', 'kutchan'),
+  ('017010', '函館', 'はこだて', 'hakodate'),
+  ('017020', '江差', 'えさし', 'esashi'),
+  ('020010', '青森', 'あおもり', 'aomori'),
+  ('020020', 'むつ', 'むつ', 'mutsu'),
+  ('020030', '八戸', 'はちのへ', 'hachinohe'),
+  ('030010', '盛岡', 'もりおか', 'morioka'),
+  ('030020', '宮古', 'みやこ', 'miyako'),
+  ('030030', '大船渡', 'おおふなと', 'ofunato'),
+  ('040010', '仙台', 'せんだい', 'sendai'),
+  ('040020', '白石', 'しろいし', 'shiroishi'),
+  ('050010', '秋田', 'あきた', 'akita'),
+  ('050020', '横手', 'よこて', 'yokote'),
+  ('060010', '山形', 'やまがた', 'yamagata'),
+  ('060020', '米沢', 'よねざわ', 'yonezawa'),
+  ('060030', '酒田', 'さかた', 'sakata'),
+  ('060040', '新庄', 'しんじょう', 'shinjo'),
+  ('070010', '福島', 'ふくしま', 'fukushima'),
+  ('070020', '小名浜', 'おなはま', 'onahama'),
+  ('070030', '若松', 'わかまつ', 'wakamatsu'),
+  ('080010', '水戸', 'みと', 'mito'),
+  ('080020', '土浦', 'つちうら', 'tsuchiura'),
+  ('090010', '宇都宮', 'うつのみや', 'utsunomiya'),
+  ('090020', '大田原', 'おおたわら', 'otawara'),
+  ('100010', '前橋', 'まえばし', 'maebashi'),
+  ('100020', 'みなかみ', 'みなかみ', 'minakami'),
+  ('110010', 'さいたま', 'さいたま', 'saitama'),
+  ('110020', '熊谷', 'くまがや', 'kumagaya'),
+  ('110030', '秩父', 'ちちぶ', 'chichibu'),
+  ('120010', '千葉', 'ちば', 'chiba'),
+  ('120020', '銚子', 'ちょうし', 'choshi'),
+  ('120030', '館山', 'たてやま', 'tateyama'),
+  ('130010', '東京', 'とうきょう', 'tokyo'),
+  ('130020', '大島', 'おおしま', 'oshima'),
+  ('130030', '八丈島', 'はちじょうじま', 'hachijojima'),
+  ('130040', '父島', 'ちちじま', 'chichijima'),
+  ('140010', '横浜', 'よこはま', 'yokohama'),
+  ('140020', '小田原', 'おだわら', 'odawara'),
+  ('150010', '新潟', 'にいがた', 'niigata'),
+  ('150020', '長岡', 'ながおか', 'nagaoka'),
+  ('150030', '高田', 'たかだ', 'takada'),
+  ('150040', '相川', 'あいかわ', 'aikawa'),
+  ('160010', '富山', 'とやま', 'toyama'),
+  ('160020', '伏木', 'ふしき', 'fushiki'),
+  ('170010', '金沢', 'かなざわ', 'kanazawa'),
+  ('170020', '輪島', 'わじま', 'wajima'),
+  ('180010', '福井', 'ふくい', 'fukui'),
+  ('180020', '敦賀', 'つるが', 'tsuruga'),
+  ('190010', '甲府', 'こうふ', 'kofu'),
+  ('190020', '河口湖', 'かわぐちこ', 'kawaguchiko'),
+  ('200010', '長野', 'ながの', 'nagano'),
+  ('200020', '松本', 'まつもと', 'matsumoto'),
+  ('200030', '飯田', 'いいだ', 'iida'),
+  ('210010', '岐阜', 'ぎふ', 'gifu'),
+  ('210020', '高山', 'たかやま', 'takayama'),
+  ('220010', '静岡', 'しずおか', 'shizuoka'),
+  ('220020', '網代', 'あじろ', 'ajiro'),
+  ('220030', '三島', 'みしま', 'mishima'),
+  ('220040', '浜松', 'はままつ', 'hamamatsu'),
+  ('230010', '名古屋', 'なごや', 'nagoya'),
+  ('230020', '豊橋', 'とよはし', 'toyohashi'),
+  ('240010', '津', 'つ', 'tsu'),
+  ('240020', '尾鷲', 'おわせ', 'owase'),
+  ('250010', '大津', 'おおつ', 'otsu'),
+  ('250020', '彦根', 'ひこね', 'hikone'),
+  ('260010', '京都', 'きょうと', 'kyoto'),
+  ('260020', '舞鶴', 'まいづる', 'maizuru'),
+  ('270000', '大阪', 'おおさか', 'osaka'),
+  ('280010', '神戸', 'こうべ', 'kobe'),
+  ('280020', '豊岡', 'とよおか', 'toyooka'),
+  ('290010', '奈良', 'なら', 'nara'),
+  ('290020', '風屋', 'かぜや', 'kazeya'),
+  ('300010', '和歌山', 'わかやま', 'wakayama'),
+  ('300020', '潮岬', 'しおのみさき', 'shionomisaki'),
+  ('310010', '鳥取', 'とっとり', 'tottori'),
+  ('310020', '米子', 'よなご', 'yonago'),
+  ('320010', '松江', 'まつえ', 'matsue'),
+  ('320020', '浜田', 'はまだ', 'hamada'),
+  ('320030', '西郷', 'さいごう', 'saigo'),
+  ('330010', '岡山', 'おかやま', 'okayama'),
+  ('330020', '津山', 'つやま', 'tsuyama'),
+  ('340010', '広島', 'ひろしま', 'hiroshima'),
+  ('340020', '庄原', 'しょうばら', 'shobara'),
+  ('350010', '下関', 'しものせき', 'shimonoseki'),
+  ('350020', '山口', 'やまぐち', 'yamaguchi'),
+  ('350030', '柳井', 'やない', 'yanai'),
+  ('350040', '萩', 'はぎ', 'hagi'),
+  ('360010', '徳島', 'とくしま', 'tokushima'),
+  ('360020', '日和佐', 'ひわさ', 'hiwasa'),
+  ('370000', '高松', 'たかまつ', 'takamatsu'),
+  ('380010', '松山', 'まつやま', 'matsuyama'),
+  ('380020', '新居浜', 'にいはま', 'niihama'),
+  ('380030', '宇和島', 'うわじま', 'uwajima'),
+  ('390010', '高知', 'こうち', 'kochi'),
+  ('390020', '室戸岬', 'むろとみさき', 'murotomisaki'),
+  ('390030', '清水', 'しみず', 'shimizu'),
+  ('400010', '福岡', 'ふくおか', 'fukuoka'),
+  ('400020', '八幡', 'やはた', 'yahata'),
+  ('400030', '飯塚', 'いいづか', 'iizuka'),
+  ('400040', '久留米', 'くるめ', 'kurume'),
+  ('410010', '佐賀', 'さが', 'saga'),
+  ('410020', '伊万里', 'いまり', 'imari'),
+  ('420010', '長崎', 'ながさき', 'nagasaki'),
+  ('420020', '佐世保', 'させぼ', 'sasebo'),
+  ('420030', '厳原', 'いづはら', 'izuhara'),
+  ('420040', '福江', 'ふくえ', 'fukue'),
+  ('430010', '熊本', 'くまもと', 'kumamoto'),
+  ('430020', '阿蘇乙姫', 'あそおとひめ', 'asootohime'),
+  ('430030', '牛深', 'うしぶか', 'ushibuka'),
+  ('430040', '人吉', 'ひとよし', 'hitoyoshi'),
+  ('440010', '大分', 'おおいた', 'oita'),
+  ('440020', '中津', 'なかつ', 'nakatsu'),
+  ('440030', '日田', 'ひた', 'hita'),
+  ('440040', '佐伯', 'さいき', 'saiki'),
+  ('450010', '宮崎', 'みやざき', 'miyazaki'),
+  ('450020', '延岡', 'のべおか', 'nobeoka'),
+  ('450030', '都城', 'みやこのじょう', 'miyakonojo'),
+  ('450040', '高千穂', 'たかちほ', 'takachiho'),
+  ('460010', '鹿児島', 'かごしま', 'kagoshima'),
+  ('460020', '鹿屋', 'かのや', 'kanoya'),
+  ('460030', '種子島', 'たねがしま', 'tanegashima'),
+  ('460040', '名瀬', 'なぜ', 'naze'),
+  ('471010', '那覇', 'なは', 'naha'),
+  ('471020', '名護', 'なご', 'nago'),
+  ('471030', '久米島', 'くめじま', 'kumejima'),
+  ('472000', '南大東', 'みなみだいとう', 'minamidaito'),
+  ('473000', '宮古島', 'みやこじま', 'miyakojima'),
+  ('474010', '石垣島', 'いしがきじま', 'ishigakijima'),
+  ('474020', '与那国島', 'よなぐにじま', 'yonagunijima')
+)
+
+
+_KATAKANA = {c: c - 0x60 for c in range(ord('ァ'), ord('ヶ') + 1)}
+_LONG_VOWELS = re.compile(r'([aiueo])[aiueo]')
+_LONG_VOWEL_PAIRS = ('aa', 'ii', 'uu', 'ee', 'oo', 'ou')
+_SEPARATORS = re.compile(r'[\s\-_・]+')
+
+
+def _shorten(m):
+  text = m.group(0)
+  return m.group(1) if text in _LONG_VOWEL_PAIRS else text
+
+
+def normalize(query):
+  """normalize the query to the key of the index
+
+  e.g. ' Tokyo ' -> 'tokyo', 'Toukyou' -> 'tokyo', 'トウキョウ' -> 'とうきょう'
+  """
+  text = unicodedata.normalize('NFKC', query).strip().lower()
+  text = _SEPARATORS.sub('', text).translate(_KATAKANA)
+  if text.isascii():
+    text = _LONG_VOWELS.sub(_shorten, text)
+  return text
+
+
+def prefecture_of(code):
+  return PREFECTURES[int(code[:2])]
+
+
+class CityIndex:
+
+  def __init__(self, cities=CITIES):
+    """constructor for CityIndex
+
+    Keyword Arguments:
+        cities {list} -- tuples of (area code, name, kana, romaji) (default: {CITIES})
+    """
+    self.cities = [City(code, name, kana, romaji, prefecture_of(code)) for code, name, kana, romaji in cities]
+
+    # query as it is and normalized key -> City
+    self._exact = {}
+    for city in self.cities:
+      for key in (city.code, city.name, city.kana, city.romaji):
+        self._exact.setdefault(key, city)
+        self._exact.setdefault(normalize(key), city)
+    self._keys = sorted(self._exact.keys())
+
+    # prefecture with and without 都府県 -> cities
+    self._prefectures = {}
+    for city in self.cities:
+      pref = city.prefecture
+      for key in {pref, pref if pref == '北海道' else pref[:-1]}:
+        self._prefectures.setdefault(key, []).append(city)
+
+    # name -> area code, as returned by the old get_city_map()
+    self.city_map = {city.name: city.code for city in self.cities}
+    self.list_text = self._format_list()
+
+
+  def _format_list(self):
+    lines = []
+    for pref in PREFECTURES[1:]:
+      names = [city.name for city in self._prefectures.get(pref, [])]
+      if names:
+        lines.append('{}: {}'.format(pref, ' '.join(names)))
+    return '\n'.join(lines)
+
+
+  def lookup(self, query):
+    """exact lookup by the area code, name, kana or romaji
+
+    Returns:
+        City -- the city, None if not found
+    """
+    city = self._exact.get(query)
+    if city is None:
+      city = self._exact.get(normalize(query))
+    return city
+
+
+  def search(self, query, limit=10):
+    """find the cities, exact matches first, then prefix, prefecture and fuzzy matches
+
+    Arguments:
+        query {str} -- area code, name, kana or romaji, or a part of them
+
+    Keyword Arguments:
+        limit {int} -- max number of the results (default: {10})
+
+    Returns:
+        list -- City, empty if nothing is found
+    """
+    city = self.lookup(query)
+    if city is not None:
+      return [city]
+
+    key = normalize(query)
+    if not key:
+      return []
+    results = []
+
+    def add(city):
+      if city not in results:
+        results.append(city)
+
+    # keys starting with the query are adjacent in the sorted keys
+    pos = bisect.bisect_left(self._keys, key)
+    while pos < len(self._keys) and self._keys[pos].startswith(key) and len(results) < limit:
+      add(self._exact[self._keys[pos]])
+      pos += 1
+    if results:
+      return results
+
+    for city in self._prefectures.get(key, []):
+      add(city)
+    if results:
+      return results[:limit]
+
+    for match in difflib.get_close_matches(key, self._keys, n=limit, cutoff=0.75):
+      add(self._exact[match])
+    return results
+
+
+  def cities_in(self, prefecture):
+    """Returns:
+        list -- City in the prefecture, e.g. '沖縄' or '沖縄県'
+    """
+    return list(self._prefectures.get(prefecture, []))
+
+
+_index = CityIndex()
+
+
+def get_city_index():
+  """city index built at import"""
+  return _index
+
+
+if __name__ == '__main__':
+
+  import timeit
+
+  def main():
+    index = get_city_index()
+    for query in ['横浜', 'yokohama', 'Toukyou', 'トウキョウ', '140010', '横', 'miya', '沖縄', 'yokohma', 'さっぽろ', 'unknown']:
+      print('{:10s} {}'.format(query, [c.name for c in index.search(query)]))
+    print(index.list_text)
+
+    rounds = 100000
+    t = timeit.timeit(lambda: index.lookup('横浜'), number=rounds)
+    print('exact lookup:      {:6.3f} usec'.format(t / rounds * 1e6))
+    t = timeit.timeit(lambda: index.lookup('Yokohama'), number=rounds)
+    print('normalized lookup: {:6.3f} usec'.format(t / rounds * 1e6))
+    return 0
+
+  sys.exit(main())
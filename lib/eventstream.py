@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Durable webhook event queue on Redis Streams
+
+- the webhook handler appends the event to a stream (XADD)
+- every gunicorn worker (or host) reads the stream as a member of one consumer group (XREADGROUP)
+- the event is acknowledged (XACK) after it is handled
+- events left pending by a crashed consumer are claimed by the others (XPENDING + XCLAIM)
+- events delivered too many times are moved to a dead letter stream
+
+see, https://redis.io/topics/streams-intro
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class RedisEventStream:
+
+  def __init__(self, conn, stream='bot:events', group='bot', maxlen=100000, batch_size=10, block_ms=5000, claim_idle_ms=60000, max_deliveries=5):
+    """constructor for RedisEventStream
+
+    Arguments:
+        conn {redis.StrictRedis} -- redis client, created with decode_responses=True
+
+    Keyword Arguments:
+        stream {str} -- key of the stream (default: {'bot:events'})
+        group {str} -- name of the consumer group (default: {'bot'})
+        maxlen {int} -- approximate max length of the stream (default: {100000})
+        batch_size {int} -- max number of events read at once (default: {10})
+        block_ms {int} -- milliseconds to block in XREADGROUP (default: {5000})
+        claim_idle_ms {int} -- pending events idle longer than this are reclaimed (default: {60000})
+        max_deliveries {int} -- events delivered more than this are moved to the dead letter stream (default: {5})
+    """
+    self.conn = conn
+    self.stream = stream
+    self.group = group
+    self.dead_stream = '{}:dead'.format(stream)
+    self.maxlen = maxlen
+    self.batch_size = batch_size
+    self.block_ms = block_ms
+    self.claim_idle_ms = claim_idle_ms
+    self.max_deliveries = max_deliveries
+
+    self._lock = threading.Lock()
+    self._pid = None
+    self._stop = threading.Event()
+    self._threads = []
+    self._group_ready = False
+
+    # metrics
+    self.published = 0
+    self.handled = 0
+    self.failed = 0
+    self.reclaimed = 0
+    self.dead = 0
+
+
+  def ensure_group(self):
+    """create the stream and the consumer group, if not exist"""
+    if self._group_ready:
+      return
+    try:
+      self.conn.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+      if 'BUSYGROUP' not in str(e):
+        raise
+    self._group_ready = True
+
+
+  def publish(self, event):
+    """append the event to the stream
+
+    Arguments:
+        event {dict} -- webhook data
+
+    Returns:
+        str -- id of the stream entry
+    """
+    entry_id = self.conn.xadd(self.stream, {'data': json.dumps(event)}, maxlen=self.maxlen, approximate=True)
+    with self._lock:
+      self.published += 1
+    return entry_id
+
+
+  @staticmethod
+  def _decode(entries):
+    result = []
+    for entry_id, fields in entries or []:
+      if fields is None:
+        # deleted by XTRIM while pending
+        result.append((entry_id, None))
+        continue
+      try:
+        result.append((entry_id, json.loads(fields.get('data'))))
+      except (TypeError, ValueError):
+        logger.error("broken event in stream: %s", entry_id)
+        result.append((entry_id, None))
+    return result
+
+
+  def read(self, consumer, count=None, block_ms=None):
+    """read new events delivered to this consumer
+
+    Returns:
+        list -- list of (entry_id, event)
+    """
+    count = self.batch_size if count is None else count
+    block_ms = self.block_ms if block_ms is None else block_ms
+    response = self.conn.xreadgroup(self.group, consumer, {self.stream: '>'}, count=count, block=block_ms)
+    if not response:
+      return []
+    _, entries = response[0]
+    return self._decode(entries)
+
+
+  def ack(self, *entry_ids):
+    if entry_ids:
+      self.conn.xack(self.stream, self.group, *entry_ids)
+
+
+  def reclaim(self, consumer, count=None):
+    """claim events left pending by other (crashed) consumers
+
+    Returns:
+        list -- list of (entry_id, event) claimed by this consumer
+    """
+    count = self.batch_size if count is None else count
+    pending = self.conn.xpending_range(self.stream, self.group, '-', '+', count)
+
+    claim_ids = []
+    for p in pending:
+      if p.get('time_since_delivered', 0) < self.claim_idle_ms:
+        continue
+      entry_id = p.get('message_id')
+      if p.get('times_delivered', 0) >= self.max_deliveries:
+        self._move_to_dead(entry_id)
+        continue
+      claim_ids.append(entry_id)
+
+    if not claim_ids:
+      return []
+
+    entries = self.conn.xclaim(self.stream, self.group, consumer, self.claim_idle_ms, claim_ids)
+    with self._lock:
+      self.reclaimed += len(entries)
+    return self._decode(entries)
+
+
+  def _move_to_dead(self, entry_id):
+    entries = self.conn.xrange(self.stream, min=entry_id, max=entry_id)
+    pipe = self.conn.pipeline(transaction=True)
+    for _, fields in entries:
+      pipe.xadd(self.dead_stream, fields, maxlen=self.maxlen, approximate=True)
+    pipe.xack(self.stream, self.group, entry_id)
+    pipe.execute()
+    with self._lock:
+      self.dead += 1
+    logger.error("event %s is moved to %s", entry_id, self.dead_stream)
+
+
+  def _handle(self, handler, entries):
+    # pylint: disable=broad-except
+    done = []
+    for entry_id, event in entries:
+      if event is None:
+        done.append(entry_id)
+        continue
+      try:
+        handler(event)
+      except Exception as e:
+        # not acknowledged, reclaimed later by some consumer
+        logger.exception(e)
+        with self._lock:
+          self.failed += 1
+        continue
+      done.append(entry_id)
+      with self._lock:
+        self.handled += 1
+    self.ack(*done)
+
+
+  def consume(self, handler, consumer):
+    """consume events until stop() is called
+
+    Arguments:
+        handler {func} -- called with the event dict
+        consumer {str} -- name of this consumer, unique in the group
+    """
+    # pylint: disable=broad-except
+    last_reclaim = 0.0
+    while not self._stop.is_set():
+      try:
+        self.ensure_group()
+        now = time.monotonic()
+        if now - last_reclaim > self.claim_idle_ms / 1000.0:
+          last_reclaim = now
+          self._handle(handler, self.reclaim(consumer))
+        self._handle(handler, self.read(consumer))
+      except redis.exceptions.RedisError as e:
+        logger.error("%s: %s", consumer, e)
+        self._group_ready = False
+        self._stop.wait(1.0)
+      except Exception as e:
+        logger.exception(e)
+
+
+  def start(self, handler, consumers=1):
+    """start consumer threads in this process
+
+    consumer name is hostname-pid-n, so each gunicorn worker joins the group as its own consumers.
+    """
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self._stop.clear()
+      self._threads = []
+      for i in range(consumers):
+        consumer = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), i)
+        t = threading.Thread(target=self.consume, args=(handler, consumer), name=consumer, daemon=True)
+        t.start()
+        self._threads.append(t)
+      logger.info("started %d consumers of %s", consumers, self.stream)
+
+
+  def stop(self, timeout=None):
+    self._stop.set()
+    for t in self._threads:
+      t.join(timeout)
+    with self._lock:
+      self._pid = None
+      self._threads = []
+
+
+  def get_stats(self):
+    stats = {}
+    try:
+      stats['length'] = self.conn.xlen(self.stream)
+      stats['dead_length'] = self.conn.xlen(self.dead_stream)
+      for g in self.conn.xinfo_groups(self.stream):
+        if g.get('name') == self.group:
+          stats['pending'] = g.get('pending')
+          stats['consumers'] = g.get('consumers')
+    except redis.exceptions.RedisError as e:
+      stats['error'] = str(e)
+    with self._lock:
+      stats.update({
+        'published': self.published,
+        'handled': self.handled,
+        'failed': self.failed,
+        'reclaimed': self.reclaimed,
+        'dead': self.dead
+      })
+    return stats
+
+
+if __name__ == '__main__':
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    redis_url = os.environ.get('bot_redis_url', 'redis://localhost:6399')
+    conn = redis.StrictRedis.from_url(redis_url, decode_responses=True)
+
+    stream = RedisEventStream(conn, stream='test:events', group='test', block_ms=100, claim_idle_ms=500)
+    stream.ensure_group()
+
+    for n in range(100):
+      stream.publish({'id': str(n), 'created': time.time()})
+
+    # this consumer crashes after reading, events stay pending
+    print('read by crashed consumer: {}'.format(len(stream.read('crashed', count=10))))
+
+    handled = []
+    stream.start(lambda event: handled.append(event.get('id')), consumers=4)
+    time.sleep(2.0)
+    stream.stop()
+
+    print('handled: {}'.format(len(handled)))
+    print(stream.get_stats())
+    conn.delete(stream.stream, stream.dead_stream)
+    return 0
+
+  sys.exit(main())
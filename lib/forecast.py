@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Weather forecast client and its cache
+
+- forecasts are cached by city code for ttl seconds
+- after ttl, the stale forecast is returned for stale_ttl seconds more,
+  while it is refreshed in background
+- concurrent misses of the same city wait for one upstream call
+- optional second tier in redis, shared by all gunicorn workers
+- the stale forecast is returned when the upstream fails
+
+Environment variables:
+  - weather_api_url: url of the forecast api, city code is given as ?city= (default: livedoor weather hacks)
+  - weather_ttl: seconds to keep the forecast fresh (default: 1800)
+  - weather_stale_ttl: seconds to return the stale forecast while refreshing it (default: 21600)
+  - weather_cache_redis: 1 to share the cache in redis (default: 0)
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+def here(path=''):
+  return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+
+if not here('.') in sys.path:
+  sys.path.append(here('.'))
+
+from teams.v1.session import PooledSession
+
+logger = logging.getLogger(__name__)
+
+
+WEATHER_API_URL = 'http://weather.livedoor.com/forecast/webservice/json/v1'
+
+
+def normalize_forecast(json_data):
+  """convert the response of the api to the values of the weather card
+
+  data structures are described in http://weather.livedoor.com/weather_hacks/webservice
+  """
+  def normalize(fcst):
+    r = {}
+    r['dateLabel'] = fcst.get('dateLabel', '-')
+    r['date'] = fcst.get('date', '1970-01-01')
+    r['telop'] = fcst.get('telop', '-')
+    temp = fcst.get('temperature', {})
+    r['temp_min'] = '-' if temp is None or temp.get('min') is None else temp.get('min', {}).get('celsius', '-')
+    r['temp_max'] = '-' if temp is None or temp.get('max') is None else temp.get('max', {}).get('celsius', '-')
+    image = fcst.get('image', {})
+    r['img_url'] = '' if image is None else image.get('url', '')
+    r['img_title'] = '-' if image is None else image.get('title', '-')
+    return r
+
+  forecasts = json_data.get('forecasts') or []
+  forecasts = forecasts + [{}] * (2 - len(forecasts))
+
+  return {
+    'city': json_data.get('location', {}).get('city', '-'),      # "横浜"
+    'title': json_data.get('title', '-'),                         # "神奈川県 横浜 の天気"
+    'description': json_data.get('description', {}).get('text', '-'),
+    'today': normalize(forecasts[0]),
+    'tomorrow': normalize(forecasts[1])
+  }
+
+
+class WeatherClient:
+
+  TIMEOUT = (3.05, 10.0)  # (connect timeout, read timeout)
+
+  def __init__(self, api_url=None, session=None):
+    """constructor for WeatherClient
+
+    Keyword Arguments:
+        api_url {str} -- url of the forecast api, environment variable weather_api_url overrides the default (default: {None})
+        session {PooledSession} -- keep-alive session (default: {None})
+    """
+    self.api_url = api_url or os.getenv('weather_api_url') or WEATHER_API_URL
+    self.session = PooledSession() if session is None else session
+
+
+  def fetch(self, city_code):
+    """get the forecast of the city from the api
+
+    Returns:
+        dict -- normalized forecast, None if failed
+    """
+    # pylint: disable=broad-except
+    try:
+      get_result = self.session.get(self.api_url, params={'city': city_code}, timeout=self.TIMEOUT)
+    except Exception as e:
+      logger.error("failed to get forecast of %s: %s", city_code, e)
+      return None
+    if not get_result.ok:
+      logger.error("failed to get forecast of %s: status %d", city_code, get_result.status_code)
+      return None
+    try:
+      return normalize_forecast(get_result.json())
+    except (ValueError, AttributeError) as e:
+      logger.error("invalid forecast of %s: %s", city_code, e)
+    return None
+
+
+class _Flight:
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.value = None
+
+
+class ForecastCache:
+
+  def __init__(self, fetch, ttl=1800, stale_ttl=21600, conn=None, prefix='weather:forecast'):
+    """constructor for ForecastCache
+
+    Arguments:
+        fetch {func} -- called with city code, returns the forecast or None
+
+    Keyword Arguments:
+        ttl {int} -- seconds to keep the forecast fresh (default: {1800})
+        stale_ttl {int} -- seconds to return the stale forecast after ttl (default: {21600})
+        conn {redis.StrictRedis} -- redis client of the second tier, created with decode_responses=True (default: {None})
+        prefix {str} -- prefix of redis keys (default: {'weather:forecast'})
+    """
+    self.fetch = fetch
+    self.ttl = ttl
+    self.stale_ttl = stale_ttl
+    self.conn = conn
+    self.prefix = prefix
+
+    self._data = {}     # city code -> (fetched_at, forecast), fetched_at is unix time shared with redis
+    self._flights = {}
+    self._lock = threading.Lock()
+
+    # metrics
+    self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'redis_hits': 0, 'fetches': 0, 'failures': 0, 'coalesced': 0, 'refreshes': 0}
+
+
+  def _count(self, name):
+    with self._lock:
+      self.stats[name] += 1
+
+
+  def _key(self, city_code):
+    return '{}:{}'.format(self.prefix, city_code)
+
+
+  def _load_shared(self, city_code):
+    # pylint: disable=broad-except
+    if self.conn is None:
+      return None
+    try:
+      value = self.conn.get(self._key(city_code))
+      if value is not None:
+        entry = json.loads(value)
+        return entry['fetched_at'], entry['forecast']
+    except Exception as e:
+      logger.error("failed to get forecast from redis: %s", e)
+    return None
+
+
+  def _store(self, city_code, forecast):
+    # pylint: disable=broad-except
+    fetched_at = time.time()
+    with self._lock:
+      self._data[city_code] = (fetched_at, forecast)
+    if self.conn is not None:
+      try:
+        value = json.dumps({'fetched_at': fetched_at, 'forecast': forecast}, ensure_ascii=False)
+        self.conn.set(self._key(city_code), value, ex=int(self.ttl + self.stale_ttl))
+      except Exception as e:
+        logger.error("failed to set forecast to redis: %s", e)
+
+
+  def _load(self, city_code):
+    """fetch the forecast, concurrent calls of the same city wait for the first one"""
+    with self._lock:
+      flight = self._flights.get(city_code)
+      leader = flight is None
+      if leader:
+        flight = _Flight()
+        self._flights[city_code] = flight
+      else:
+        self.stats['coalesced'] += 1
+
+    if not leader:
+      flight.event.wait()
+      return flight.value
+
+    try:
+      # another worker may have fetched it
+      shared = self._load_shared(city_code)
+      if shared is not None and time.time() - shared[0] < self.ttl:
+        with self._lock:
+          self._data[city_code] = shared
+        self._count('redis_hits')
+        flight.value = shared[1]
+        return flight.value
+
+      self._count('fetches')
+      forecast = self.fetch(city_code)
+      if forecast is None:
+        self._count('failures')
+      else:
+        self._store(city_code, forecast)
+      flight.value = forecast
+      return forecast
+    finally:
+      with self._lock:
+        self._flights.pop(city_code, None)
+      flight.event.set()
+
+
+  def _refresh(self, city_code):
+    # pylint: disable=broad-except
+    with self._lock:
+      if city_code in self._flights:
+        return
+    self._count('refreshes')
+    try:
+      threading.Thread(target=self._load, args=(city_code,), name='forecast-refresh', daemon=True).start()
+    except Exception as e:
+      logger.error("failed to start refresh of %s: %s", city_code, e)
+
+
+  def get(self, city_code):
+    """get the forecast of the city
+
+    Returns:
+        dict -- forecast, None if it is not cached and the upstream failed
+    """
+    now = time.time()
+    with self._lock:
+      entry = self._data.get(city_code)
+
+    if entry is None:
+      entry = self._load_shared(city_code)
+      if entry is not None:
+        with self._lock:
+          self._data[city_code] = entry
+
+    if entry is not None:
+      fetched_at, forecast = entry
+      age = now - fetched_at
+      if age < self.ttl:
+        self._count('hits')
+        return forecast
+      if age < self.ttl + self.stale_ttl:
+        self._count('stale_hits')
+        self._refresh(city_code)
+        return forecast
+
+    self._count('misses')
+    forecast = self._load(city_code)
+    if forecast is None and entry is not None:
+      # upstream failed, the old forecast is better than nothing
+      return entry[1]
+    return forecast
+
+
+  def get_stats(self):
+    with self._lock:
+      return dict(self.stats, cities=len(self._data))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_forecast_cache():
+  """forecast cache shared by the process, configured by the environment variables"""
+  # pylint: disable=global-statement
+  global _cache
+  if _cache is None:
+    with _cache_lock:
+      if _cache is None:
+        conn = None
+        if os.environ.get('weather_cache_redis', '0') == '1':
+          from botscript import get_redis  # pylint: disable=import-outside-toplevel
+          conn = get_redis()
+        _cache = ForecastCache(
+          WeatherClient().fetch,
+          ttl=int(os.environ.get('weather_ttl', 1800)),
+          stale_ttl=int(os.environ.get('weather_stale_ttl', 21600)),
+          conn=conn)
+  return _cache
+
+
+if __name__ == '__main__':
+
+  from concurrent.futures import ThreadPoolExecutor
+  from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+  from urllib.parse import parse_qs, urlsplit
+
+  logging.basicConfig(level=logging.INFO)
+
+  class FakeWeatherHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    calls = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      city = parse_qs(urlsplit(self.path).query).get('city', ['-'])[0]
+      self.calls.append(city)
+      time.sleep(0.2)  # latency of the upstream
+      body = json.dumps({
+        'title': 'forecast of {}'.format(city),
+        'location': {'city': city},
+        'description': {'text': 'fine'},
+        'forecasts': [
+          {'dateLabel': '今日', 'date': '2020-01-01', 'telop': '晴れ', 'temperature': {'max': {'celsius': '11'}, 'min': None}},
+          {'dateLabel': '明日', 'date': '2020-01-02', 'telop': '曇り', 'temperature': {'max': None, 'min': None}}
+        ]
+      }).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      pass
+
+  def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeWeatherHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = WeatherClient(api_url='http://127.0.0.1:{}/forecast'.format(server.server_address[1]))
+    cache = ForecastCache(client.fetch, ttl=1, stale_ttl=60)
+
+    # 100 concurrent requests of 4 cities
+    cities = ['130010', '270000', '016010', '140010']
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=100) as executor:
+      list(executor.map(lambda i: cache.get(cities[i % 4]), range(100)))
+    print('100 requests in {:.2f} sec, upstream calls {}'.format(time.perf_counter() - start, len(FakeWeatherHandler.calls)))
+
+    # after ttl, the stale forecast is returned at once and refreshed in background
+    time.sleep(1.1)
+    start = time.perf_counter()
+    cache.get('130010')
+    print('stale hit in {:.2f} ms'.format((time.perf_counter() - start) * 1000))
+    time.sleep(0.5)
+    print(cache.get_stats(), 'upstream calls {}'.format(len(FakeWeatherHandler.calls)))
+    server.shutdown()
+    return 0
+
+  sys.exit(main())
@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # pylint: disable=missing-docstring
+"""Plugins of the bot
 
+Every *.py in this directory which has plugin_props() is a plugin.
+
+Commands and descriptions are read from plugin_props() without importing the module,
+by parsing the source, and saved in the manifest ./data/plugins-manifest.json.
+The manifest entry is reused while the mtime and size of the file (or its sha256) are unchanged.
+The module is imported when one of its commands is called for the first time,
+so the startup time of the worker does not depend on the number of plugins.
+
+plugin_props() which is not a literal list of dicts is read by importing the module.
+"""
+
+import ast
+import hashlib
 import importlib.util
+import json
 import logging
 import os
 import sys
+import tempfile
+import threading
 from pathlib import Path
 
 
@@ -28,55 +45,379 @@ def load_module(module_name, module_path):
   return None
 
 
-def load_plugins(base_path):
-  result_list = []
-  p = Path(base_path)
-  if not p.exists() or not p.is_dir():
-    return result_list
+def read_props_from_source(source):
+  """read plugin_props() from the source without executing it
+
+  Names of module level constants, e.g. 'timeout': TIMEOUT with TIMEOUT = 20, are resolved to their values,
+  other names are kept as names, e.g. 'func': plugin_main.
+
+  Returns:
+      list -- dicts of name, description, command and func (name of the function),
+      [] if there is no plugin_props(), None if plugin_props() is not a literal
+  """
+  try:
+    tree = ast.parse(source)
+  except SyntaxError:
+    return None
+
+  constants = {}
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+      for target in node.targets:
+        if isinstance(target, ast.Name):
+          constants[target.id] = node.value.value
+
+  for node in tree.body:
+    if isinstance(node, ast.FunctionDef) and node.name == 'plugin_props':
+      returns = [n for n in node.body if isinstance(n, ast.Return)]
+      if len(returns) != 1 or not isinstance(returns[0].value, ast.List):
+        return None
+      props = []
+      for elt in returns[0].value.elts:
+        if not isinstance(elt, ast.Dict):
+          return None
+        prop = {}
+        for k, v in zip(elt.keys, elt.values):
+          if not isinstance(k, ast.Constant):
+            return None
+          if isinstance(v, ast.Constant):
+            prop[k.value] = v.value
+          elif isinstance(v, ast.Name):
+            prop[k.value] = constants.get(v.id, v.id)
+          else:
+            return None
+        props.append(prop)
+      return props
+  return []
+
+
+def read_props_from_module(module):
+  """read plugin_props() of the imported module, functions are replaced with their names"""
+  props = []
+  for prop in module.plugin_props():
+    prop = dict(prop)
+    func = prop.get('func')
+    prop['func'] = getattr(func, '__name__', None)
+    props.append(prop)
+  return props
+
+
+def validate_props(props, module):
+  """check plugin_props() of the module
+
+  Raises:
+      ValueError -- props is not a list of dicts with command, description and function of the module
+  """
+  if not isinstance(props, list) or not props:
+    raise ValueError("plugin_props() must return a list of dicts")
+  for prop in props:
+    if not isinstance(prop, dict):
+      raise ValueError("plugin_props() must return a list of dicts")
+    command = prop.get('command')
+    if not isinstance(command, str) or not command.startswith('/') or command == '/':
+      raise ValueError("invalid command: {!r}".format(command))
+    if not isinstance(prop.get('description'), str):
+      raise ValueError("invalid description of {}".format(command))
+    if not callable(getattr(module, prop.get('func') or '', None)):
+      raise ValueError("function of {} is not found: {!r}".format(command, prop.get('func')))
+
+
+class LazyCommand:
+  """function of the plugin, the module is imported on the first call"""
+
+  def __init__(self, registry, module_name, func_name):
+    self.registry = registry
+    self.module_name = module_name
+    self.func_name = func_name
+    self.__name__ = func_name
+
+
+  def __call__(self, *args, **kwargs):
+    func = self.registry.get_function(self.module_name, self.func_name)
+    if func is None:
+      logger.error("plugin function is not found: %s.%s", self.module_name, self.func_name)
+      return None
+    return func(*args, **kwargs)
+
+
+  def __repr__(self):
+    return '<LazyCommand {}.{}>'.format(self.module_name, self.func_name)
+
+
+  def __reduce__(self):
+    # sent to the child process of the sandbox, which imports the module by itself,
+    # sha256 tells the child to import it again after the plugin is reloaded
+    entry = self.registry.entries.get(self.module_name, {})
+    return _load_function, (self.module_name, entry.get('path'), self.func_name, entry.get('sha256'))
+
+
+# module path -> (sha256, module) in the child process of the sandbox
+_loaded_modules = {}
+
+
+def _load_function(module_name, module_path, func_name, sha256=None):
+  loaded = _loaded_modules.get(module_path)
+  if loaded is None or loaded[0] != sha256:
+    module = load_module(module_name, module_path)
+    if module is None:
+      raise ImportError("failed to import plugin: {}".format(module_path))
+    loaded = (sha256, module)
+    _loaded_modules[module_path] = loaded
+  return getattr(loaded[1], func_name)
+
+
+class PluginRegistry:
+
+  MANIFEST_VERSION = 1
+
+  def __init__(self, plugin_dir, manifest_path=None):
+    """constructor for PluginRegistry
+
+    Arguments:
+        plugin_dir {str} -- directory of the plugins
+
+    Keyword Arguments:
+        manifest_path {str} -- path of the manifest cache, not saved if None (default: {None})
+    """
+    self.plugin_dir = plugin_dir
+    self.manifest_path = manifest_path
+    self.entries = {}    # module name -> manifest entry
+    self.modules = {}    # module name -> imported module
+    self._lock = threading.Lock()
+    self.stats = {'parsed': 0, 'cached': 0, 'imported': 0}
+
+
+  def _read_manifest(self):
+    if not self.manifest_path or not os.path.isfile(self.manifest_path):
+      return {}
+    try:
+      with open(self.manifest_path) as f:
+        manifest = json.load(f)
+      if manifest.get('version') != self.MANIFEST_VERSION or manifest.get('plugin_dir') != self.plugin_dir:
+        return {}
+      return manifest.get('entries', {})
+    except (IOError, ValueError) as e:
+      logger.error("failed to read plugin manifest: %s", e)
+    return {}
+
+
+  def _write_manifest(self):
+    if not self.manifest_path:
+      return
+    manifest = {'version': self.MANIFEST_VERSION, 'plugin_dir': self.plugin_dir, 'entries': self.entries}
+    try:
+      # other workers may read the manifest at the same time, replace it atomically
+      directory = os.path.dirname(self.manifest_path)
+      os.makedirs(directory, exist_ok=True)
+      fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.plugins-', suffix='.json')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+      os.replace(tmp_path, self.manifest_path)
+    except (IOError, OSError) as e:
+      logger.error("failed to write plugin manifest: %s", e)
+
+
+  def scan_entry(self, path, cached=None):
+    """make the manifest entry of the plugin file
+
+    Arguments:
+        path {Path} -- path of the plugin
+
+    Keyword Arguments:
+        cached {dict} -- entry in the manifest cache (default: {None})
+
+    Returns:
+        dict -- manifest entry, None if the file is not a plugin
+    """
+    stat = path.stat()
+    if cached is not None and cached.get('mtime_ns') == stat.st_mtime_ns and cached.get('size') == stat.st_size:
+      self.stats['cached'] += 1
+      return cached
+
+    source = path.read_bytes()
+    sha256 = hashlib.sha256(source).hexdigest()
+    if cached is not None and cached.get('sha256') == sha256:
+      # touched but not changed
+      self.stats['cached'] += 1
+      return dict(cached, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+    self.stats['parsed'] += 1
+    module_name = path.stem
+    props = read_props_from_source(source)
+    if props is None:
+      module = load_module(module_name, path)
+      if module is None or not hasattr(module, 'plugin_props'):
+        return None
+      props = read_props_from_module(module)
+      self.modules[module_name] = module
+    if not props:
+      return None
+
+    return {
+      'module': module_name,
+      'path': str(path),
+      'mtime_ns': stat.st_mtime_ns,
+      'size': stat.st_size,
+      'sha256': sha256,
+      'props': props
+    }
+
+
+  def load(self):
+    """read the plugin directory and update the manifest"""
+    cached = self._read_manifest()
+    entries = {}
+    p = Path(self.plugin_dir)
+    if p.exists() and p.is_dir():
+      for path in sorted(p.glob('*.py')):
+        module_name = path.stem
+        if module_name == '__init__':
+          continue
+        entry = self.scan_entry(path, cached.get(module_name))
+        if entry is not None:
+          entries[module_name] = entry
+
+    with self._lock:
+      self.entries = entries
+    if entries != cached:
+      self._write_manifest()
+    return self
+
+
+  def reload_module(self, module_name):
+    """import the changed plugin again, other plugins are untouched
+
+    The new module is validated before it replaces the old one,
+    the old one is kept if the new one is broken.
+
+    Returns:
+        bool -- True if the plugin is added, replaced or removed
+    """
+    path = Path(self.plugin_dir, module_name + '.py')
+    if not path.is_file():
+      with self._lock:
+        if module_name not in self.entries:
+          return False
+        self.entries = {k: v for k, v in self.entries.items() if k != module_name}
+        self.modules = {k: v for k, v in self.modules.items() if k != module_name}
+      self._write_manifest()
+      logger.info("plugin removed: %s", module_name)
+      return True
+
+    stat = path.stat()
+    source = path.read_bytes()
+    sha256 = hashlib.sha256(source).hexdigest()
+    old = self.entries.get(module_name)
+    if old is not None and old.get('sha256') == sha256:
+      return False
 
-  for path in p.glob('*.py'):
-    module_name = Path(path).stem
-    if module_name == '__init__':
-      continue
     module = load_module(module_name, path)
+    if module is None or not hasattr(module, 'plugin_props'):
+      logger.error("plugin is not reloaded: %s", module_name)
+      return False
+    try:
+      props = read_props_from_module(module)
+      validate_props(props, module)
+    except Exception as e:  # pylint: disable=broad-except
+      logger.error("plugin is not reloaded: %s: %s", module_name, e)
+      return False
+
+    entry = {
+      'module': module_name,
+      'path': str(path),
+      'mtime_ns': stat.st_mtime_ns,
+      'size': stat.st_size,
+      'sha256': sha256,
+      'props': props
+    }
+    # replace the dicts instead of updating them, readers never see a half updated registry
+    with self._lock:
+      self.entries = dict(self.entries, **{module_name: entry})
+      self.modules = dict(self.modules, **{module_name: module})
+      self.stats['imported'] += 1
+    self._write_manifest()
+    logger.info("plugin reloaded: %s", module_name)
+    return True
+
+
+  def get_function(self, module_name, func_name):
+    """import the module if not imported, and get the function"""
+    module = self.modules.get(module_name)
     if module is None:
-      continue
-    dir_list = dir(module)
-    if 'plugin_props' in dir_list:  # only accept module which has plugin_props()
-      result_list.append(module)
-
-  return result_list
-
-
-def create_plugin_map(module_list):
-  result_map = {
-    '/': send_help
-  }
-  for module in module_list:
-    props = module.plugin_props()
-    for prop in props:
-      command = prop.get('command')
-      func = prop.get('func')
-      result_map[command] = func
-  return result_map
-
-
-def create_help_list(module_list):
-  result_list = []
-  for module in module_list:
-    props = module.plugin_props()
-    for prop in props:
-      command = prop.get('command')
-      descr = prop.get('description')
-      result_list.append('\n  '.join([command, descr]) + '\n')
-  return result_list
+      with self._lock:
+        module = self.modules.get(module_name)
+        if module is None:
+          entry = self.entries.get(module_name)
+          if entry is None:
+            return None
+          module = load_module(module_name, entry['path'])
+          if module is None:
+            return None
+          self.modules = dict(self.modules, **{module_name: module})
+          self.stats['imported'] += 1
+    return getattr(module, func_name, None)
+
+
+  def get_options(self, module_name):
+    """Returns:
+        dict -- executor, timeout and concurrency of the plugin in plugin_props(), see sandbox.py
+    """
+    options = {}
+    for prop in self.entries.get(module_name, {}).get('props', []):
+      for key in ('executor', 'timeout', 'concurrency'):
+        if key in prop and key not in options:
+          options[key] = prop[key]
+    return options
+
+
+  def create_plugin_map(self):
+    """Returns:
+        dict -- command -> function, '/' is the help
+    """
+    result_map = {
+      '/': send_help
+    }
+    for module_name, entry in self.entries.items():
+      for prop in entry['props']:
+        command = prop.get('command')
+        func_name = prop.get('func')
+        if command and func_name:
+          result_map[command] = LazyCommand(self, module_name, func_name)
+    return result_map
+
+
+  def create_help_list(self):
+    result_list = []
+    for entry in self.entries.values():
+      for prop in entry['props']:
+        command = prop.get('command')
+        descr = prop.get('description')
+        result_list.append('\n  '.join([command, descr]) + '\n')
+    return result_list
+
+
+  def get_stats(self):
+    return {
+      'plugins': len(self.entries),
+      'imported': sorted(self.modules.keys()),
+      'manifest': dict(self.stats)
+    }
 
 
 def send_help(bot=None, room_id=None, args=None):
   # pylint: disable=unused-argument
   if not all([bot, room_id]):
     return
-  bot.send_message(room_id=room_id, text='\n'.join(_plugin_help_list))
+  bot.send_message(room_id=room_id, text='\n'.join(_plugins.help_list))
+
+
+class _Plugins:
+  """registry, help and plugin map of the same moment, replaced as a whole"""
+
+  def __init__(self, registry):
+    self.registry = registry
+    self.help_list = registry.create_help_list()
+    self.plugin_map = registry.create_plugin_map()
 
 #
 #
@@ -84,32 +425,75 @@ def send_help(bot=None, room_id=None, args=None):
 
 plugin_dir = here('.')
 
-_plugin_list = load_plugins(plugin_dir)
-_plugin_help_list = create_help_list(_plugin_list)
-_plugin_map = create_plugin_map(_plugin_list)
+manifest_path = os.path.join(here('../..'), 'data', 'plugins-manifest.json')
+
+_plugins = _Plugins(PluginRegistry(plugin_dir, manifest_path=manifest_path).load())
+
+
+def get_registry():
+  return _plugins.registry
 
 
 def get_plugin_map(reload=False):
   """get plugin map, key=commnad, value=function"""
   # pylint: disable=global-statement
-  global _plugin_map
+  global _plugins
   if reload is False:
-    return _plugin_map
+    return _plugins.plugin_map
+
+  _plugins = _Plugins(PluginRegistry(plugin_dir, manifest_path=manifest_path).load())
+  return _plugins.plugin_map
+
+
+def reload_plugins(module_names):
+  """reload the changed plugins only
+
+  Arguments:
+      module_names {list} -- names of the changed modules, e.g. ['weather']
 
-  global _plugin_list
-  global _plugin_help_list
-  _plugin_list = load_plugins(plugin_dir)
-  _plugin_help_list = create_help_list(_plugin_list)
-  _plugin_map = create_plugin_map(_plugin_list)
-  return _plugin_map
+  Returns:
+      dict -- new plugin map, None if nothing is changed
+  """
+  # pylint: disable=global-statement
+  global _plugins
+  changed = [name for name in module_names if _plugins.registry.reload_module(name)]
+  if not changed:
+    return None
+  _plugins = _Plugins(_plugins.registry)
+  return _plugins.plugin_map
 
 
 if __name__ == '__main__':
 
+  import shutil
+  import time
+
   logging.basicConfig(level=logging.INFO)
 
   def main():
-    print(_plugin_map)
+    print(get_plugin_map())
+    print(get_registry().get_stats())
+
+    # startup time with 200 plugins, with and without the manifest cache
+    work_dir = tempfile.mkdtemp()
+    try:
+      source = Path(here('weather.py')).read_text()
+      for i in range(200):
+        Path(work_dir, 'plugin{}.py'.format(i)).write_text(source.replace("'/tenki'", "'/tenki{}'".format(i)).replace("'/weather'", "'/weather{}'".format(i)))
+      path = os.path.join(work_dir, 'manifest.json')
+
+      start = time.perf_counter()
+      for module_path in Path(work_dir).glob('plugin*.py'):
+        load_module(module_path.stem, module_path).plugin_props()
+      print('import all   {:.3f} sec'.format(time.perf_counter() - start))
+
+      for label in ['parse', 'cached']:
+        start = time.perf_counter()
+        registry = PluginRegistry(work_dir, manifest_path=path).load()
+        registry.create_plugin_map()
+        print('{:12s} {:.3f} sec {}'.format(label, time.perf_counter() - start, registry.stats))
+    finally:
+      shutil.rmtree(work_dir)
     return 0
 
   sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import logging
+import os
+import sys
+from datetime import datetime
+
+def here(path=''):
+  return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+
+if not here('..') in sys.path:
+  sys.path.append(here('..'))
+
+from broadcast import get_broadcast_scheduler
+from cityindex import get_city_index
+
+logger = logging.getLogger(__name__)
+
+# job created by server.py, see bot_broadcast_cron
+JOB_ID = 'morning'
+
+
+def plugin_props():
+  return [
+    {
+      'name': "subscribe",
+      'description': "send weather forecast every morning",
+      'command': '/subscribe',
+      'func': subscribe_main
+    },
+    {
+      'name': "unsubscribe",
+      'description': "stop sending weather forecast",
+      'command': '/unsubscribe',
+      'func': unsubscribe_main
+    }
+  ]
+
+
+def subscribe_main(bot=None, room_id=None, args=None):
+  if not all([bot, room_id]):
+    return
+
+  scheduler = get_broadcast_scheduler()
+  if not scheduler.is_enabled(JOB_ID):
+    bot.send_message(room_id=room_id, text="定期配信は停止しています。")
+    return
+
+  city_name = '横浜'
+  city_code = '140010'
+  if args:
+    cities = get_city_index().search(args[0])
+    if len(cities) != 1:
+      bot.send_message(room_id=room_id, text="{}はお調べできません。/tenki list で地点を確認してください。".format(args[0]))
+      return
+    city_name = cities[0].name
+    city_code = cities[0].code
+
+  scheduler.subscribe(JOB_ID, room_id, city_code)
+  next_time = [j['next'] for j in scheduler.get_jobs() if j['id'] == JOB_ID]
+  msg = "{}の天気を毎朝お届けします。".format(city_name)
+  if next_time and next_time[0]:
+    msg += "次回は{}です。".format(datetime.fromtimestamp(next_time[0]).strftime('%m/%d %H:%M'))
+  bot.send_message(room_id=room_id, text=msg)
+
+
+def unsubscribe_main(bot=None, room_id=None, args=None):
+  if not all([bot, room_id]):
+    return
+
+  if get_broadcast_scheduler().unsubscribe(JOB_ID, room_id):
+    bot.send_message(room_id=room_id, text="天気の配信を停止しました。")
+  else:
+    bot.send_message(room_id=room_id, text="このスペースには配信していません。")
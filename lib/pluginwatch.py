@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Watcher of the plugin directory
+
+- inotify on linux, polling of mtime and size on the other platforms
+- calls on_change() with the names of the changed modules, e.g. ['weather']
+- publishes the change to redis, the watchers in the other gunicorn workers
+  (and hosts sharing the directory) receive it and call on_change() too
+
+The watcher waits with select() and sleep(), in gunicorn gevent workers
+these are monkey patched and do not block the other greenlets.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class _Inotify:
+  """minimal inotify of linux, via libc"""
+
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_NONBLOCK = 0o4000
+  IN_CLOEXEC = 0o2000000
+
+  EVENT = struct.Struct('iIII')
+
+  def __init__(self, path):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1')
+    mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+    if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+      errno = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(errno, 'inotify_add_watch')
+
+
+  def read(self, timeout):
+    """Returns:
+        list -- names of the files changed, [] on timeout
+    """
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if not readable:
+      return []
+    try:
+      data = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+    names = []
+    offset = 0
+    while offset < len(data):
+      _, _, _, length = self.EVENT.unpack_from(data, offset)
+      offset += self.EVENT.size
+      names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+      offset += length
+    return names
+
+
+  def close(self):
+    os.close(self.fd)
+
+
+class PluginWatcher:
+
+  def __init__(self, plugin_dir, on_change, conn=None, channel='bot:plugins', interval=2.0, use_inotify=True):
+    """constructor for PluginWatcher
+
+    Arguments:
+        plugin_dir {str} -- directory of the plugins
+        on_change {func} -- called with the list of the changed module names
+
+    Keyword Arguments:
+        conn {redis.StrictRedis} -- redis client to notify the other workers (default: {None})
+        channel {str} -- redis pub/sub channel (default: {'bot:plugins'})
+        interval {float} -- seconds between polling, and debounce of inotify (default: {2.0})
+        use_inotify {bool} -- use inotify if available (default: {True})
+    """
+    self.plugin_dir = plugin_dir
+    self.on_change = on_change
+    self.conn = conn
+    self.channel = channel
+    self.interval = interval
+    self.use_inotify = use_inotify
+
+    self._lock = threading.Lock()
+    self._pid = None
+    self._stopped = threading.Event()
+    self._files = {}
+    self.backend = None
+    self.node = None  # hostname-pid, the publisher of the notification
+
+    # metrics
+    self.local_changes = 0
+    self.remote_changes = 0
+    self.last_change = None
+
+
+  def snapshot(self):
+    """Returns:
+        dict -- module name -> (mtime_ns, size) of the plugin files
+    """
+    files = {}
+    for path in Path(self.plugin_dir).glob('*.py'):
+      if path.stem == '__init__':
+        continue
+      try:
+        stat = path.stat()
+      except FileNotFoundError:
+        continue
+      files[path.stem] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+  def poll(self):
+    """compare the plugin files with the last snapshot
+
+    Returns:
+        list -- names of the modules added, changed or removed
+    """
+    files = self.snapshot()
+    changed = sorted(name for name in set(files) | set(self._files) if files.get(name) != self._files.get(name))
+    self._files = files
+    return changed
+
+
+  def _changed(self, module_names, remote=False):
+    # pylint: disable=broad-except
+    with self._lock:
+      if remote:
+        self.remote_changes += 1
+      else:
+        self.local_changes += 1
+      self.last_change = time.time()
+    logger.info("plugins changed: %s", ', '.join(module_names))
+    try:
+      self.on_change(module_names)
+    except Exception as e:
+      logger.exception(e)
+    if not remote:
+      self.notify(module_names)
+
+
+  def notify(self, module_names):
+    """tell the other workers that the plugins are changed"""
+    # pylint: disable=broad-except
+    if self.conn is None:
+      return
+    try:
+      self.conn.publish(self.channel, json.dumps({'node': self.node, 'modules': module_names}))
+    except Exception as e:
+      logger.error("failed to publish plugin change: %s", e)
+
+
+  def _run_inotify(self, inotify, stopped):
+    while not stopped.is_set():
+      names = inotify.read(timeout=1.0)
+      if not names or not any(name.endswith('.py') for name in names):
+        continue
+      # editors write a file in several steps, wait for them
+      time.sleep(self.interval)
+      while inotify.read(timeout=0):
+        pass
+      changed = self.poll()
+      if changed:
+        self._changed(changed)
+
+
+  def _run_poll(self, stopped):
+    while not stopped.wait(self.interval):
+      changed = self.poll()
+      if changed:
+        self._changed(changed)
+
+
+  def _run(self, stopped):
+    # pylint: disable=broad-except
+    inotify = None
+    if self.use_inotify and sys.platform.startswith('linux'):
+      try:
+        inotify = _Inotify(self.plugin_dir)
+      except (OSError, AttributeError) as e:
+        logger.info("inotify is not available, polling: %s", e)
+    self.backend = 'inotify' if inotify is not None else 'poll'
+    try:
+      while not stopped.is_set():
+        try:
+          if inotify is not None:
+            self._run_inotify(inotify, stopped)
+          else:
+            self._run_poll(stopped)
+        except Exception as e:
+          logger.exception(e)
+          time.sleep(self.interval)
+    finally:
+      if inotify is not None:
+        inotify.close()
+
+
+  def _run_subscriber(self, stopped):
+    # pylint: disable=broad-except
+    while not stopped.is_set():
+      pubsub = None
+      try:
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        while not stopped.is_set():
+          message = pubsub.get_message(timeout=1.0)
+          if message is None:
+            continue
+          data = json.loads(message.get('data'))
+          if data.get('node') == self.node:
+            continue
+          # the file is read again here, the snapshot follows so that the local watcher does not fire again
+          self._files = self.snapshot()
+          self._changed(data.get('modules', []), remote=True)
+      except Exception as e:
+        logger.error("plugin change subscriber: %s", e)
+        time.sleep(self.interval)
+      finally:
+        if pubsub is not None:
+          try:
+            pubsub.close()
+          except Exception:
+            pass
+
+
+  def start(self):
+    """start watching in this process"""
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self.node = '{}-{}'.format(socket.gethostname(), os.getpid())
+      # threads of the previous start() see their own event and exit
+      self._stopped = threading.Event()
+      stopped = self._stopped
+    self._files = self.snapshot()
+    threading.Thread(target=self._run, args=(stopped,), name='plugin-watcher', daemon=True).start()
+    if self.conn is not None:
+      threading.Thread(target=self._run_subscriber, args=(stopped,), name='plugin-subscriber', daemon=True).start()
+
+
+  def stop(self):
+    self._stopped.set()
+    with self._lock:
+      self._pid = None
+
+
+  def get_stats(self):
+    with self._lock:
+      return {
+        'backend': self.backend,
+        'files': len(self._files),
+        'local_changes': self.local_changes,
+        'remote_changes': self.remote_changes,
+        'last_change': self.last_change
+      }
+
+
+if __name__ == '__main__':
+
+  import tempfile
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    work_dir = tempfile.mkdtemp()
+    changes = []
+
+    for use_inotify in [True, False]:
+      watcher = PluginWatcher(work_dir, changes.append, interval=0.2, use_inotify=use_inotify)
+      watcher.start()
+      time.sleep(0.5)
+
+      start = time.perf_counter()
+      Path(work_dir, 'hello.py').write_text('def plugin_props():\n  return []\n')
+      while not changes:
+        time.sleep(0.01)
+      print('{}: {} detected in {:.2f} sec'.format(watcher.backend, changes.pop(), time.perf_counter() - start))
+
+      os.remove(os.path.join(work_dir, 'hello.py'))
+      while not changes:
+        time.sleep(0.01)
+      changes.clear()
+      watcher.stop()
+    os.rmdir(work_dir)
+    return 0
+
+  sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Process wide redis connection pool
+
+- BlockingConnectionPool, callers wait for a free connection instead of opening new ones
+- health check of idle connections, and reconnect on the next command after an error
+- connection counts and command latency
+
+redis-py uses socket and threading, both are patched by gevent in gunicorn gevent workers,
+so one pool is shared by all greenlets of the worker.
+"""
+
+import logging
+import sys
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class RedisStats:
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.commands = {}
+
+
+  def add(self, name, elapsed, error=False):
+    with self._lock:
+      c = self.commands.setdefault(name, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+      c['count'] += 1
+      c['total'] += elapsed
+      if elapsed > c['max']:
+        c['max'] = elapsed
+      if error:
+        c['errors'] += 1
+
+
+  def as_dict(self):
+    with self._lock:
+      return {
+        name: {
+          'count': c['count'],
+          'errors': c['errors'],
+          'avg_ms': round(c['total'] / c['count'] * 1000, 3) if c['count'] else 0.0,
+          'max_ms': round(c['max'] * 1000, 3)
+        } for name, c in self.commands.items()
+      }
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+
+  stats = None
+
+  def execute(self, raise_on_error=True):
+    name = 'MULTI' if self.transaction else 'PIPELINE'
+    start = time.perf_counter()
+    error = False
+    try:
+      return super().execute(raise_on_error=raise_on_error)
+    except redis.exceptions.RedisError:
+      error = True
+      raise
+    finally:
+      if self.stats is not None:
+        self.stats.add(name, time.perf_counter() - start, error=error)
+
+
+class InstrumentedRedis(redis.StrictRedis):
+  """StrictRedis which records latency of each command"""
+
+  stats = None
+
+  def execute_command(self, *args, **options):
+    start = time.perf_counter()
+    error = False
+    try:
+      return super().execute_command(*args, **options)
+    except redis.exceptions.RedisError:
+      error = True
+      raise
+    finally:
+      if self.stats is not None:
+        self.stats.add(str(args[0]).upper(), time.perf_counter() - start, error=error)
+
+
+  def pipeline(self, transaction=True, shard_hint=None):
+    pipe = InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+    pipe.stats = self.stats
+    return pipe
+
+
+class RedisPool:
+
+  def __init__(self, url, max_connections=50, timeout=5.0, health_check_interval=30):
+    """constructor for RedisPool
+
+    Arguments:
+        url {str} -- redis url, e.g. redis://localhost:6399
+
+    Keyword Arguments:
+        max_connections {int} -- max number of connections of this process (default: {50})
+        timeout {float} -- seconds to wait for a free connection (default: {5.0})
+        health_check_interval {int} -- idle seconds before PING on reuse (default: {30})
+    """
+    self.url = url
+    self.max_connections = max_connections
+    self.pool = redis.BlockingConnectionPool.from_url(
+      url,
+      max_connections=max_connections,
+      timeout=timeout,
+      health_check_interval=health_check_interval,
+      socket_keepalive=True,
+      retry_on_timeout=True,
+      decode_responses=True)
+    self.stats = RedisStats()
+    self.client = InstrumentedRedis(connection_pool=self.pool)
+    self.client.stats = self.stats
+
+
+  def get_client(self):
+    """Get the redis client shared by the process
+
+    Returns:
+        redis.StrictRedis -- client on the shared pool
+    """
+    return self.client
+
+
+  def get_stats(self):
+    # pylint: disable=protected-access
+    connections = [c for c in getattr(self.pool, '_connections', []) if c is not None]
+    idle = [c for c in list(getattr(self.pool.pool, 'queue', [])) if c is not None]
+    return {
+      'max_connections': self.max_connections,
+      'connections': len(connections),
+      'in_use': len(connections) - len(idle),
+      'idle': len(idle),
+      'commands': self.stats.as_dict()
+    }
+
+
+  def disconnect(self):
+    self.pool.disconnect()
+
+
+if __name__ == '__main__':
+
+  import json
+  import os
+  from concurrent.futures import ThreadPoolExecutor
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    redis_url = os.environ.get('bot_redis_url', 'redis://localhost:6399')
+    pool = RedisPool(redis_url, max_connections=10)
+    conn = pool.get_client()
+
+    with ThreadPoolExecutor(max_workers=50) as executor:
+      list(executor.map(lambda i: conn.set('test:pool:{}'.format(i % 10), i, ex=10), range(1000)))
+
+    print(json.dumps(pool.get_stats(), indent=2))
+    return 0
+
+  sys.exit(main())
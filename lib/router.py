@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Router of incoming messages
+
+All routes are compiled into one matcher,
+
+- commands and aliases, e.g. '/tenki', in a prefix trie, the longest command ending at a word boundary wins
+- exact messages, e.g. 'あ', in a dict
+- regex and glob routes, e.g. 'hello*', in one combined regex, the first registered route wins,
+  routes with back references or conditional groups are matched by themselves in the same order
+- '*' is the default route
+
+Messages are normalized before matching, the mention of the bot is removed and
+commands and messages are case folded.
+Dispatch cost depends on the length of the message, not on the number of routes.
+"""
+
+import fnmatch
+import logging
+import re
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Match:
+
+  # kind of the route
+  COMMAND = 'command'
+  MESSAGE = 'message'
+  REGEX = 'regex'
+  DEFAULT = 'default'
+
+  __slots__ = ('kind', 'route', 'func', 'text', 'args', 'match')
+
+  def __init__(self, kind, route, func, text, args=None, match=None):
+    self.kind = kind
+    self.route = route    # pattern registered
+    self.func = func
+    self.text = text      # normalized message
+    self.args = args      # list of words after the command
+    self.match = match    # re.Match of the regex route
+
+
+  def __repr__(self):
+    return 'Match(kind={!r}, route={!r}, args={!r})'.format(self.kind, self.route, self.args)
+
+
+class _Table:
+  """compiled routes, never modified after compile()"""
+
+  def __init__(self, trie, messages, segments, default, command_default):
+    self.trie = trie
+    self.messages = messages
+    # list of (combined regex or None, regex routes), tried in the order of registration
+    self.segments = segments
+    self.default = default
+    self.command_default = command_default
+
+
+class Router:
+
+  # a node of the trie is a dict, the handler of the command is stored with this key
+  _END = ''
+
+  _NAMED_GROUP = re.compile(r'\(\?P<\w+>')
+
+  # \1, (?P=name) and (?(1)...) which are not escaped, their group numbers change in the combined regex
+  _GROUP_REFERENCE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?P=|\(\?\()')
+
+  def __init__(self, mention_names=None, case_sensitive=False):
+    """constructor for Router
+
+    Keyword Arguments:
+        mention_names {list} -- names of the bot removed from the head of the message (default: {None})
+        case_sensitive {bool} -- match commands and messages case sensitively (default: {False})
+    """
+    self.case_sensitive = case_sensitive
+    self.mention_names = []
+    for name in mention_names or []:
+      self.add_mention_name(name)
+
+    self._commands = {}       # command -> (func, route)
+    self._messages = {}       # message -> func
+    self._regex_routes = []   # (route, regex pattern, func)
+    self._default = None
+    self._command_default = None
+
+    self._lock = threading.Lock()
+    self._table = None
+
+
+  def _fold(self, text):
+    return text if self.case_sensitive else text.casefold()
+
+
+  def add_mention_name(self, name):
+    if name and name not in self.mention_names:
+      self.mention_names.append(name)
+      # longer names first, e.g. 'bot dev' before 'bot'
+      self.mention_names.sort(key=len, reverse=True)
+    self._table = None
+
+
+  def add_command(self, command, func, aliases=None):
+    """add a command, e.g. '/tenki'
+
+    Arguments:
+        command {str} -- command, may contain spaces, e.g. '/tenki list'
+        func {func} -- called with bot, room_id and args
+
+    Keyword Arguments:
+        aliases {list} -- other commands of the same function (default: {None})
+    """
+    with self._lock:
+      for c in [command] + list(aliases or []):
+        c = ' '.join(c.split())
+        if c == '/':
+          self._command_default = func
+          continue
+        self._commands[self._fold(c)] = (func, command)
+      self._table = None
+
+
+  def add_message(self, text, func):
+    """add a message handler, '*' is the default and the other glob patterns are added as glob routes
+
+    Arguments:
+        text {str} -- message text
+        func {func} -- called with room_id
+    """
+    if text == '*':
+      with self._lock:
+        self._default = func
+        self._table = None
+      return
+    if any(c in text for c in '*?['):
+      self.add_glob(text, func)
+      return
+    with self._lock:
+      self._messages[self._fold(' '.join(text.split()))] = func
+      self._table = None
+
+
+  def add_regex(self, pattern, func):
+    """add a regex route, matched from the head of the message
+
+    Arguments:
+        pattern {str} -- regular expression
+        func {func} -- called with room_id and match
+    """
+    flags = 0 if self.case_sensitive else re.IGNORECASE
+    re.compile(pattern, flags)  # raise re.error now, not on dispatch
+    with self._lock:
+      self._regex_routes.append((pattern, pattern, func))
+      self._table = None
+
+
+  def add_glob(self, pattern, func):
+    """add a glob route, e.g. 'hello*', which must match the whole message"""
+    regex = fnmatch.translate(pattern)
+    with self._lock:
+      self._regex_routes.append((pattern, regex, func))
+      self._table = None
+
+
+  def compile(self):
+    """compile the routes into one matcher, called on the first dispatch if not called"""
+    with self._lock:
+      trie = {}
+      for command, (func, route) in self._commands.items():
+        node = trie
+        for c in command:
+          node = node.setdefault(c, {})
+        node[self._END] = (func, route)
+
+      flags = 0 if self.case_sensitive else re.IGNORECASE
+      regex_routes = [(route, re.compile(regex, flags), func) for route, regex, func in self._regex_routes]
+
+      # consecutive routes are combined, routes which refer to their groups split them
+      segments = []
+      combinable = []
+      for (_, regex, _), compiled in zip(self._regex_routes, regex_routes):
+        if self._GROUP_REFERENCE.search(regex):
+          segments.extend(self._combine(combinable, flags))
+          segments.append((None, [compiled]))
+          combinable = []
+        else:
+          combinable.append((regex, compiled))
+      segments.extend(self._combine(combinable, flags))
+
+      table = _Table(trie, dict(self._messages), segments, self._default, self._command_default)
+      self._table = table
+    return table
+
+
+  def _combine(self, routes, flags):
+    """combine the regex routes into one regex
+
+    Each route is wrapped by a named group, lastgroup of the match tells the route.
+    Named groups of the routes may collide, they are made non capturing here and
+    the groups are taken by the second match of the route itself.
+
+    Arguments:
+        routes {list} -- (regex, compiled route)
+
+    Returns:
+        list -- segments of _Table, the routes are tried one by one if they can not be combined
+    """
+    if not routes:
+      return []
+    compiled = [c for _, c in routes]
+    if len(routes) == 1:
+      return [(None, compiled)]
+    alternatives = ['(?P<_r{}>{})'.format(i, self._NAMED_GROUP.sub('(?:', regex)) for i, (regex, _) in enumerate(routes)]
+    try:
+      return [(re.compile('|'.join(alternatives), flags), compiled)]
+    except re.error:
+      logger.warning("regex routes can not be combined, fallback to sequential match")
+      return [(None, [c]) for c in compiled]
+
+
+  def strip_mention(self, text):
+    text = text.strip()
+    folded = self._fold(text)
+    for name in self.mention_names:
+      for mention in ['@' + name, name]:
+        mention = self._fold(mention)
+        if folded.startswith(mention) and (len(folded) == len(mention) or folded[len(mention)].isspace()):
+          # case folding may change the length, e.g. 'ß' -> 'ss', cut the original text at the same position
+          return text[self._original_length(text, len(mention)):].strip()
+    return text
+
+
+  def _original_length(self, text, folded_length):
+    if self.case_sensitive:
+      return folded_length
+    length = 0
+    for i, c in enumerate(text):
+      if length >= folded_length:
+        return i
+      length += len(c.casefold())
+    return len(text)
+
+
+  def _match_command(self, trie, text):
+    # walk the trie with the case folded characters of the text, whose spaces are single,
+    # the longest command which ends at a word boundary wins
+    node = trie
+    found = None
+    for i, c in enumerate(text):
+      for f in (c if self.case_sensitive else c.casefold()):
+        node = node.get(f)
+        if node is None:
+          return found
+      if self._END in node and (i + 1 == len(text) or text[i + 1] == ' '):
+        found = (node[self._END], i + 1)
+    return found
+
+
+  def match(self, text):
+    """match the message with the routes
+
+    Arguments:
+        text {str} -- message text
+
+    Returns:
+        Match -- matched route, or None if no route matches and there is no default
+    """
+    table = self._table or self.compile()
+
+    text = self.strip_mention(text)
+    if not text:
+      return None
+
+    words = ' '.join(text.split())
+    if words.startswith('/'):
+      result = self._match_command(table.trie, words)
+      if result is not None:
+        (func, route), end = result
+        return Match(Match.COMMAND, route, func, text, args=words[end:].split())
+      if table.command_default is not None:
+        return Match(Match.COMMAND, '/', table.command_default, text, args=words.split()[1:])
+
+    func = table.messages.get(self._fold(words))
+    if func is not None:
+      return Match(Match.MESSAGE, text, func, text)
+
+    for combined, regex_routes in table.segments:
+      if combined is not None:
+        m = combined.match(text)
+        if m is not None:
+          route, regex, func = regex_routes[int(m.lastgroup[2:])]
+          return Match(Match.REGEX, route, func, text, match=regex.match(text))
+        continue
+      for route, regex, func in regex_routes:
+        m = regex.match(text)
+        if m is not None:
+          return Match(Match.REGEX, route, func, text, match=m)
+
+    if table.default is not None:
+      return Match(Match.DEFAULT, '*', table.default, text)
+    return None
+
+
+  def get_stats(self):
+    return {
+      'commands': len(self._commands),
+      'messages': len(self._messages),
+      'regex_routes': len(self._regex_routes),
+      'mention_names': list(self.mention_names)
+    }
+
+
+def build_router(bot, plugin_map=None, case_sensitive=False):
+  """build the router from the decorators of the bot and the plugins
+
+  Arguments:
+      bot {Bot} -- bot with on_message, on_command and on_regex functions
+
+  Keyword Arguments:
+      plugin_map {dict} -- command -> function, see plugins.get_plugin_map() (default: {None})
+      case_sensitive {bool} -- match case sensitively (default: {False})
+
+  Returns:
+      Router -- compiled router
+  """
+  router = Router(mention_names=[bot.bot_name], case_sensitive=case_sensitive)
+  for command, func in (plugin_map or {}).items():
+    router.add_command(command, func)
+  for command, func in bot.on_command_functions.items():
+    router.add_command(command, func)
+  for text, func in bot.on_message_functions.items():
+    router.add_message(text, func)
+  for pattern, func in getattr(bot, 'on_regex_functions', []):
+    router.add_regex(pattern, func)
+  router.compile()
+  return router
+
+
+if __name__ == '__main__':
+
+  import time
+
+  logging.basicConfig(level=logging.INFO)
+
+  def noop(**kwargs):
+    return kwargs
+
+  def build(n):
+    router = Router(mention_names=['bot'])
+    for i in range(n):
+      router.add_command('/cmd{}'.format(i), noop, aliases=['/alias{}'.format(i)])
+      router.add_message('message {}'.format(i), noop)
+    for i in range(n // 10):
+      router.add_regex(r'order (?P<item>\w+) x{}'.format(i), noop)
+      router.add_glob('hello{}*'.format(i), noop)
+    router.add_message('*', noop)
+    router.compile()
+    return router
+
+  def bench(router, messages, rounds=20000):
+    start = time.perf_counter()
+    for i in range(rounds):
+      router.match(messages[i % len(messages)])
+    return (time.perf_counter() - start) / rounds * 1e6
+
+  def linear(n, messages, rounds=20000):
+    # every route is tried in order, as a list of regex
+    routes = [re.compile(r'/cmd{}(\s|$)'.format(i), re.IGNORECASE) for i in range(n)]
+    routes += [re.compile(r'message {}$'.format(i), re.IGNORECASE) for i in range(n)]
+    start = time.perf_counter()
+    for i in range(rounds):
+      text = messages[i % len(messages)]
+      for r in routes:
+        if r.match(text):
+          break
+    return (time.perf_counter() - start) / rounds * 1e6
+
+  def main():
+    print(build(10).match('@bot /CMD3 Yokohama Tokyo'))
+    print(build(10).match('Order pizza x0'))
+
+    for n in [10, 100, 1000]:
+      messages = ['@bot /cmd{} a b'.format(n - 1), 'Message {}'.format(n // 2), 'hello0 world', 'unknown text']
+      print('{:5d} routes: router {:6.2f} usec/match, linear {:8.2f} usec/match'.format(
+        n, bench(build(n), messages), linear(n, messages)))
+    return 0
+
+  sys.exit(main())
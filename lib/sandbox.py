@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Sandbox of the plugins
+
+Every plugin runs in its own compartment,
+
+- executor: 'thread' (default), 'process' for cpu heavy plugins, or 'asyncio' for coroutine functions
+  (normal functions of an 'asyncio' plugin run in its threads)
+- timeout: seconds the caller waits for the plugin, the caller is released on timeout
+- concurrency: max number of calls running at the same time, calls over the limit are rejected
+- circuit breaker: after consecutive failures (errors and timeouts) the calls are rejected
+  for reset_timeout seconds, then one trial call decides to close or to open again
+- latency histogram of the calls
+
+so one slow or broken plugin can not occupy the webhook handlers and starve the other plugins.
+
+The options are read from plugin_props(), e.g.
+  {'command': '/tenki', 'func': plugin_main, 'executor': 'thread', 'timeout': 30, 'concurrency': 8}
+"""
+
+import asyncio
+import inspect
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class SandboxRejected(Exception):
+  """the call is not started because of the concurrency limit or the open circuit"""
+
+
+class Histogram:
+
+  # upper bounds in milliseconds
+  BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+  def __init__(self):
+    self.counts = [0] * (len(self.BUCKETS) + 1)
+    self.count = 0
+    self.total = 0.0
+
+
+  def add(self, seconds):
+    ms = seconds * 1000
+    for i, bound in enumerate(self.BUCKETS):
+      if ms <= bound:
+        self.counts[i] += 1
+        break
+    else:
+      self.counts[-1] += 1
+    self.count += 1
+    self.total += seconds
+
+
+  def percentile(self, p):
+    """upper bound of the bucket which contains the percentile, in milliseconds
+
+    None if the percentile is beyond the last bucket, it is null in json of /stats (inf is not valid json)
+    """
+    if self.count == 0:
+      return 0
+    rank = self.count * p
+    seen = 0
+    for i, c in enumerate(self.counts[:-1]):
+      seen += c
+      if seen >= rank:
+        return self.BUCKETS[i]
+    return None
+
+
+  def as_dict(self):
+    buckets = {'le_{}'.format(b): c for b, c in zip(self.BUCKETS, self.counts)}
+    buckets['le_inf'] = self.counts[-1]
+    return {
+      'count': self.count,
+      'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+      'p50_ms': self.percentile(0.5),
+      'p99_ms': self.percentile(0.99),
+      'buckets': buckets
+    }
+
+
+class CircuitBreaker:
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half_open'
+
+  def __init__(self, name='', failure_threshold=5, reset_timeout=30.0):
+    self.name = name
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened_at = 0.0
+    self._trial = False
+
+
+  def allow(self):
+    # caller holds the lock of the compartment
+    if self.state == self.CLOSED:
+      return True
+    if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+      self.state = self.HALF_OPEN
+      self._trial = False
+    if self.state == self.HALF_OPEN and not self._trial:
+      self._trial = True
+      return True
+    return False
+
+
+  def record(self, ok):
+    if ok:
+      self.state = self.CLOSED
+      self.failures = 0
+      return
+    self.failures += 1
+    if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+      if self.state != self.OPEN:
+        logger.warning("circuit of %s opened after %d failures", self.name, self.failures)
+      self.state = self.OPEN
+      self.opened_at = time.monotonic()
+
+
+def _call_in_process(func, kwargs, with_bot):
+  # the bot of the parent process can not be pickled, the child process has its own
+  if with_bot:
+    kwargs = dict(kwargs, bot=_get_process_bot() if _process_bot_factory is not None else None)
+  return func(**kwargs)
+
+
+_process_bot_factory = None
+_process_bot = None
+
+
+def _init_process(bot_factory):
+  # pylint: disable=global-statement
+  global _process_bot_factory
+  _process_bot_factory = bot_factory
+
+
+def _get_process_bot():
+  # pylint: disable=global-statement
+  global _process_bot
+  if _process_bot is None:
+    _process_bot = _process_bot_factory()
+  return _process_bot
+
+
+class Compartment:
+
+  EXECUTORS = ('thread', 'process', 'asyncio')
+
+  def __init__(self, name, executor='thread', timeout=30.0, concurrency=4,
+               failure_threshold=5, reset_timeout=30.0, bot_factory=None):
+    """constructor for Compartment
+
+    Arguments:
+        name {str} -- name of the plugin
+
+    Keyword Arguments:
+        executor {str} -- 'thread', 'process' or 'asyncio' (default: {'thread'})
+        timeout {float} -- seconds to wait for the result (default: {30.0})
+        concurrency {int} -- max number of running calls (default: {4})
+        failure_threshold {int} -- consecutive failures to open the circuit (default: {5})
+        reset_timeout {float} -- seconds the circuit stays open (default: {30.0})
+        bot_factory {func} -- picklable function which creates the bot in the child process (default: {None})
+    """
+    if executor not in self.EXECUTORS:
+      raise ValueError("unknown executor: {}".format(executor))
+    self.name = name
+    self.kind = executor
+    self.timeout = timeout
+    self.concurrency = concurrency
+    self.breaker = CircuitBreaker(name=name, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+
+    self._lock = threading.Lock()
+    self._running = 0
+    self._loop = None
+
+    if executor == 'process':
+      self.executor = ProcessPoolExecutor(
+        max_workers=concurrency,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_process,
+        initargs=(bot_factory,))
+    else:
+      self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='plugin-{}'.format(name))
+    if executor == 'asyncio':
+      self._loop = asyncio.new_event_loop()
+      threading.Thread(target=self._loop.run_forever, name='plugin-{}-loop'.format(name), daemon=True).start()
+
+    # metrics
+    self.latency = Histogram()
+    self.calls = 0
+    self.errors = 0
+    self.timeouts = 0
+    self.rejected = 0
+
+
+  def options(self):
+    return {'executor': self.kind, 'timeout': self.timeout, 'concurrency': self.concurrency}
+
+
+  def _submit(self, func, kwargs):
+    if self.kind == 'process':
+      with_bot = 'bot' in kwargs
+      kwargs = {k: v for k, v in kwargs.items() if k != 'bot'}
+      return self.executor.submit(_call_in_process, func, kwargs, with_bot)
+    if self.kind == 'asyncio':
+      if inspect.iscoroutinefunction(func):
+        return asyncio.run_coroutine_threadsafe(func(**kwargs), self._loop)
+    return self.executor.submit(func, **kwargs)
+
+
+  def call(self, func, **kwargs):
+    """call the function in this compartment and wait for the result
+
+    Raises:
+        SandboxRejected -- the call is over the concurrency limit, or the circuit is open
+        concurrent.futures.TimeoutError -- no result in timeout seconds, the call goes on in background
+        Exception -- raised by the function
+
+    Returns:
+        object -- result of the function
+    """
+    with self._lock:
+      if self._running >= self.concurrency:
+        self.rejected += 1
+        raise SandboxRejected("{}: {} calls are running".format(self.name, self._running))
+      if not self.breaker.allow():
+        self.rejected += 1
+        raise SandboxRejected("{}: circuit is {}".format(self.name, self.breaker.state))
+      self._running += 1
+      self.calls += 1
+
+    start = time.perf_counter()
+    try:
+      future = self._submit(func, kwargs)
+    except Exception:
+      with self._lock:
+        self._running -= 1
+      raise
+
+    # the slot is released when the call really finishes, not when the caller gives up
+    def done(_):
+      with self._lock:
+        self._running -= 1
+        self.latency.add(time.perf_counter() - start)
+    future.add_done_callback(done)
+
+    try:
+      result = future.result(timeout=self.timeout)
+    except FutureTimeoutError:
+      with self._lock:
+        self.timeouts += 1
+        self.breaker.record(False)
+      raise
+    except Exception:
+      with self._lock:
+        self.errors += 1
+        self.breaker.record(False)
+      raise
+    with self._lock:
+      self.breaker.record(True)
+    return result
+
+
+  def shutdown(self):
+    self.executor.shutdown(wait=False)
+    if self._loop is not None:
+      self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+  def get_stats(self):
+    with self._lock:
+      return dict(
+        self.options(),
+        running=self._running,
+        calls=self.calls,
+        errors=self.errors,
+        timeouts=self.timeouts,
+        rejected=self.rejected,
+        circuit=self.breaker.state,
+        latency=self.latency.as_dict())
+
+
+class PluginSandbox:
+
+  OPTION_KEYS = ('executor', 'timeout', 'concurrency')
+
+  def __init__(self, defaults=None, bot_factory=None):
+    """constructor for PluginSandbox
+
+    Keyword Arguments:
+        defaults {dict} -- options of Compartment used when the plugin does not tell (default: {None})
+        bot_factory {func} -- picklable function which creates the bot in the child process (default: {None})
+    """
+    self.defaults = dict(defaults or {})
+    self.bot_factory = bot_factory
+    self.compartments = {}
+    self._lock = threading.Lock()
+
+
+  def get_compartment(self, name, options=None):
+    """get the compartment of the plugin, it is created again when the options are changed
+
+    Arguments:
+        name {str} -- name of the plugin
+
+    Keyword Arguments:
+        options {dict} -- executor, timeout and concurrency of the plugin (default: {None})
+    """
+    options = {k: v for k, v in (options or {}).items() if k in self.OPTION_KEYS and v is not None}
+    merged = dict(self.defaults, **options)
+    compartment = self.compartments.get(name)
+    if compartment is not None and all(compartment.options().get(k) == v for k, v in merged.items() if k in self.OPTION_KEYS):
+      return compartment
+    with self._lock:
+      old = self.compartments.get(name)
+      if old is not None and old is not compartment:
+        return old
+      compartment = Compartment(name, bot_factory=self.bot_factory, **merged)
+      self.compartments = dict(self.compartments, **{name: compartment})
+    if old is not None:
+      old.shutdown()
+    return compartment
+
+
+  def call(self, name, func, options=None, **kwargs):
+    """call the function of the plugin in its compartment, see Compartment.call()"""
+    return self.get_compartment(name, options).call(func, **kwargs)
+
+
+  def get_stats(self):
+    return {name: c.get_stats() for name, c in self.compartments.items()}
+
+
+if __name__ == '__main__':
+
+  import json
+
+  logging.basicConfig(level=logging.INFO)
+
+  def slow(seconds=None):
+    time.sleep(seconds)
+    return seconds
+
+  def fast():
+    return 'ok'
+
+  def broken():
+    raise ValueError('broken')
+
+  def main():
+    sandbox = PluginSandbox(defaults={'timeout': 0.5, 'concurrency': 2})
+
+    # the slow plugin uses up its own slots, the fast plugin is not affected
+    results = {'slow': [], 'fast': []}
+
+    def call(name, func, **kwargs):
+      try:
+        results[name].append(sandbox.call(name, func, **kwargs))
+      except SandboxRejected:
+        results[name].append('rejected')
+      except FutureTimeoutError:
+        results[name].append('timeout')
+      except ValueError:
+        results[name].append('error')
+
+    threads = [threading.Thread(target=call, args=('slow', slow), kwargs={'seconds': 3}) for _ in range(10)]
+    for t in threads:
+      t.start()
+    start = time.perf_counter()
+    for _ in range(100):
+      call('fast', fast)
+    print('100 fast calls in {:.3f} sec while the slow plugin hangs'.format(time.perf_counter() - start))
+    for t in threads:
+      t.join()
+    print('slow:', results['slow'])
+
+    # the circuit opens after 5 consecutive failures
+    results['broken'] = []
+    for _ in range(7):
+      call('broken', broken)
+    print('broken:', results['broken'])
+
+    time.sleep(3)
+    print(json.dumps(sandbox.get_stats()['slow'], indent=2))
+    return 0
+
+  sys.exit(main())
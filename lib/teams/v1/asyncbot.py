@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Asyncio Bot for Webex Teams
+
+Same methods as bot.Bot, but every rest api call is a coroutine.
+One aiohttp.ClientSession (and its connection pool) is shared by all calls,
+so hundreds of api calls can be in flight in one process.
+
+usage:
+
+  async with AsyncBot() as bot:
+    me = await bot.get_me()
+    async for room in bot.get_rooms():
+      print(room.get('title'))
+"""
+
+import asyncio
+import inspect
+import logging
+import mimetypes
+import os
+import sys
+
+import aiohttp
+
+def here(path=''):
+  return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+
+if not here('../..') in sys.path:
+  sys.path.append(here('../..'))
+
+from teams.v1.bot import Bot
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBot:
+
+  TIMEOUT = aiohttp.ClientTimeout(sock_connect=10.0, sock_read=30.0)
+
+  API_URL = Bot.API_URL
+
+  def __init__(self, bot_name=None, api_url=None, limit=100, limit_per_host=100):
+    """constructor for AsyncBot
+
+    Keyword Arguments:
+        bot_name {str} -- name of the bot (default: {None})
+        api_url {str} -- base url of rest api (default: {None})
+        limit {int} -- max number of connections (default: {100})
+        limit_per_host {int} -- max number of connections per host (default: {100})
+    """
+    bot_name = os.getenv('bot_name') if bot_name is None else bot_name
+    if bot_name is None or bot_name.strip() == '':
+      sys.exit("please set environment variable 'bot_name' before run this script")
+    self.bot_name = bot_name
+
+    self._bot_id = None  # get_bot_id() set this value and returns it
+
+    self.auth_token = Bot.get_auth_token(bot_name=bot_name)
+    if self.auth_token is None:
+      sys.exit("failed to get authentication token for {}".format(bot_name))
+
+    self.headers = {
+      'Authorization': "Bearer {}".format(self.auth_token),
+      'content-type': "application/json"
+    }
+
+    self.api_url = api_url or os.getenv('bot_api_url') or self.API_URL
+
+    self.limit = limit
+    self.limit_per_host = limit_per_host
+    self._session = None
+
+    # functions (or coroutine functions) with decorator will be stored in this dict object
+    self.on_message_functions = {}
+    self.on_command_functions = {}
+    self.on_regex_functions = []
+
+
+  async def __aenter__(self):
+    return self
+
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+
+  @property
+  def session(self):
+    # ClientSession must be created in a running event loop
+    if self._session is None or self._session.closed:
+      connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ssl=False)
+      self._session = aiohttp.ClientSession(connector=connector, timeout=self.TIMEOUT)
+    return self._session
+
+
+  async def close(self):
+    if self._session is not None and not self._session.closed:
+      await self._session.close()
+    self._session = None
+
+
+  def on_message(self, message_text):
+    """Decorator for the on_message, accepts coroutine function
+
+    Arguments:
+        message_text {str} -- the message text correspond to the function
+
+    Returns:
+        [func] -- decorator function
+    """
+    def decorator(func):
+      self.on_message_functions[message_text] = func
+      return func
+    return decorator
+
+
+  def on_command(self, command=None):
+    """Decorator for the on_command, accepts coroutine function
+
+    Arguments:
+        command {str} -- the command text correspond to the function
+
+    Returns:
+        [func] -- decorator function
+    """
+    def decorator(func):
+      self.on_command_functions[command] = func
+      return func
+    return decorator
+
+
+  def on_regex(self, pattern):
+    """Decorator for the message which matches the regular expression, accepts coroutine function
+
+    Arguments:
+        pattern {str} -- regular expression matched from the head of the message,
+        the function is called with room_id and match
+
+    Returns:
+        [func] -- decorator function
+    """
+    def decorator(func):
+      self.on_regex_functions.append((pattern, func))
+      return func
+    return decorator
+
+
+  @staticmethod
+  async def call_handler(func, **kwargs):
+    """Call the decorated function
+
+    coroutine function is awaited, normal function runs in the default executor.
+    """
+    if inspect.iscoroutinefunction(func):
+      return await func(**kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: func(**kwargs))
+
+
+  async def _request(self, method, api_path, **kwargs):
+    """Send a request and return (status, json data)
+
+    Returns:
+        tuple -- (ok, json data or None), (False, None) if the request failed
+    """
+    kwargs.setdefault('headers', self.headers)
+    try:
+      async with self.session.request(method, api_path, **kwargs) as response:
+        if response.status == 204:
+          return response.status < 400, None
+        if response.status < 400:
+          return True, await response.json(content_type=None)
+        logger.error("failed to %s: %s", method.lower(), api_path)
+        logger.error(await response.text())
+        return False, None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      logger.exception(e)
+    return False, None
+
+
+  async def _requests_get_as_json(self, api_path=None, params=None):
+    ok, data = await self._request('GET', api_path, params=params)
+    if ok:
+      logger.info("get success: %s", api_path)
+      return data
+    return None
+
+
+  async def _requests_get_pagination_as_items(self, api_path=None, params=None):
+    """Async generator yields items of all pages
+
+    next page is the url in Link header, rel="next"
+    see, https://developer.webex.com/docs/api/basics/pagination
+    """
+    url = api_path
+    while url:
+      try:
+        async with self.session.get(url, headers=self.headers, params=params) as response:
+          if response.status >= 400:
+            logger.error("failed to get: %s", url)
+            logger.error(await response.text())
+            return
+          data = await response.json(content_type=None)
+          next_link = response.links.get('next')
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.exception(e)
+        return
+
+      logger.info("get success: %s", url)
+      for item in (data or {}).get('items') or []:
+        yield item
+
+      # next url already contains query parameters
+      url = str(next_link.get('url')) if next_link else None
+      params = None
+
+
+  async def _requests_delete_as_bool(self, api_path=None):
+    ok, _ = await self._request('DELETE', api_path)
+    if ok:
+      logger.info("delete success: %s", api_path)
+    return ok
+
+
+  async def _requests_post_as_json(self, api_path=None, payload=None, data=None):
+    if data is not None:
+      ok, data = await self._request('POST', api_path, data=data)
+    else:
+      ok, data = await self._request('POST', api_path, json=payload)
+    if ok:
+      logger.info("post success: %s", api_path)
+      return data
+    return None
+
+
+  async def get_me(self):
+    api_path = '{}/people/me'.format(self.api_url)
+    return await self._requests_get_as_json(api_path=api_path)
+
+
+  async def get_bot_id(self):
+    if self._bot_id:
+      return self._bot_id
+    me = await self.get_me()
+    if not me:
+      return None
+    self._bot_id = me.get('id')
+    return self._bot_id
+
+
+  @staticmethod
+  async def _no_items():
+    return
+    yield  # pylint: disable=unreachable
+
+
+  def get_people_by_email(self, email=None):
+    """Async generator of people in your organization by email attribute"""
+    if email is None:
+      return self._no_items()
+    api_path = '{}/people'.format(self.api_url)
+    return self._requests_get_pagination_as_items(api_path=api_path, params={'email': email})
+
+
+  async def get_person_details(self, person_id=None):
+    if person_id is None:
+      return None
+    api_path = '{}/people/{}'.format(self.api_url, person_id)
+    return await self._requests_get_as_json(api_path=api_path)
+
+
+  def get_rooms(self):
+    """Async generator of rooms to which the authenticated user belongs"""
+    api_path = '{}/rooms'.format(self.api_url)
+    return self._requests_get_pagination_as_items(api_path=api_path)
+
+
+  async def get_room_details(self, room_id=None):
+    if room_id is None:
+      return None
+    api_path = '{}/rooms/{}'.format(self.api_url, room_id)
+    return await self._requests_get_as_json(api_path=api_path)
+
+
+  async def delete_room(self, room_id=None):
+    if room_id is None:
+      return False
+    api_path = '{}/rooms/{}'.format(self.api_url, room_id)
+    return await self._requests_delete_as_bool(api_path=api_path)
+
+
+  async def get_message_detail(self, message_id=None):
+    if message_id is None:
+      return None
+    api_path = '{}/messages/{}'.format(self.api_url, message_id)
+    return await self._requests_get_as_json(api_path=api_path)
+
+
+  async def get_message_text(self, message_id=None):
+    json_data = await self.get_message_detail(message_id=message_id)
+    if json_data is None:
+      return None
+    return json_data.get('text')
+
+
+  @staticmethod
+  def _message_payload(text, room_id, to_person_id, to_person_email):
+    payload = {'text': text}
+    if room_id is not None:
+      payload.update({'roomId': room_id})
+    if to_person_id is not None:
+      payload.update({'toPersonId': to_person_id})
+    if to_person_email is not None:
+      payload.update({'toPersonEmail': to_person_email})
+    return payload
+
+
+  async def send_message(self, text=None, room_id=None, to_person_id=None, to_person_email=None, attachments=None):
+    if not any([room_id, to_person_id, to_person_email]):
+      return None
+    payload = self._message_payload(text or "message", room_id, to_person_id, to_person_email)
+    api_path = '{}/messages/'.format(self.api_url)
+    if attachments is not None and isinstance(attachments, list):
+      if any(isinstance(a, bytes) for a in attachments):
+        return await self._requests_post_as_json(api_path=api_path, data=Bot.encode_payload(payload, attachments))
+      payload.update({'attachments': attachments})
+    return await self._requests_post_as_json(api_path=api_path, payload=payload)
+
+
+  async def send_image(self, text=None, room_id=None, to_person_id=None, to_person_email=None, image_filename=None):
+    if not any([room_id, to_person_id, to_person_email]):
+      return None
+    if image_filename is None:
+      return None
+
+    payload = self._message_payload(text or "image", room_id, to_person_id, to_person_email)
+    content_type = mimetypes.guess_type(image_filename)[0] or 'application/octet-stream'
+
+    api_path = '{}/messages'.format(self.api_url)
+    headers = {'Authorization': self.headers.get('Authorization')}
+
+    with open(image_filename, 'rb') as f:
+      form = aiohttp.FormData()
+      for k, v in payload.items():
+        form.add_field(k, v)
+      form.add_field('files', f, filename=os.path.basename(image_filename), content_type=content_type)
+      ok, data = await self._request('POST', api_path, data=form, headers=headers)
+
+    if ok:
+      logger.info("post success: %s", api_path)
+      return data
+    return None
+
+
+  async def get_attachment(self, attachment_id=None):
+    if attachment_id is None:
+      return None
+    api_path = '{}/attachment/actions/{}'.format(self.api_url, attachment_id)
+    return await self._requests_get_as_json(api_path=api_path)
+
+
+  async def get_webhooks(self, webhook_name=None):
+    name = webhook_name
+    if name is None:
+      name = self.bot_name
+    api_path = '{}/webhooks'.format(self.api_url)
+    webhooks = [w async for w in self._requests_get_pagination_as_items(api_path=api_path)]
+    return [w for w in webhooks if w.get('name') == name]
+
+
+  async def has_webhooks(self, webhook_name=None):
+    webhooks = await self.get_webhooks(webhook_name=webhook_name)
+    return len(webhooks) > 0
+
+
+  async def delete_webhook(self, webhook_id=None):
+    if not webhook_id:
+      return False
+    api_path = '{}/webhooks/{}'.format(self.api_url, webhook_id)
+    return await self._requests_delete_as_bool(api_path=api_path)
+
+
+  async def delete_webhooks(self):
+    await self.delete_webhooks_by_name(webhook_name=self.bot_name)
+
+
+  async def delete_webhooks_by_name(self, webhook_name=None):
+    webhooks = await self.get_webhooks(webhook_name=webhook_name)
+    await asyncio.gather(*[self.delete_webhook(webhook_id=w.get('id')) for w in webhooks])
+
+
+  async def regist_webhook(self, webhook_name=None, target_url=None):
+    name = webhook_name
+    if name is None:
+      name = self.bot_name
+
+    # delete same name webhooks, if any
+    await self.delete_webhooks_by_name(webhook_name=name)
+
+    api_path = '{}/webhooks'.format(self.api_url)
+
+    results = await asyncio.gather(*[
+      self._requests_post_as_json(api_path=api_path, payload={
+        'resource': resource,
+        'event': "all",
+        'targetUrl': target_url,
+        'name': name
+      }) for resource in ["messages", "attachmentActions"]
+    ])
+
+    for resource, result in zip(["message", "attachment action"], results):
+      if result is None:
+        logger.error('Failed to regist webhook for %s', resource)
+      else:
+        logger.info('Success to regist webhook for %s', resource)
+
+
+  async def update_webhook(self, webhook_id=None, webhook_name=None, target_url=None):
+    api_path = '{}/webhooks/{}'.format(self.api_url, webhook_id)
+    payload = {
+      'name': webhook_name,
+      'targetUrl': target_url,
+      'status': 'active'
+    }
+    ok, data = await self._request('PUT', api_path, json=payload)
+    if ok:
+      logger.info('Webhook update successfuly')
+      return data
+    return None
+
+
+if __name__ == '__main__':
+
+  import argparse
+  import time
+
+  from aiohttp import web
+
+  logging.basicConfig(level=logging.WARNING)
+
+  async def run_fake_api():
+    """local fake api, responds after a fixed latency"""
+
+    async def people_me(request):
+      await asyncio.sleep(0.02)  # latency of the upstream
+      return web.json_response({'id': 'fake-bot', 'displayName': 'fake'})
+
+    app = web.Application()
+    app.router.add_get('/v1/people/me', people_me)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+    return runner, 'http://127.0.0.1:{}/v1'.format(port)
+
+
+  async def bench(bot, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call():
+      async with semaphore:
+        return await bot.get_me()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[call() for _ in range(count)])
+    elapsed = time.perf_counter() - start
+    assert all(results)
+    return count / elapsed
+
+
+  async def amain(count):
+    runner, api_url = await run_fake_api()
+    async with AsyncBot(bot_name='bench', api_url=api_url, limit=500, limit_per_host=500) as bot:
+      for concurrency in [1, 10, 50, 100, 200]:
+        rps = await bench(bot, count, concurrency)
+        print('concurrency {:4d} : {:8.1f} req/s'.format(concurrency, rps))
+    await runner.cleanup()
+
+
+  def main():
+    parser = argparse.ArgumentParser(description='benchmark AsyncBot against a local fake api.')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='number of requests per concurrency')
+    args = parser.parse_args()
+    os.environ.setdefault('bot_token', 'fake-token')
+    asyncio.run(amain(args.count))
+    return 0
+
+  sys.exit(main())
@@ -5,6 +5,10 @@
 
 - Define decorator for bot
 - Show/Create/Delete webhook for Webex Teams
+- Share keep-alive connections among all rest api calls (see session.py)
+- Pace rest api calls and retry on 429 Too Many Requests (see ratelimit.py)
+- Cache people, room and message lookups (see cache.py)
+- Stream uploaded files and close them on return (see upload.py)
 
 Links:
   - user account: https://developer.webex.com/
@@ -16,11 +20,22 @@ import json
 import logging
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 requests.packages.urllib3.disable_warnings()
 
-from requests_toolbelt.multipart.encoder import MultipartEncoder
+def here(path=''):
+  return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+
+if not here('../..') in sys.path:
+  sys.path.append(here('../..'))
+
+from teams.v1.ratelimit import RateLimitScheduler
+from teams.v1.session import PooledSession
+from teams.v1.upload import as_source, encode_multipart
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +43,14 @@ class Bot:
 
   TIMEOUT = (10.0, 30.0)  # (connect timeout, read timeout)
 
-  def __init__(self, bot_name=None):
+  API_URL = 'https://api.ciscospark.com/v1'
+
+  # methods which could be retried safely on connection error or 5xx
+  IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+  RETRY_STATUS = (502, 503, 504)
+
+  def __init__(self, bot_name=None, session=None, api_url=None, scheduler=None):
 
     bot_name = os.getenv('bot_name') if bot_name is None else bot_name
     if bot_name is None or bot_name.strip() == '':
@@ -37,18 +59,39 @@ class Bot:
 
     self._bot_id = None  # get_bot_id() set this value and returns it
 
+    # IdentityCache for get_me(), see identity.py
+    self.identity_cache = None
+
+    # TTLCache for people, rooms and messages, see cache.py
+    self.cache = None
+
     self.auth_token = self.get_auth_token(bot_name=bot_name)
     if self.auth_token is None:
       sys.exit("failed to get authentication token for {}".format(bot_name))
 
-    self.headers = {
-      'Authorization': "Bearer {}".format(self.auth_token),
-      'content-type': "application/json"
+    # multipart uploads replace only the content-type of these headers
+    self.auth_headers = {
+      'Authorization': "Bearer {}".format(self.auth_token)
     }
 
+    self.headers = dict(self.auth_headers, **{'content-type': "application/json"})
+
+    # base url of rest api, environment variable bot_api_url could point to a stand-in server
+    self.api_url = api_url or os.getenv('bot_api_url') or self.API_URL
+
+    # keep-alive connections are shared by every call of this bot
+    self.session = PooledSession() if session is None else session
+
+    # token bucket per endpoint family, shared by every call of this bot
+    self.scheduler = RateLimitScheduler() if scheduler is None else scheduler
+
+    # status code of the last request per thread, see last_status()
+    self._local = threading.local()
+
     # functions with decorator will be stored in this dict object
     self.on_message_functions = {}
     self.on_command_functions = {}
+    self.on_regex_functions = []
 
 
   def on_message(self, message_text):
@@ -62,6 +105,7 @@ class Bot:
     """
     def decorator(func):
       self.on_message_functions[message_text] = func
+      return func
     return decorator
 
 
@@ -77,6 +121,23 @@ class Bot:
     """
     def decorator(func):
       self.on_command_functions[command] = func
+      return func
+    return decorator
+
+
+  def on_regex(self, pattern):
+    """Decorator for the message which matches the regular expression
+
+    Arguments:
+        pattern {str} -- regular expression matched from the head of the message,
+        the function is called with room_id and match
+
+    Returns:
+        [func] -- decorator function
+    """
+    def decorator(func):
+      self.on_regex_functions.append((pattern, func))
+      return func
     return decorator
 
 
@@ -114,6 +175,105 @@ class Bot:
     return None
 
 
+  def _request(self, method, api_path, **kwargs):
+    """Send a request through the pooled session
+
+    every request waits for the budget of its endpoint family.
+    429 response is retried after Retry-After, because the request was not processed.
+    connection error and 5xx response are retried only for idempotent methods.
+
+    Arguments:
+        method {str} -- http method
+        api_path {str} -- api path, fqdn
+
+    Returns:
+        requests.Response -- response object, or None if the request failed
+    """
+    kwargs.setdefault('headers', self.headers)
+    kwargs.setdefault('timeout', self.TIMEOUT)
+    kwargs.setdefault('verify', False)
+
+    family = self.scheduler.family(api_path)
+
+    # streamed body (e.g. MultipartEncoder) could not be sent twice
+    replayable = not hasattr(kwargs.get('data'), 'read')
+    idempotent = replayable and method.upper() in self.IDEMPOTENT_METHODS
+
+    attempt = 0
+    while True:
+      self.scheduler.acquire(family)
+      can_retry = attempt < self.scheduler.max_retries
+
+      self._local.status = None
+      try:
+        response = self.session.request(method, api_path, **kwargs)
+      except requests.exceptions.RequestException as e:
+        if not (idempotent and can_retry):
+          logger.exception(e)
+          return None
+        logger.warning("retry %s %s: %s", method, api_path, e)
+        wait = self.scheduler.backoff(attempt)
+      else:
+        if response.status_code == 429 and replayable and can_retry:
+          retry_after = self.scheduler.parse_retry_after(response.headers.get('Retry-After'))
+          wait = self.scheduler.on_throttled(family, retry_after=retry_after, attempt=attempt)
+        elif response.status_code in self.RETRY_STATUS and idempotent and can_retry:
+          logger.warning("retry %s %s: status %d", method, api_path, response.status_code)
+          wait = self.scheduler.backoff(attempt)
+        else:
+          self._local.status = response.status_code
+          return response
+
+      self.scheduler.on_retry(family)
+      attempt += 1
+      time.sleep(wait)
+
+
+  def last_status(self):
+    """Status code of the last request in this thread
+
+    e.g. send_message() returns None for both 400 and connection error, the caller tells them apart by this.
+
+    Returns:
+        int -- http status code, or None if no response was received
+    """
+    return getattr(self._local, 'status', None)
+
+
+  def get_rate_limit_stats(self):
+    """Get budget and throttle counts of each endpoint family
+
+    Returns:
+        dict -- family name -> rate, burst, available tokens, throttled and retries
+    """
+    return self.scheduler.get_stats()
+
+
+  def _cached(self, resource, key, loader):
+    """Get the value through the cache, if it is set"""
+    if self.cache is None:
+      return loader()
+    return self.cache.get_or_load(resource, key, loader)
+
+
+  def get_cache_stats(self):
+    """Get hit rate of the cache
+
+    Returns:
+        dict -- statistics per resource, or None if the cache is not set
+    """
+    return self.cache.get_stats() if self.cache is not None else None
+
+
+  def get_session_stats(self):
+    """Get metrics of the pooled session
+
+    Returns:
+        dict -- requests, errors, pool exhaustion and per host connections
+    """
+    return self.session.get_stats()
+
+
   def _requests_get_as_json(self, api_path=None):
     """Send get method to api_path and return json data
 
@@ -123,11 +283,7 @@ class Bot:
     Returns:
         dict -- json data, or None
     """
-    get_result = None
-    try:
-      get_result = requests.get(api_path, headers=self.headers, timeout=self.TIMEOUT, verify=False)
-    except requests.exceptions.RequestException as e:
-      logger.exception(e)
+    get_result = self._request('GET', api_path)
 
     if get_result is None:
       return None
@@ -142,68 +298,86 @@ class Bot:
     return None
 
 
-  def _requests_get_pagination_as_items(self, api_path=None, params=None):
-    """Get all items with pagination
-
-    pagination is not tested well.
-    see, https://developer.webex.com/docs/api/basics/pagination
-
-    in requests module, 'next' url could be retrieved easily
-    response.links['next']['url']
+  def _requests_get_page(self, api_path=None, params=None):
+    """Get one page of items
 
     Arguments:
-        api_path {str} -- api path fqdn
+        api_path {str} -- api path fqdn, or the url of the next page
 
     Keyword Arguments:
         params {dict} -- get request params (default: {None})
 
     Returns:
-        list -- a list contains all items
+        tuple -- (items, url of the next page or None), or None if failed
     """
-    result_list = []
-
-    get_result = None
-    try:
-      get_result = requests.get(api_path, headers=self.headers, params=params, timeout=self.TIMEOUT, verify=False)
-    except requests.exceptions.RequestException as e:
-      logger.exception(e)
+    get_result = self._request('GET', api_path, params=params)
 
     if get_result is None:
-      return []
+      return None
 
     if not get_result.ok:
       logger.error("failed to get: %s", api_path)
       logger.error(get_result.text)
-      return []
+      return None
 
     logger.info("get success: %s", api_path)
-    items = get_result.json().get('items')
-    if items:
-      result_list.extend(items)
-    else:
-      return []
+    items = get_result.json().get('items') or []
+    next_url = get_result.links.get('next', {}).get('url')
+    return items, next_url
 
-    while 'next' in get_result.links.keys():
-      get_result = None
-      try:
-        get_result = requests.get(api_path, headers=self.headers, params=params, timeout=self.TIMEOUT, verify=False)
-      except requests.exceptions.RequestException as e:
-        logger.exception(e)
 
-      if get_result is None:
-        return []
+  def _requests_get_pagination_as_items(self, api_path=None, params=None, max_items=None, page_size=None, prefetch=False):
+    """Generator yields items of all pages
 
-      if get_result.ok:
-        logger.info("get success: %s", api_path)
-        items = get_result.json().get('items')
-        if items:
-          result_list.extend(items)
-      else:
-        logger.error("failed to get: %s", api_path)
-        logger.error(get_result.text)
-        return []
+    the url of the next page is in the Link header (RFC 5988), rel="next"
+    see, https://developer.webex.com/docs/api/basics/pagination
+
+    items are yielded as each page arrives, so memory usage does not depend on the number of items.
+
+    Arguments:
+        api_path {str} -- api path fqdn
+
+    Keyword Arguments:
+        params {dict} -- get request params (default: {None})
+        max_items {int} -- stop after this number of items (default: {None})
+        page_size {int} -- number of items per page, 'max' param of the api (default: {None})
+        prefetch {bool} -- get the next page while the caller processes the current page (default: {False})
+
+    Yields:
+        dict -- item
+    """
+    params = dict(params or {})
+    if page_size:
+      params['max'] = page_size
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    future = None
+    count = 0
+    try:
+      page = self._requests_get_page(api_path=api_path, params=params)
+      while page is not None:
+        items, next_url = page
 
-    return result_list
+        # next url already contains query parameters
+        if next_url and executor is not None:
+          future = executor.submit(self._requests_get_page, api_path=next_url)
+
+        for item in items:
+          if max_items is not None and count >= max_items:
+            return
+          count += 1
+          yield item
+
+        if not next_url:
+          return
+
+        page = future.result() if future is not None else self._requests_get_page(api_path=next_url)
+        future = None
+    finally:
+      if executor is not None:
+        if future is not None:
+          future.cancel()
+        executor.shutdown(wait=False)
 
 
   def _requests_delete_as_bool(self, api_path=None):
@@ -215,11 +389,7 @@ class Bot:
     Returns:
         bool -- True if success
     """
-    delete_result = None
-    try:
-      delete_result = requests.delete(api_path, headers=self.headers, timeout=self.TIMEOUT, verify=False)
-    except requests.exceptions.RequestException as e:
-      logger.exception(e)
+    delete_result = self._request('DELETE', api_path)
 
     if delete_result is None:
       return False
@@ -233,12 +403,12 @@ class Bot:
     return False
 
 
-  def _requests_post_as_json(self, api_path=None, payload=None):
-    post_result = None
-    try:
-      post_result = requests.post(api_path, json=payload, headers=self.headers, timeout=self.TIMEOUT, verify=False)
-    except requests.exceptions.RequestException as e:
-      logger.exception(e)
+  def _requests_post_as_json(self, api_path=None, payload=None, data=None):
+    if data is not None:
+      # request body already serialized, see encode_payload()
+      post_result = self._request('POST', api_path, data=data)
+    else:
+      post_result = self._request('POST', api_path, json=payload)
 
     if post_result is None:
       return None
@@ -259,10 +429,25 @@ class Bot:
     GET /v1/people/me
     https://developer.webex.com/docs/api/v1/people/get-my-own-details
 
+    the result is taken from identity_cache, if it is set.
+
+    Returns:
+        dict -- information about this bot obtained from rest api, or None
+    """
+    if self.identity_cache is not None:
+      me = self.identity_cache.get()
+      if me:
+        return me
+    return self.fetch_me()
+
+
+  def fetch_me(self):
+    """Same as get_me() but always calls rest api
+
     Returns:
         dict -- information about this bot obtained from rest api, or None
     """
-    api_path = 'https://api.ciscospark.com/v1/people/me'
+    api_path = '{}/people/me'.format(self.api_url)
     return self._requests_get_as_json(api_path=api_path)
 
 
@@ -281,7 +466,7 @@ class Bot:
     return self._bot_id
 
 
-  def get_people_by_email(self, email=None):
+  def get_people_by_email(self, email=None, max_items=None):
     """Get people in your organization by email attribute
 
     GET /v1/people
@@ -289,20 +474,26 @@ class Bot:
 
     Keyword Arguments:
         email {str} -- get people with this email address (default: {None})
+        max_items {int} -- max number of people (default: {None})
 
     Returns:
-        list -- list of person objects
+        generator -- person objects
     """
     if email is None:
-      return []
+      return iter([])
 
-    api_path = 'https://api.ciscospark.com/v1/people'
+    api_path = '{}/people'.format(self.api_url)
 
     params = {
       "email": email
     }
 
-    return self._requests_get_pagination_as_items(api_path=api_path, params=params)
+    if self.cache is None:
+      return self._requests_get_pagination_as_items(api_path=api_path, params=params, max_items=max_items)
+
+    # a few people have the same email, cache them as list
+    people = self._cached('people_by_email', email, lambda: list(self._requests_get_pagination_as_items(api_path=api_path, params=params)))
+    return iter((people or [])[:max_items])
 
 
   def get_person_details(self, person_id=None):
@@ -319,21 +510,28 @@ class Bot:
     """
     if person_id is None:
       return None
-    api_path = 'https://api.ciscospark.com/v1/people/{}'.format(person_id)
-    return self._requests_get_as_json(api_path=api_path)
+    if self.identity_cache is not None and person_id == self.get_bot_id():
+      return self.get_me()
+    api_path = '{}/people/{}'.format(self.api_url, person_id)
+    return self._cached('people', person_id, lambda: self._requests_get_as_json(api_path=api_path))
 
 
-  def get_rooms(self):
+  def get_rooms(self, max_items=None, page_size=100, prefetch=True):
     """Get rooms to which the authenticated user belongs
 
     GET /v1/rooms
     https://developer.webex.com/docs/api/v1/rooms/list-rooms
 
+    Keyword Arguments:
+        max_items {int} -- max number of rooms (default: {None})
+        page_size {int} -- number of rooms per page (default: {100})
+        prefetch {bool} -- get the next page in background (default: {True})
+
     Returns:
-        list -- list of the rooms
+        generator -- room objects
     """
-    api_path = 'https://api.ciscospark.com/v1/rooms'
-    return self._requests_get_pagination_as_items(api_path=api_path)
+    api_path = '{}/rooms'.format(self.api_url)
+    return self._requests_get_pagination_as_items(api_path=api_path, max_items=max_items, page_size=page_size, prefetch=prefetch)
 
 
   def get_room_details(self, room_id=None):
@@ -350,8 +548,8 @@ class Bot:
     """
     if room_id is None:
       return None
-    api_path = 'https://api.ciscospark.com/v1/rooms/{}'.format(room_id)
-    return self._requests_get_as_json(api_path=api_path)
+    api_path = '{}/rooms/{}'.format(self.api_url, room_id)
+    return self._cached('rooms', room_id, lambda: self._requests_get_as_json(api_path=api_path))
 
 
   def delete_room(self, room_id=None):
@@ -368,7 +566,9 @@ class Bot:
     """
     if room_id is None:
       return False
-    api_path = 'https://api.ciscospark.com/v1/rooms/{}'.format(room_id)
+    if self.cache is not None:
+      self.cache.invalidate('rooms', room_id)
+    api_path = '{}/rooms/{}'.format(self.api_url, room_id)
     return self._requests_delete_as_bool(api_path=api_path)
 
 
@@ -386,8 +586,8 @@ class Bot:
     """
     if message_id is None:
       return None
-    api_path = 'https://api.ciscospark.com/v1/messages/{}'.format(message_id)
-    return self._requests_get_as_json(api_path=api_path)
+    api_path = '{}/messages/{}'.format(self.api_url, message_id)
+    return self._cached('messages', message_id, lambda: self._requests_get_as_json(api_path=api_path))
 
 
   def get_message_text(self, message_id=None):
@@ -416,7 +616,7 @@ class Bot:
         room_id {str} -- The room ID of the message (default: {None})
         to_person_id {str} -- The person ID of the recipient when sending a private 1:1 message. (default: {None})
         to_person_email {str} -- The email address of the recipient when sending a private 1:1 message. (default: {None})
-        attachments {list} -- Content attachments to attach to the message. (default: {None})
+        attachments {list} -- Content attachments to attach to the message, dict or json bytes. (default: {None})
 
     Returns:
         dict -- post response, or None
@@ -437,16 +637,55 @@ class Bot:
     if to_person_email is not None:
       payload.update({'toPersonEmail': to_person_email})
 
+    api_path = '{}/messages/'.format(self.api_url)
+
     if attachments is not None and isinstance(attachments, list):
+      if any(isinstance(a, bytes) for a in attachments):
+        return self._requests_post_as_json(api_path=api_path, data=self.encode_payload(payload, attachments))
       payload.update({'attachments': attachments})
 
-    api_path = 'https://api.ciscospark.com/v1/messages/'
     return self._requests_post_as_json(api_path=api_path, payload=payload)
 
 
+  @staticmethod
+  def encode_payload(payload, attachments):
+    """serialize the message with attachments, attachments in bytes are embedded as they are
+
+    Arguments:
+        payload {dict} -- message without attachments, not empty
+        attachments {list} -- attachment dicts, or json bytes of them (e.g. CardRepository.get_bytes())
+
+    Returns:
+        bytes -- request body
+    """
+    parts = [a if isinstance(a, bytes) else json.dumps(a).encode('utf-8') for a in attachments]
+    body = json.dumps(payload).encode('utf-8')
+    return body[:-1] + b',"attachments":[' + b','.join(parts) + b']}'
+
+
   def send_image(self, text=None, room_id=None, to_person_id=None, to_person_email=None, image_filename=None):
     """Create a message with image
 
+    Keyword Arguments:
+        text {str} -- The message, in plain text (default: {None})
+        room_id {str} -- The room ID of the message (default: {None})
+        to_person_id {str} -- The person ID of the recipient when sending a private 1:1 message. (default: {None})
+        to_person_email {str} -- The email address of the recipient when sending a private 1:1 message. (default: {None})
+        image_filename {str} -- The filename of the image. (default: {None})
+
+    Returns:
+        dict -- post response, or None
+    """
+    if image_filename is None:
+      return None
+
+    return self.send_file(text=text or "image", room_id=room_id, to_person_id=to_person_id, to_person_email=to_person_email, content=image_filename)
+
+
+  def send_file(self, text=None, room_id=None, to_person_id=None, to_person_email=None, content=None, source=None,
+                filename=None, content_type=None, progress=None):
+    """Create a message with file, the file is streamed and closed on return (see upload.py)
+
     SEE
     https://developer.webex.com/docs/api/basics/message-attachments
 
@@ -455,7 +694,11 @@ class Bot:
         room_id {str} -- The room ID of the message (default: {None})
         to_person_id {str} -- The person ID of the recipient when sending a private 1:1 message. (default: {None})
         to_person_email {str} -- The email address of the recipient when sending a private 1:1 message. (default: {None})
-        image_filename {str} -- The filename of the image. (default: {None})
+        content {str, bytes or iterable} -- path of the file, bytes, or generator of bytes (default: {None})
+        source {UploadSource} -- source of the file instead of content, closed by the caller (default: {None})
+        filename {str} -- The filename in the message (default: {basename of the path})
+        content_type {str} -- The content type, guessed if None (default: {None})
+        progress {func} -- called with (filename, bytes sent, total bytes) (default: {None})
 
     Returns:
         dict -- post response, or None
@@ -463,11 +706,15 @@ class Bot:
     if not any([room_id, to_person_id, to_person_email]):
       return None
 
-    if image_filename is None:
-      return None
+    if source is None:
+      if content is None:
+        return None
+      with as_source(content, filename=filename, content_type=content_type) as owned:
+        return self.send_file(text=text, room_id=room_id, to_person_id=to_person_id, to_person_email=to_person_email,
+                              source=owned, progress=progress)
 
     payload = {
-      'text': text or "image"
+      'text': text or "file"
     }
 
     if room_id is not None:
@@ -479,28 +726,17 @@ class Bot:
     if to_person_email is not None:
       payload.update({'toPersonEmail': to_person_email})
 
-    payload.update(
-      {
-        'files': (image_filename, open(image_filename, 'rb'), 'image/png')
-      }
-    )
-
-    m = MultipartEncoder(payload)
-
-    headers = {
-      'Authorization': "Bearer {}".format(self.auth_token),
-      'content-type': m.content_type
-    }
+    try:
+      body, body_content_type = encode_multipart(payload, source, progress=progress)
+    except (IOError, OSError) as e:
+      logger.error("failed to open %s: %s", source.filename, e)
+      return None
 
-    logger.info(m.content_type)
+    headers = dict(self.auth_headers, **{'content-type': body_content_type})
 
-    api_path = 'https://api.ciscospark.com/v1/messages'
+    api_path = '{}/messages'.format(self.api_url)
 
-    post_result = None
-    try:
-      post_result = requests.post(api_path, data=m, headers=headers, timeout=self.TIMEOUT, verify=False)
-    except requests.exceptions.RequestException as e:
-      logger.exception(e)
+    post_result = self._request('POST', api_path, data=body, headers=headers)
 
     if post_result is None:
       return None
@@ -511,6 +747,7 @@ class Bot:
 
     logger.error("failed to post: %s", api_path)
     logger.error(post_result.text)
+    return None
 
 
   def get_attachment(self, attachment_id=None):
@@ -527,7 +764,7 @@ class Bot:
     """
     if attachment_id is None:
       return None
-    api_path = 'https://api.ciscospark.com/v1/attachment/actions/{}'.format(attachment_id)
+    api_path = '{}/attachment/actions/{}'.format(self.api_url, attachment_id)
     return self._requests_get_as_json(api_path=api_path)
 
 
@@ -538,13 +775,9 @@ class Bot:
     if name is None:
       name = self.bot_name
 
-    api_path = 'https://api.ciscospark.com/v1/webhooks'
+    api_path = '{}/webhooks'.format(self.api_url)
 
-    get_result = None
-    try:
-      get_result = requests.get(api_path, headers=self.headers, timeout=self.TIMEOUT, verify=False)
-    except requests.exceptions.RequestException as e:
-      logger.exception(e)
+    get_result = self._request('GET', api_path)
 
     if get_result is None:
       return []
@@ -596,7 +829,7 @@ class Bot:
     """
     if not id:
       return False
-    api_path = 'https://api.ciscospark.com/v1/webhooks/{}'.format(webhook_id)
+    api_path = '{}/webhooks/{}'.format(self.api_url, webhook_id)
     return self._requests_delete_as_bool(api_path=api_path)
 
 
@@ -623,7 +856,7 @@ class Bot:
     # delete same name webhooks, if any
     self.delete_webhooks_by_name(webhook_name=name)
 
-    api_path = 'https://api.ciscospark.com/v1/webhooks'
+    api_path = '{}/webhooks'.format(self.api_url)
 
     payload = {
       'resource': "messages",
@@ -659,7 +892,7 @@ class Bot:
   def update_webhook(self, webhook_id=None, webhook_name=None, target_url=None):
     # PUT /v1/webhooks/{webhookId}
     # https://developer.webex.com/docs/api/v1/webhooks/update-a-webhook
-    api_path = 'https://api.ciscospark.com/v1/webhooks/{}'.format(webhook_id)
+    api_path = '{}/webhooks/{}'.format(self.api_url, webhook_id)
 
     payload = {
       'name': webhook_name,
@@ -667,11 +900,7 @@ class Bot:
       'status': 'active'
     }
 
-    put_result = None
-    try:
-      put_result = requests.put(api_path, json=payload, headers=self.headers, timeout=self.TIMEOUT, verify=False)
-    except requests.exceptions.RequestException as e:
-      logger.exception(e)
+    put_result = self._request('PUT', api_path, json=payload)
 
     if put_result is None:
       return None
@@ -742,8 +971,8 @@ if __name__ == '__main__':
           print("{} : {}".format(webhook_id, "delete failed"))
 
     elif args.room:
-      rooms = bot.get_rooms()
-      print(json.dumps(rooms, ensure_ascii=False, indent=2))
+      for room in bot.get_rooms():
+        print(json.dumps(room, ensure_ascii=False, indent=2))
 
     elif args.me:
       me = bot.get_me()
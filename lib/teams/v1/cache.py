@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Cache for rest api lookups of the Bot
+
+- bounded LRU in process memory, TTL per resource (people, rooms, messages)
+- optional second tier in redis, shared by all gunicorn workers
+- single flight, concurrent misses of the same key wait for one upstream call
+- hit rate statistics per resource
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class RedisCacheBackend:
+
+  def __init__(self, conn, prefix='bot:cache'):
+    """constructor for RedisCacheBackend
+
+    Arguments:
+        conn {redis.StrictRedis} -- redis client, created with decode_responses=True
+
+    Keyword Arguments:
+        prefix {str} -- prefix of redis keys (default: {'bot:cache'})
+    """
+    self.conn = conn
+    self.prefix = prefix
+
+
+  def _key(self, resource, key):
+    return '{}:{}:{}'.format(self.prefix, resource, key)
+
+
+  def get(self, resource, key):
+    """Returns:
+        tuple -- (value, seconds to live), or (None, 0)
+    """
+    pipe = self.conn.pipeline(transaction=False)
+    pipe.get(self._key(resource, key))
+    pipe.pttl(self._key(resource, key))
+    value, pttl = pipe.execute()
+    if value is None:
+      return None, 0
+    return json.loads(value), max(pttl, 0) / 1000.0
+
+
+  def set(self, resource, key, value, ttl):
+    self.conn.set(self._key(resource, key), json.dumps(value), px=int(ttl * 1000))
+
+
+  def delete(self, resource, key):
+    self.conn.delete(self._key(resource, key))
+
+
+class _Flight:
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.value = None
+
+
+class TTLCache:
+
+  DEFAULT_TTLS = {
+    'people': 600,
+    'rooms': 300,
+    'messages': 60
+  }
+
+  def __init__(self, maxsize=4096, ttls=None, default_ttl=300, backend=None):
+    """constructor for TTLCache
+
+    Keyword Arguments:
+        maxsize {int} -- max number of entries in process memory (default: {4096})
+        ttls {dict} -- resource name -> seconds to live, merged with DEFAULT_TTLS (default: {None})
+        default_ttl {int} -- seconds to live of other resources (default: {300})
+        backend {RedisCacheBackend} -- second tier shared by processes (default: {None})
+    """
+    self.maxsize = maxsize
+    self.ttls = dict(self.DEFAULT_TTLS)
+    self.ttls.update(ttls or {})
+    self.default_ttl = default_ttl
+    self.backend = backend
+
+    self._data = OrderedDict()  # (resource, key) -> (expires, value)
+    self._flights = {}
+    self._lock = threading.Lock()
+    self._stats = {}
+
+
+  def _count(self, resource, name):
+    # caller holds the lock
+    stats = self._stats.setdefault(resource, {'hits': 0, 'misses': 0, 'backend_hits': 0, 'loads': 0, 'coalesced': 0, 'evictions': 0})
+    stats[name] += 1
+
+
+  def ttl(self, resource):
+    return self.ttls.get(resource, self.default_ttl)
+
+
+  def get(self, resource, key):
+    """get the value from process memory
+
+    Returns:
+        tuple -- (found, value)
+    """
+    now = time.monotonic()
+    with self._lock:
+      entry = self._data.get((resource, key))
+      if entry is not None:
+        expires, value = entry
+        if now < expires:
+          self._data.move_to_end((resource, key))
+          self._count(resource, 'hits')
+          return True, value
+        del self._data[(resource, key)]
+      self._count(resource, 'misses')
+    return False, None
+
+
+  def set(self, resource, key, value, ttl=None, shared=True):
+    ttl = self.ttl(resource) if ttl is None else ttl
+    with self._lock:
+      self._data[(resource, key)] = (time.monotonic() + ttl, value)
+      self._data.move_to_end((resource, key))
+      while len(self._data) > self.maxsize:
+        (evicted, _), _ = self._data.popitem(last=False)
+        self._count(evicted, 'evictions')
+    if shared and self.backend is not None:
+      try:
+        self.backend.set(resource, key, value, ttl)
+      except Exception as e:  # pylint: disable=broad-except
+        logger.error("failed to set cache backend: %s", e)
+
+
+  def invalidate(self, resource, key):
+    with self._lock:
+      self._data.pop((resource, key), None)
+    if self.backend is not None:
+      try:
+        self.backend.delete(resource, key)
+      except Exception as e:  # pylint: disable=broad-except
+        logger.error("failed to delete cache backend: %s", e)
+
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+
+  def get_or_load(self, resource, key, loader):
+    """get the value from memory, backend, or loader in this order
+
+    None returned by the loader (failure of the rest api) is not cached.
+
+    Arguments:
+        resource {str} -- resource name, e.g. 'people'
+        key {str} -- identifier of the resource
+        loader {func} -- called with no argument on miss
+
+    Returns:
+        object -- cached or loaded value
+    """
+    found, value = self.get(resource, key)
+    if found:
+      return value
+
+    with self._lock:
+      flight = self._flights.get((resource, key))
+      leader = flight is None
+      if leader:
+        flight = _Flight()
+        self._flights[(resource, key)] = flight
+      else:
+        self._count(resource, 'coalesced')
+
+    if not leader:
+      flight.event.wait()
+      return flight.value
+
+    try:
+      value = self._load(resource, key, loader)
+      flight.value = value
+      return value
+    finally:
+      with self._lock:
+        self._flights.pop((resource, key), None)
+      flight.event.set()
+
+
+  def _load(self, resource, key, loader):
+    # pylint: disable=broad-except
+    if self.backend is not None:
+      try:
+        value, ttl = self.backend.get(resource, key)
+        if value is not None:
+          self.set(resource, key, value, ttl=ttl, shared=False)
+          with self._lock:
+            self._count(resource, 'backend_hits')
+          return value
+      except Exception as e:
+        logger.error("failed to get cache backend: %s", e)
+
+    value = loader()
+    with self._lock:
+      self._count(resource, 'loads')
+    if value is not None:
+      self.set(resource, key, value)
+    return value
+
+
+  def get_stats(self):
+    with self._lock:
+      result = {'size': len(self._data), 'maxsize': self.maxsize, 'resources': {}}
+      for resource, stats in self._stats.items():
+        stats = dict(stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        result['resources'][resource] = stats
+      return result
+
+
+if __name__ == '__main__':
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    cache = TTLCache(maxsize=100)
+    calls = []
+
+    def loader(person_id):
+      calls.append(person_id)
+      time.sleep(0.1)  # latency of the rest api
+      return {'id': person_id}
+
+    # 50 concurrent lookups of 5 people, single flight makes 5 upstream calls
+    with ThreadPoolExecutor(max_workers=50) as executor:
+      ids = ['person-{}'.format(i % 5) for i in range(50)]
+      list(executor.map(lambda i: cache.get_or_load('people', i, lambda: loader(i)), ids))
+    print('upstream calls: {}'.format(len(calls)))
+
+    for i in range(1000):
+      cache.get_or_load('people', 'person-{}'.format(i % 5), lambda: None)
+    print(json.dumps(cache.get_stats(), indent=2))
+    return 0
+
+  sys.exit(main())
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Cache of the bot identity (GET /v1/people/me)
+
+The result of /people/me rarely changes, but every new gunicorn worker
+had to call it on the first webhook event. This cache keeps it
+
+- in memory of the process
+- in redis (shared by all workers and hosts) or in a file (shared by workers on the host)
+
+and refreshes it in background before it expires.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class IdentityCache:
+
+  # delete the refresh lock only if this process still holds it
+  RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+  # seconds between the checks of the process which waits for the refresh by another process
+  MIN_BACKOFF = 1.0
+  MAX_BACKOFF = 60.0
+
+  def __init__(self, fetch, token, conn=None, path=None, ttl=86400, prefix='bot:identity', lock_ttl=120):
+    """constructor for IdentityCache
+
+    Arguments:
+        fetch {func} -- function returns the identity from the rest api, or None
+        token {str} -- bot token, identity is cached per token
+
+    Keyword Arguments:
+        conn {redis.StrictRedis} -- redis client, cache in redis if given (default: {None})
+        path {str} -- directory to store the cache file, used when conn is None (default: {None})
+        ttl {int} -- seconds to keep the identity (default: {86400})
+        prefix {str} -- prefix of redis key (default: {'bot:identity'})
+        lock_ttl {int} -- seconds of the refresh lock in redis, a few times the request timeout (default: {120})
+    """
+    self.fetch = fetch
+    self.conn = conn
+    self.ttl = ttl
+    self.lock_ttl = lock_ttl
+    self.node = '{}-{}'.format(socket.gethostname(), os.getpid())
+    self._release = conn.register_script(self.RELEASE_SCRIPT) if conn is not None else None
+
+    digest = hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+    self.key = '{}:{}'.format(prefix, digest)
+    self.lock_key = '{}:refresh'.format(self.key)
+    self.file_path = os.path.join(path, 'identity-{}.json'.format(digest)) if path else None
+
+    self._identity = None
+    self._expires = 0.0
+    self._lock = threading.Lock()
+    self._refresh_lock = threading.Lock()
+    self._pid = None
+
+    # metrics
+    self.hits = 0
+    self.fetches = 0
+
+
+  def _load_shared(self):
+    """load from redis or file
+
+    Returns:
+        tuple -- (identity, seconds to live), or (None, 0)
+    """
+    # pylint: disable=broad-except
+    try:
+      if self.conn is not None:
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.get(self.key)
+        pipe.ttl(self.key)
+        value, ttl = pipe.execute()
+        if value:
+          return json.loads(value), max(ttl, 0)
+      elif self.file_path and os.path.isfile(self.file_path):
+        age = time.time() - os.path.getmtime(self.file_path)
+        if age < self.ttl:
+          with open(self.file_path) as f:
+            return json.load(f), self.ttl - age
+    except Exception as e:
+      logger.error("failed to load identity cache: %s", e)
+    return None, 0
+
+
+  def _store_shared(self, identity):
+    # pylint: disable=broad-except
+    try:
+      if self.conn is not None:
+        self.conn.set(self.key, json.dumps(identity), ex=self.ttl)
+      elif self.file_path:
+        # write to temporary file, then rename it atomically
+        dir_name = os.path.dirname(self.file_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.identity-')
+        with os.fdopen(fd, 'w') as f:
+          json.dump(identity, f)
+        os.replace(tmp_path, self.file_path)
+    except Exception as e:
+      logger.error("failed to store identity cache: %s", e)
+
+
+  def _set(self, identity, ttl):
+    with self._lock:
+      self._identity = identity
+      self._expires = time.monotonic() + ttl
+
+
+  def _remaining(self):
+    with self._lock:
+      if self._identity is None:
+        return 0.0
+      return self._expires - time.monotonic()
+
+
+  def refresh(self, min_remaining=None):
+    """get the identity from the rest api and store it
+
+    concurrent callers wait for one fetch.
+
+    Keyword Arguments:
+        min_remaining {float} -- skip the fetch if the identity lives longer than this (default: {None})
+
+    Returns:
+        dict -- identity, or None
+    """
+    with self._refresh_lock:
+      if min_remaining is not None and self._remaining() > min_remaining:
+        return self._identity
+      identity = self.fetch()
+      with self._lock:
+        self.fetches += 1
+      if identity:
+        self._store_shared(identity)
+        self._set(identity, self.ttl)
+      return identity
+
+
+  def get(self):
+    """get the identity, from memory, redis/file, or rest api in this order
+
+    Returns:
+        dict -- identity, or None
+    """
+    self.start()
+    if self._remaining() > 0:
+      with self._lock:
+        self.hits += 1
+        return self._identity
+
+    identity, ttl = self._load_shared()
+    if identity:
+      self._set(identity, ttl)
+      with self._lock:
+        self.hits += 1
+      return identity
+
+    return self.refresh(min_remaining=0)
+
+
+  def _should_refresh(self):
+    """only one process refreshes at a time when redis is shared"""
+    # pylint: disable=broad-except
+    if self.conn is None:
+      return True
+    try:
+      return bool(self.conn.set(self.lock_key, self.node, nx=True, ex=self.lock_ttl))
+    except Exception as e:
+      logger.error("failed to lock identity refresh: %s", e)
+    return False
+
+
+  def _release_refresh(self):
+    # pylint: disable=broad-except
+    if self._release is None:
+      return
+    try:
+      self._release(keys=[self.lock_key], args=[self.node])
+    except Exception as e:
+      logger.error("failed to unlock identity refresh: %s", e)
+
+
+  def _run(self):
+    # pylint: disable=broad-except
+    # load at startup, then refresh when half of ttl has passed
+    backoff = self.MIN_BACKOFF
+    while True:
+      try:
+        remaining = self._remaining()
+        if remaining > self.ttl / 2:
+          time.sleep(remaining - self.ttl / 2)
+          continue
+        identity, ttl = self._load_shared()
+        if identity and ttl > self.ttl / 2:
+          self._set(identity, ttl)
+          backoff = self.MIN_BACKOFF
+          continue
+        if self._should_refresh():
+          try:
+            refreshed = self.refresh(min_remaining=self.ttl / 2)
+          finally:
+            # released also on failure, the next try is not blocked until the lock expires
+            self._release_refresh()
+          if refreshed is not None:
+            backoff = self.MIN_BACKOFF
+            continue
+        elif identity:
+          self._set(identity, ttl)
+      except Exception as e:
+        logger.exception(e)
+      # the fetch failed, or another process is refreshing, wait with exponential backoff and jitter
+      time.sleep(backoff * random.uniform(0.5, 1.0))
+      backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+
+  def start(self):
+    """start the background refresher in this process"""
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self.node = '{}-{}'.format(socket.gethostname(), os.getpid())
+    t = threading.Thread(target=self._run, name='identity-refresh', daemon=True)
+    t.start()
+
+
+  def get_stats(self):
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'fetches': self.fetches,
+        'ttl': round(max(0.0, self._expires - time.monotonic()), 1)
+      }
+
+
+if __name__ == '__main__':
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    def fetch():
+      time.sleep(0.3)  # latency of /people/me
+      return {'id': 'bot-id', 'displayName': 'bot'}
+
+    path = tempfile.mkdtemp()
+
+    # cold worker, the identity is fetched from the rest api
+    cache = IdentityCache(fetch, token='token', path=path, ttl=60)
+    start = time.perf_counter()
+    print(cache.get(), '{:.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+    # another worker, the identity is loaded from the file
+    cache = IdentityCache(fetch, token='token', path=path, ttl=60)
+    start = time.perf_counter()
+    print(cache.get(), '{:.1f} ms'.format((time.perf_counter() - start) * 1000))
+    print(cache.get_stats())
+    return 0
+
+  sys.exit(main())
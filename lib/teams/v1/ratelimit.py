@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Rate limit aware request scheduler for Webex Teams REST API
+
+- token bucket per endpoint family (messages, people, rooms, webhooks, ...)
+- Retry-After of 429 response pauses the family
+- jittered exponential backoff for retries
+- optional GCRA limiter in redis, shared by every process which uses the same bot token
+
+see, https://developer.webex.com/docs/api/basics/rate-limiting
+"""
+
+import email.utils
+import hashlib
+import logging
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+  def __init__(self, rate=10.0, capacity=20):
+    """constructor for TokenBucket
+
+    Keyword Arguments:
+        rate {float} -- tokens added per second (default: {10.0})
+        capacity {int} -- max number of tokens, size of the burst (default: {20})
+    """
+    self.rate = float(rate)
+    self.capacity = float(capacity)
+    self.tokens = float(capacity)
+    self.paused_until = 0.0
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+
+  def _refill(self, now):
+    elapsed = now - self._updated
+    if elapsed > 0:
+      self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+      self._updated = now
+
+
+  def reserve(self):
+    """take one token, and return seconds to wait before using it"""
+    with self._lock:
+      now = time.monotonic()
+      self._refill(now)
+      # tokens may go negative, which queues the callers in order
+      self.tokens -= 1.0
+      wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+      # while paused, refill starts at the end of the pause
+      return wait + max(0.0, self._updated - now)
+
+
+  def acquire(self):
+    """block until a token is available
+
+    Returns:
+        float -- seconds waited
+    """
+    wait = self.reserve()
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+
+  def pause(self, seconds):
+    """stop handing out tokens for seconds, e.g. Retry-After of 429 response"""
+    with self._lock:
+      now = time.monotonic()
+      self.paused_until = max(self.paused_until, now + seconds)
+      # tokens consumed while paused are lost
+      self._refill(now)
+      self.tokens = min(self.tokens, 0.0)
+      self._updated = self.paused_until
+
+
+  def available(self):
+    with self._lock:
+      self._refill(time.monotonic())
+      return self.tokens
+
+
+class RateLimitScheduler:
+
+  # (rate per second, burst) for each endpoint family
+  DEFAULT_LIMITS = {
+    'messages': (5.0, 10),
+    'people': (10.0, 20),
+    'rooms': (10.0, 20),
+    'webhooks': (2.0, 5),
+    'default': (10.0, 20)
+  }
+
+  def __init__(self, limits=None, max_retries=3, backoff_base=0.5, backoff_cap=30.0, global_limiter=None):
+    """constructor for RateLimitScheduler
+
+    Keyword Arguments:
+        limits {dict} -- family name -> (rate, burst), merged with DEFAULT_LIMITS (default: {None})
+        max_retries {int} -- max number of retries (default: {3})
+        backoff_base {float} -- base seconds of exponential backoff (default: {0.5})
+        backoff_cap {float} -- max seconds of exponential backoff (default: {30.0})
+        global_limiter {object} -- shared limiter with acquire(family) method, consulted after the local bucket (default: {None})
+    """
+    merged = dict(self.DEFAULT_LIMITS)
+    merged.update(limits or {})
+    self.buckets = {name: TokenBucket(rate=rate, capacity=burst) for name, (rate, burst) in merged.items()}
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_cap = backoff_cap
+    self.global_limiter = global_limiter
+
+    self._lock = threading.Lock()
+    self.requests = {}
+    self.throttled = {}
+    self.retries = {}
+    self.waited = {}
+
+
+  def family(self, api_path):
+    """endpoint family of the api path, e.g. https://api.ciscospark.com/v1/messages/xxx -> messages"""
+    parts = [p for p in urlsplit(api_path).path.split('/') if p]
+    # skip version prefix, v1
+    if parts and parts[0].startswith('v') and parts[0][1:].isdigit():
+      parts = parts[1:]
+    name = parts[0] if parts else 'default'
+    return name if name in self.buckets else 'default'
+
+
+  def _count(self, counter, family, value=1):
+    with self._lock:
+      counter[family] = counter.get(family, 0) + value
+
+
+  def acquire(self, family):
+    """wait for the budget of the family"""
+    waited = self.buckets.get(family, self.buckets['default']).acquire()
+    if self.global_limiter is not None:
+      waited += self.global_limiter.acquire(family)
+    self._count(self.requests, family)
+    if waited > 0:
+      self._count(self.waited, family, waited)
+
+
+  def on_throttled(self, family, retry_after=None, attempt=0):
+    """429 is received, pause the family
+
+    Returns:
+        float -- seconds to wait before retry
+    """
+    wait = retry_after if retry_after is not None else self.backoff(attempt)
+    self.buckets.get(family, self.buckets['default']).pause(wait)
+    if self.global_limiter is not None:
+      # other processes stop sending too
+      self.global_limiter.pause(family, wait)
+    self._count(self.throttled, family)
+    logger.warning("rate limited: %s, retry after %.1f sec", family, wait)
+    return wait
+
+
+  def on_retry(self, family):
+    self._count(self.retries, family)
+
+
+  def backoff(self, attempt):
+    """full jitter exponential backoff"""
+    return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+
+  @staticmethod
+  def parse_retry_after(value):
+    """Retry-After header is seconds or http date
+
+    Returns:
+        float -- seconds, or None
+    """
+    if value is None:
+      return None
+    try:
+      return max(0.0, float(value))
+    except ValueError:
+      pass
+    try:
+      retry_at = email.utils.parsedate_to_datetime(value)
+      return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+      return None
+
+
+  def get_stats(self):
+    with self._lock:
+      stats = {}
+      for name, bucket in self.buckets.items():
+        stats[name] = {
+          'rate': bucket.rate,
+          'burst': bucket.capacity,
+          'available': round(bucket.available(), 2),
+          'requests': self.requests.get(name, 0),
+          'throttled': self.throttled.get(name, 0),
+          'retries': self.retries.get(name, 0),
+          'waited_sec': round(self.waited.get(name, 0.0), 3)
+        }
+      return stats
+
+
+class RedisRateLimiter:
+  """GCRA (generic cell rate algorithm) limiter in redis
+
+  theoretical arrival time (TAT) of each family is stored in redis,
+  and updated by lua script atomically, so the aggregate rate of all processes
+  (gunicorn workers on any hosts) which share the bot token stays under the limit.
+
+  the clock of redis server (TIME) is used, clocks of hosts do not matter.
+  """
+
+  # KEYS[1]: key of TAT
+  # ARGV[1]: emission interval in ms, ARGV[2]: burst tolerance in ms
+  # returns ms to wait before sending
+  RESERVE_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval
+redis.call('SET', KEYS[1], new_tat, 'PX', math.ceil(new_tat - now + tolerance))
+local wait = new_tat - tolerance - now
+if wait < 0 then wait = 0 end
+return wait
+"""
+
+  # KEYS[1]: key of TAT
+  # ARGV[1]: ms to pause, ARGV[2]: burst tolerance in ms
+  PAUSE_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local until_tat = now + tonumber(ARGV[1]) + tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < until_tat then
+  redis.call('SET', KEYS[1], until_tat, 'PX', math.ceil(until_tat - now + tonumber(ARGV[2])))
+end
+return 0
+"""
+
+  def __init__(self, conn, token, limits=None, prefix='bot:ratelimit'):
+    """constructor for RedisRateLimiter
+
+    Arguments:
+        conn {redis.StrictRedis} -- redis client
+        token {str} -- bot token, the limit is shared by every process with this token
+
+    Keyword Arguments:
+        limits {dict} -- family name -> (rate, burst), merged with RateLimitScheduler.DEFAULT_LIMITS (default: {None})
+        prefix {str} -- prefix of redis keys (default: {'bot:ratelimit'})
+    """
+    self.conn = conn
+    merged = dict(RateLimitScheduler.DEFAULT_LIMITS)
+    merged.update(limits or {})
+    self.limits = merged
+    # do not store the token itself in redis
+    digest = hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+    self.key_prefix = '{}:{}'.format(prefix, digest)
+    self._reserve = conn.register_script(self.RESERVE_SCRIPT)
+    self._pause = conn.register_script(self.PAUSE_SCRIPT)
+
+
+  def _params(self, family):
+    rate, burst = self.limits.get(family, self.limits['default'])
+    interval = 1000.0 / rate
+    return '{}:{}'.format(self.key_prefix, family), interval, interval * burst
+
+
+  def acquire(self, family):
+    """reserve one request of the family, and wait for it
+
+    redis errors are logged and ignored, local token bucket still limits the rate.
+
+    Returns:
+        float -- seconds waited
+    """
+    # pylint: disable=broad-except
+    key, interval, tolerance = self._params(family)
+    try:
+      wait = float(self._reserve(keys=[key], args=[interval, tolerance])) / 1000.0
+    except Exception as e:
+      logger.error("global rate limiter is not available: %s", e)
+      return 0.0
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+
+  def pause(self, family, seconds):
+    # pylint: disable=broad-except
+    key, _, tolerance = self._params(family)
+    try:
+      self._pause(keys=[key], args=[int(seconds * 1000), tolerance])
+    except Exception as e:
+      logger.error("global rate limiter is not available: %s", e)
+
+
+if __name__ == '__main__':
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    scheduler = RateLimitScheduler(limits={'messages': (5.0, 3)})
+    family = scheduler.family('https://api.ciscospark.com/v1/messages/')
+
+    start = time.perf_counter()
+    for i in range(10):
+      scheduler.acquire(family)
+      print('{:2d} {:6.3f} sec'.format(i, time.perf_counter() - start))
+      if i == 5:
+        scheduler.on_throttled(family, retry_after=1.0)
+
+    print(scheduler.get_stats()[family])
+    return 0
+
+  sys.exit(main())
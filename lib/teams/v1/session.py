@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Pooled HTTP session for Webex Teams REST API
+
+- Keep-alive connections shared by every call of the Bot
+- Per-host pool sizing
+- Pool exhaustion and connection reuse metrics
+
+requests.Session is not thread safe about cookies, so cookies are never stored.
+Connection pools of urllib3 are guarded by locks, so one PooledSession can be
+shared by threads (or greenlets in gunicorn gevent workers).
+
+Environment variables:
+  - bot_pool_connections: number of host pools to keep (default: 10)
+  - bot_pool_maxsize: max connections per host (default: 10)
+  - bot_pool_block: wait for a free connection when the pool is full (default: 1)
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+requests.packages.urllib3.disable_warnings()
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+  value = os.getenv(name)
+  if value is None or value.strip() == '':
+    return default
+  try:
+    return int(value)
+  except ValueError:
+    logger.error("invalid integer in environment variable %s: %s", name, value)
+  return default
+
+
+class _InstrumentedAdapter(HTTPAdapter):
+  """HTTPAdapter which counts in-flight requests per host"""
+
+  def __init__(self, stats=None, **kwargs):
+    self.stats = stats
+    super().__init__(**kwargs)
+
+
+  def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+    host = urlsplit(request.url).netloc
+    self.stats.begin(host, self._pool_maxsize)
+    try:
+      return super().send(request, **kwargs)
+    finally:
+      self.stats.end(host)
+
+
+class PoolStats:
+  """Thread safe counters of the PooledSession"""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.errors = 0
+    self.exhausted = 0
+    self.in_flight = {}
+    self.max_in_flight = {}
+
+
+  def begin(self, host, maxsize):
+    with self._lock:
+      self.requests += 1
+      in_flight = self.in_flight.get(host, 0)
+      if in_flight >= maxsize:
+        # every connection for this host is in use,
+        # the request waits for (or overflows) the pool
+        self.exhausted += 1
+      in_flight += 1
+      self.in_flight[host] = in_flight
+      if in_flight > self.max_in_flight.get(host, 0):
+        self.max_in_flight[host] = in_flight
+
+
+  def end(self, host):
+    with self._lock:
+      self.in_flight[host] = self.in_flight.get(host, 1) - 1
+
+
+  def error(self):
+    with self._lock:
+      self.errors += 1
+
+
+class PooledSession:
+  """requests.Session with keep-alive connection pools per host"""
+
+  def __init__(self, pool_connections=None, pool_maxsize=None, pool_block=None, host_pool_maxsize=None):
+    """constructor for PooledSession
+
+    Keyword Arguments:
+        pool_connections {int} -- number of host pools to cache (default: {None})
+        pool_maxsize {int} -- max connections kept alive per host (default: {None})
+        pool_block {bool} -- wait for a free connection when the pool is full (default: {None})
+        host_pool_maxsize {dict} -- per host pool_maxsize, e.g. {'api.ciscospark.com': 20} (default: {None})
+    """
+    self.pool_connections = _env_int('bot_pool_connections', 10) if pool_connections is None else pool_connections
+    self.pool_maxsize = _env_int('bot_pool_maxsize', 10) if pool_maxsize is None else pool_maxsize
+    self.pool_block = bool(_env_int('bot_pool_block', 1)) if pool_block is None else pool_block
+
+    self.stats = PoolStats()
+
+    self.session = requests.Session()
+    self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    self.adapters = []
+    self.mount('http://', self.pool_maxsize)
+    self.mount('https://', self.pool_maxsize)
+    for host, maxsize in (host_pool_maxsize or {}).items():
+      self.mount('https://{}/'.format(host), maxsize)
+      self.mount('http://{}/'.format(host), maxsize)
+
+
+  def mount(self, prefix, pool_maxsize):
+    adapter = _InstrumentedAdapter(
+      stats=self.stats,
+      pool_connections=self.pool_connections,
+      pool_maxsize=pool_maxsize,
+      pool_block=self.pool_block)
+    self.session.mount(prefix, adapter)
+    self.adapters.append(adapter)
+
+
+  def request(self, method, url, **kwargs):
+    try:
+      return self.session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+      self.stats.error()
+      raise
+
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+
+  def put(self, url, **kwargs):
+    return self.request('PUT', url, **kwargs)
+
+
+  def delete(self, url, **kwargs):
+    return self.request('DELETE', url, **kwargs)
+
+
+  def close(self):
+    self.session.close()
+
+
+  def get_stats(self):
+    """Get metrics of the connection pools
+
+    Returns:
+        dict -- counters, and per host connections/requests
+    """
+    hosts = {}
+    for adapter in self.adapters:
+      for key in adapter.poolmanager.pools.keys():
+        pool = adapter.poolmanager.pools.get(key)
+        if pool is None:
+          continue
+        host = '{}:{}'.format(pool.host, pool.port)
+        h = hosts.setdefault(host, {'connections': 0, 'requests': 0, 'idle': 0})
+        h['connections'] += pool.num_connections  # number of TCP (and TLS) handshakes
+        h['requests'] += pool.num_requests
+        h['idle'] += pool.pool.qsize() if pool.pool is not None else 0
+
+    with self.stats._lock:  # pylint: disable=protected-access
+      return {
+        'requests': self.stats.requests,
+        'errors': self.stats.errors,
+        'exhausted': self.stats.exhausted,
+        'in_flight': dict(self.stats.in_flight),
+        'max_in_flight': dict(self.stats.max_in_flight),
+        'hosts': hosts
+      }
+
+
+if __name__ == '__main__':
+
+  import argparse
+  import json
+  from concurrent.futures import ThreadPoolExecutor
+  from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+  logging.basicConfig(level=logging.WARNING)
+
+  class StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive requires HTTP/1.1 and Content-Length
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      body = b'{"id": "stand-in"}'
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      pass
+
+
+  def run(get, url, count, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      list(executor.map(lambda _: get(url, timeout=(10.0, 30.0)).json(), range(count)))
+    return count / (time.perf_counter() - start)
+
+
+  def main():
+    parser = argparse.ArgumentParser(description='measure throughput of PooledSession against a local stand-in server.')
+    parser.add_argument('-n', '--count', type=int, default=2000, help='number of requests')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='number of concurrent requests')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/v1/people/me'.format(server.server_address[1])
+
+    rps = run(requests.get, url, args.count, args.concurrency)
+    print('requests.get  : {:8.1f} req/s'.format(rps))
+
+    pooled = PooledSession(pool_maxsize=args.concurrency)
+    rps = run(pooled.get, url, args.count, args.concurrency)
+    print('PooledSession : {:8.1f} req/s'.format(rps))
+    print(json.dumps(pooled.get_stats(), indent=2))
+
+    pooled.close()
+    server.shutdown()
+    return 0
+
+  sys.exit(main())
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Streaming upload of files for Webex Teams messages
+
+- the multipart body is streamed by MultipartEncoder, the file is never read at once
+- files are mapped with mmap (or read in chunks), bytes and generators of bytes are also accepted
+- generators without size are spooled, in memory up to spool_size and to a temporary file beyond it
+- every source is closed deterministically, use it with the with statement or call close()
+- the content type is guessed from the file name, then from the first bytes of the content
+- Uploader sends several files concurrently, progress is reported by a callback
+
+The body could not be sent twice, so Bot._request() does not retry it.
+
+SEE
+https://developer.webex.com/docs/api/basics/message-attachments
+"""
+
+import logging
+import mimetypes
+import mmap
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+# magic bytes of the content -> content type
+SIGNATURES = (
+  (b'\x89PNG\r\n\x1a\n', 'image/png'),
+  (b'\xff\xd8\xff', 'image/jpeg'),
+  (b'GIF87a', 'image/gif'),
+  (b'GIF89a', 'image/gif'),
+  (b'BM', 'image/bmp'),
+  (b'%PDF-', 'application/pdf'),
+  (b'PK\x03\x04', 'application/zip')
+)
+
+
+def guess_content_type(filename=None, head=b''):
+  """guess the content type from the file name, then from the first bytes
+
+  Keyword Arguments:
+      filename {str} -- name of the file (default: {None})
+      head {bytes} -- first bytes of the content, 16 bytes are enough (default: {b''})
+
+  Returns:
+      str -- content type, application/octet-stream if unknown
+  """
+  if filename:
+    content_type = mimetypes.guess_type(filename)[0]
+    if content_type:
+      return content_type
+  head = bytes(head[:16])
+  if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+    return 'image/webp'
+  for signature, content_type in SIGNATURES:
+    if head.startswith(signature):
+      return content_type
+  return DEFAULT_CONTENT_TYPE
+
+
+class _Reader:
+  """file-like object for MultipartEncoder
+
+  len is the number of bytes left, MultipartEncoder reads the part while it is positive.
+  """
+
+  def __init__(self, read, size):
+    self._read = read
+    self.size = size
+    self.position = 0
+
+
+  @property
+  def len(self):
+    return self.size - self.position
+
+
+  def read(self, length=-1):
+    if length is None or length < 0 or length > self.len:
+      length = self.len
+    data = self._read(length)
+    if not data and length > 0:
+      raise IOError("content ended at {} of {} bytes".format(self.position, self.size))
+    self.position += len(data)
+    return data
+
+
+class _ChunkIterator:
+  """read() of the generator of bytes"""
+
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.buffer = b''
+
+
+  def read(self, length):
+    while len(self.buffer) < length:
+      chunk = next(self.chunks, None)
+      if chunk is None:
+        break
+      self.buffer += chunk
+    data, self.buffer = self.buffer[:length], self.buffer[length:]
+    return data
+
+
+class UploadSource:
+
+  def __init__(self, filename, content_type=None):
+    self.filename = filename
+    self.content_type = content_type
+    self._closers = []
+
+
+  def open(self):
+    """Returns:
+        object -- body of the part, with read() and len
+    """
+    raise NotImplementedError
+
+
+  def close(self):
+    # pylint: disable=broad-except
+    while self._closers:
+      close = self._closers.pop()
+      try:
+        close()
+      except Exception as e:
+        logger.error("failed to close %s: %s", self.filename, e)
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+class FileSource(UploadSource):
+
+  def __init__(self, path, filename=None, content_type=None, use_mmap=True):
+    """file on the disk
+
+    Arguments:
+        path {str} -- path of the file
+
+    Keyword Arguments:
+        filename {str} -- name of the file in the message (default: {basename of the path})
+        content_type {str} -- content type, guessed if None (default: {None})
+        use_mmap {bool} -- map the file instead of reading it in chunks (default: {True})
+    """
+    super().__init__(filename or os.path.basename(path), content_type)
+    self.path = path
+    self.use_mmap = use_mmap
+
+
+  def open(self):
+    f = open(self.path, 'rb')
+    self._closers.append(f.close)
+    if self.content_type is None:
+      self.content_type = guess_content_type(self.filename, f.read(16))
+      f.seek(0)
+    size = os.fstat(f.fileno()).st_size
+    if not self.use_mmap or size == 0:
+      # empty file could not be mapped
+      return f
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._closers.append(m.close)
+    return _Reader(m.read, size)
+
+
+class BytesSource(UploadSource):
+
+  def __init__(self, data, filename='file', content_type=None):
+    """content in memory
+
+    Arguments:
+        data {bytes} -- content
+    """
+    super().__init__(filename, content_type)
+    self.data = data
+
+
+  def open(self):
+    if self.content_type is None:
+      self.content_type = guess_content_type(self.filename, self.data[:16])
+    view = memoryview(self.data)
+    self._closers.append(view.release)
+    position = [0]
+
+    def read(length):
+      data = view[position[0]:position[0] + length].tobytes()
+      position[0] += len(data)
+      return data
+    return _Reader(read, len(view))
+
+
+class StreamSource(UploadSource):
+
+  def __init__(self, chunks, filename='file', content_type=None, size=None, spool_size=1024 * 1024):
+    """content from the generator of bytes
+
+    Arguments:
+        chunks {iterable} -- bytes of the content
+
+    Keyword Arguments:
+        size {int} -- size of the content, spooled to know the size if None (default: {None})
+        spool_size {int} -- bytes kept in memory when spooled, the rest goes to a temporary file (default: {1048576})
+    """
+    super().__init__(filename, content_type)
+    self.chunks = chunks
+    self.size = size
+    self.spool_size = spool_size
+
+
+  def open(self):
+    if hasattr(self.chunks, 'close'):
+      self._closers.append(self.chunks.close)
+    source = _ChunkIterator(self.chunks)
+    head = source.read(16)
+    if self.content_type is None:
+      self.content_type = guess_content_type(self.filename, head)
+
+    if self.size is not None:
+      source.buffer = head + source.buffer
+      return _Reader(source.read, self.size)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+    self._closers.append(spool.close)
+    size = spool.write(head)
+    while True:
+      data = source.read(64 * 1024)
+      if not data:
+        break
+      size += spool.write(data)
+    spool.seek(0)
+    return _Reader(spool.read, size)
+
+
+def as_source(content, filename=None, content_type=None):
+  """Returns:
+      UploadSource -- source of the path, bytes, or generator of bytes
+  """
+  if isinstance(content, UploadSource):
+    return content
+  if isinstance(content, (str, os.PathLike)):
+    return FileSource(os.fspath(content), filename=filename, content_type=content_type)
+  if isinstance(content, (bytes, bytearray, memoryview)):
+    return BytesSource(content, filename=filename or 'file', content_type=content_type)
+  return StreamSource(content, filename=filename or 'file', content_type=content_type)
+
+
+def encode_multipart(fields, source, progress=None, step=64 * 1024):
+  """multipart body of the message with the file
+
+  Arguments:
+      fields {dict} -- fields of the message, e.g. text and roomId
+      source {UploadSource} -- opened here, and closed by the caller
+
+  Keyword Arguments:
+      progress {func} -- called with (filename, bytes sent, total bytes) (default: {None})
+      step {int} -- bytes between the calls of progress (default: {65536})
+
+  Returns:
+      tuple -- (body, content type of the body)
+  """
+  body = source.open()
+  form = dict(fields)
+  form['files'] = (source.filename, body, source.content_type)
+  encoder = MultipartEncoder(form)
+  if progress is None:
+    return encoder, encoder.content_type
+
+  last = [0]
+
+  def callback(monitor):
+    if monitor.bytes_read - last[0] >= step or monitor.bytes_read >= monitor.len > last[0]:
+      last[0] = monitor.bytes_read
+      progress(source.filename, monitor.bytes_read, monitor.len)
+  return MultipartEncoderMonitor(encoder, callback), encoder.content_type
+
+
+class Uploader:
+
+  def __init__(self, bot, concurrency=4):
+    """send files concurrently
+
+    Arguments:
+        bot {Bot} -- bot to send the files
+
+    Keyword Arguments:
+        concurrency {int} -- number of files sent at the same time (default: {4})
+    """
+    self.bot = bot
+    self.concurrency = concurrency
+    self._lock = threading.Lock()
+
+    # metrics
+    self.sent = 0
+    self.failed = 0
+    self.bytes_sent = 0
+
+
+  def send(self, content, filename=None, content_type=None, progress=None, **kwargs):
+    """send a message with the file
+
+    Arguments:
+        content {str, bytes or iterable} -- path, bytes, generator of bytes, or UploadSource
+
+    Keyword Arguments:
+        progress {func} -- called with (filename, bytes sent, total bytes) (default: {None})
+        kwargs -- text, room_id, to_person_id or to_person_email of Bot.send_file()
+
+    Returns:
+        dict -- post response, or None
+    """
+    sent = [0]
+
+    def count(name, done, total):
+      sent[0] = done
+      if progress is not None:
+        progress(name, done, total)
+
+    with as_source(content, filename=filename, content_type=content_type) as source:
+      result = self.bot.send_file(source=source, progress=count, **kwargs)
+    with self._lock:
+      if result:
+        self.sent += 1
+      else:
+        self.failed += 1
+      self.bytes_sent += sent[0]
+    return result
+
+
+  def send_many(self, items, progress=None):
+    """send the files concurrently, one message per file
+
+    Arguments:
+        items {list} -- dicts of the arguments of send(), e.g. {'content': 'a.png', 'room_id': '...'}
+
+    Keyword Arguments:
+        progress {func} -- called with (filename, bytes sent, total bytes) of every file (default: {None})
+
+    Returns:
+        list -- post responses in the order of items, None if failed
+    """
+    # pylint: disable=broad-except
+    def send(item):
+      try:
+        return self.send(progress=progress, **item)
+      except Exception as e:
+        logger.exception(e)
+        with self._lock:
+          self.failed += 1
+        return None
+
+    items = list(items)
+    if not items:
+      return []
+    with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items)), thread_name_prefix='upload') as executor:
+      return list(executor.map(send, items))
+
+
+  def get_stats(self):
+    with self._lock:
+      return {'sent': self.sent, 'failed': self.failed, 'bytes_sent': self.bytes_sent}
+
+
+if __name__ == '__main__':
+
+  import time
+  import tracemalloc
+  from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+  import requests
+
+  logging.basicConfig(level=logging.INFO)
+
+  class DiscardHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):  # pylint: disable=invalid-name
+      left = int(self.headers.get('Content-Length', 0))
+      while left > 0:
+        left -= len(self.rfile.read(min(left, 1024 * 1024)))
+      body = b'{"id": "message"}'
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      pass
+
+  class FakeBot:
+    """Bot.send_file() without the token"""
+
+    def __init__(self, url):
+      self.url = url
+      self.session = requests.Session()
+
+    def send_file(self, text=None, source=None, progress=None, **kwargs):
+      body, content_type = encode_multipart({'text': text or 'file'}, source, progress=progress)
+      return self.session.post(self.url, data=body, headers={'content-type': content_type}).json()
+
+  def open_files(directory):
+    # keep-alive sockets are also open, count the files only
+    if not os.path.isdir('/proc/self/fd'):
+      return -1
+    paths = []
+    for fd in os.listdir('/proc/self/fd'):
+      try:
+        paths.append(os.readlink(os.path.join('/proc/self/fd', fd)))
+      except OSError:
+        pass
+    return sum(1 for path in paths if path.startswith(directory))
+
+  def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DiscardHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    uploader = Uploader(FakeBot('http://127.0.0.1:{}/messages'.format(server.server_address[1])))
+
+    with tempfile.TemporaryDirectory() as tmp:
+      paths = []
+      for n, size in enumerate([10, 100, 200]):
+        path = os.path.join(tmp, 'image-{}.png'.format(n))
+        with open(path, 'wb') as f:
+          f.write(b'\x89PNG\r\n\x1a\n')
+          f.truncate(size * 1024 * 1024)
+        paths.append(path)
+
+      tracemalloc.start()
+      start = time.perf_counter()
+      results = uploader.send_many(
+        [{'content': p, 'room_id': 'room'} for p in paths] +
+        [{'content': (b'x' * 65536 for _ in range(160)), 'filename': 'stream.bin', 'room_id': 'room'}],
+        progress=lambda name, done, total: done == total and print('{} {} bytes'.format(name, total)))
+      elapsed = time.perf_counter() - start
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+
+      print(results)
+      print('{} MB in {:.2f} sec, peak python memory {:.1f} MB, open files {}'.format(
+        uploader.get_stats()['bytes_sent'] // (1024 * 1024), elapsed, peak / 1024 / 1024, open_files(tmp)))
+      print(guess_content_type('a.jpg'), guess_content_type(None, b'%PDF-1.4'), guess_content_type('noext', b'\xff\xd8\xff\xe0'))
+    server.shutdown()
+    return 0
+
+  sys.exit(main())
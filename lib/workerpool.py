@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+"""Bounded worker pool for webhook events
+
+The webhook handler enqueues the event and returns immediately,
+then workers in this pool drain the queue.
+
+- concurrency: number of workers
+- maxsize: capacity of the queue, submit() waits put_timeout seconds when the queue is full (backpressure)
+- metrics: queue depth, wait time in the queue, and processing time
+
+Workers are threads, in gunicorn gevent workers they are greenlets (threading is monkey patched).
+"""
+
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Latency:
+  """count, average and max of durations in seconds"""
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+
+  def add(self, value):
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+
+  def as_dict(self):
+    return {
+      'count': self.count,
+      'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+      'max_ms': round(self.max * 1000, 3)
+    }
+
+
+class WorkerPool:
+
+  def __init__(self, concurrency=4, maxsize=1000, put_timeout=1.0, name='worker'):
+    """constructor for WorkerPool
+
+    Keyword Arguments:
+        concurrency {int} -- number of workers (default: {4})
+        maxsize {int} -- capacity of the queue (default: {1000})
+        put_timeout {float} -- seconds to wait for a free slot when the queue is full (default: {1.0})
+        name {str} -- name of the pool, used as thread name (default: {'worker'})
+    """
+    self.concurrency = concurrency
+    self.maxsize = maxsize
+    self.put_timeout = put_timeout
+    self.name = name
+
+    self._queue = queue.Queue(maxsize=maxsize)
+    self._lock = threading.Lock()
+    self._workers = []
+    self._pid = None
+
+    # metrics
+    self.submitted = 0
+    self.processed = 0
+    self.failed = 0
+    self.rejected = 0
+    self.max_depth = 0
+    self.wait_latency = _Latency()
+    self.run_latency = _Latency()
+
+
+  def start(self):
+    """start workers, if not started in this process
+
+    gunicorn forks workers after the app is loaded with preload_app,
+    so threads are (re)started lazily in each process.
+    """
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self._workers = []
+      for i in range(self.concurrency):
+        t = threading.Thread(target=self._run, name='{}-{}'.format(self.name, i), daemon=True)
+        t.start()
+        self._workers.append(t)
+      logger.info("%s: started %d workers", self.name, self.concurrency)
+
+
+  def submit(self, func, *args, **kwargs):
+    """enqueue func(*args, **kwargs)
+
+    Returns:
+        bool -- False if the queue stays full for put_timeout seconds
+    """
+    self.start()
+    item = (time.perf_counter(), func, args, kwargs)
+    try:
+      self._queue.put(item, timeout=self.put_timeout)
+    except queue.Full:
+      with self._lock:
+        self.rejected += 1
+      logger.error("%s: queue is full, rejected %s", self.name, getattr(func, '__name__', func))
+      return False
+
+    with self._lock:
+      self.submitted += 1
+      depth = self._queue.qsize()
+      if depth > self.max_depth:
+        self.max_depth = depth
+    return True
+
+
+  def _run(self):
+    # pylint: disable=broad-except
+    while True:
+      item = self._queue.get()
+      if item is None:
+        self._queue.task_done()
+        return
+      enqueued, func, args, kwargs = item
+      started = time.perf_counter()
+      failed = False
+      try:
+        func(*args, **kwargs)
+      except Exception as e:
+        failed = True
+        logger.exception(e)
+      finished = time.perf_counter()
+      with self._lock:
+        self.processed += 1
+        if failed:
+          self.failed += 1
+        self.wait_latency.add(started - enqueued)
+        self.run_latency.add(finished - started)
+      self._queue.task_done()
+
+
+  def join(self):
+    """block until all queued items are processed"""
+    self._queue.join()
+
+
+  def stop(self, timeout=None):
+    """process queued items, then stop workers"""
+    with self._lock:
+      workers = list(self._workers) if self._pid == os.getpid() else []
+      self._pid = None
+    for _ in workers:
+      self._queue.put(None)
+    for t in workers:
+      t.join(timeout)
+
+
+  def get_stats(self):
+    with self._lock:
+      return {
+        'concurrency': self.concurrency,
+        'maxsize': self.maxsize,
+        'depth': self._queue.qsize(),
+        'max_depth': self.max_depth,
+        'submitted': self.submitted,
+        'processed': self.processed,
+        'failed': self.failed,
+        'rejected': self.rejected,
+        'wait': self.wait_latency.as_dict(),
+        'run': self.run_latency.as_dict()
+      }
+
+
+if __name__ == '__main__':
+
+  import json
+
+  logging.basicConfig(level=logging.INFO)
+
+  def main():
+    pool = WorkerPool(concurrency=8, maxsize=100, name='test')
+
+    def slow_task(n):
+      time.sleep(0.05)
+      return n
+
+    start = time.perf_counter()
+    for n in range(200):
+      pool.submit(slow_task, n)
+    print('submit 200 tasks: {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+    pool.join()
+    print('processed 200 tasks: {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+    print(json.dumps(pool.get_stats(), indent=2))
+
+    pool.stop()
+    return 0
+
+  sys.exit(main())
@@ -2,15 +2,12 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=missing-docstring
 
+import argparse
 import json
 import logging
 import os
 import sys
 
-from jinja2 import Environment, FileSystemLoader
-
-import redis
-
 import requests
 requests.packages.urllib3.disable_warnings()
 
@@ -22,7 +19,13 @@ def here(path=''):
 if not here('./lib') in sys.path:
   sys.path.append(here('./lib'))
 
-from botscript import bot, redis_url
+from botscript import bot, card_state
+from broadcast import get_broadcast_scheduler
+from bulksend import send_file
+from cardbuilder import get_builder
+from cardengine import get_engine
+from cardstore import get_repository
+from forecast import get_forecast_cache
 
 # name and directory path of this application
 app_name = os.path.splitext(os.path.basename(__file__))[0]
@@ -49,8 +52,10 @@ def send_card(text=None, card_name=None, to_person_email=None):
   if to_person_email:
     kwargs.update({'to_person_email': to_person_email})
 
-  contents = get_card_content(card_name)
+  # json bytes of the card are embedded in the request as they are
+  contents = get_repository().get_bytes(card_name)
   if contents is None:
+    logger.error("card is not found: %s", card_name)
     return None
   kwargs.update({'attachments': [contents]})
 
@@ -61,6 +66,41 @@ def send_image(text=None, image_filename=None, to_person_email=None):
   return bot.send_image(text=text, image_filename=image_filename, to_person_email=to_person_email)
 
 
+def send_bulk(path, text=None, card_name=None, file_format=None, concurrency=8, retries=3, restart=False):
+  """send the text and/or card to every recipient in the CSV or JSONL file
+
+  {{ name }} in the text and .j2 cards are filled with the columns of the recipient.
+  progress is saved in {path}.checkpoint, and the run resumes from it unless restart is True.
+
+  Returns:
+      dict -- stats of the run
+  """
+  return send_file(
+    bot, path,
+    text=text,
+    card_name=card_name,
+    file_format=file_format,
+    resume=not restart,
+    concurrency=concurrency,
+    retries=retries)
+
+
+def set_broadcast(action, job_id='morning', cron=None):
+  """enable, disable or show the scheduled broadcast for all hosts, see lib/broadcast.py
+
+  Returns:
+      dict -- the job, None if it does not exist
+  """
+  scheduler = get_broadcast_scheduler()
+  if action == 'enable':
+    if scheduler.get_job(job_id) is None:
+      scheduler.add_job(job_id, cron or os.environ.get('bot_broadcast_cron', '0 7 * * *'))
+    scheduler.enable_job(job_id)
+  elif action == 'disable':
+    scheduler.disable_job(job_id)
+  return next((j for j in scheduler.get_jobs() if j['id'] == job_id), None)
+
+
 def store_message(send_result):
   if send_result is not None:
     if 'attachments' in send_result:
@@ -69,42 +109,28 @@ def store_message(send_result):
 
     message_id = send_result.get('id')
 
-    conn = redis.StrictRedis.from_url(redis_url, decode_responses=True)
-
-    # store as hash
-    conn.hmset(message_id, send_result)
-    conn.expire(message_id, 600)  # time to live is 10 min
-
-
-def show_redis_message_list():
-  conn = redis.StrictRedis.from_url(redis_url, decode_responses=True)
+    # store as hash, time to live is 10 min
+    card_state.store_card(message_id, send_result, ttl=600)
 
-  # show keys in db
-  keys = conn.keys(pattern='*')
-  for k in keys:
-    print(k)
 
-  # show values in db
-  for k in keys:
-    data = conn.hgetall(k)
+def show_redis_message_list(max_items=100, before=None):
+  # newest cards first, paged with the sorted set index instead of KEYS
+  last = None
+  for message_id, sent, data in card_state.iter_cards(max_items=max_items, before=before):
+    print(card_state.card_key(message_id))
     print(json.dumps(data, ensure_ascii=False, indent=2))
+    last = sent
+
+  # pass this as before= to show the next page
+  return last
 
 
 def get_card_content(card_name):
-  card_path = os.path.join(card_dir, card_name)
-  if not os.path.isfile(card_path):
-    logger.error("card file is not found: %s", card_path)
-    return None
-  try:
-    with open(card_path) as f:
-      card = json.load(f)
-    return {
-      'contentType': "application/vnd.microsoft.card.adaptive",
-      'content': card
-    }
-  except (IOError, json.JSONDecodeError) as e:
-    logger.exception(e)
-  return None
+  # preloaded and validated, no disk access
+  contents = get_repository().get(card_name)
+  if contents is None:
+    logger.error("card is not found: %s", card_name)
+  return contents
 
 
 def send_weather_card(to_person_email=None):
@@ -122,15 +148,17 @@ def send_weather_card(to_person_email=None):
 
 
 def get_weather_card():
-  env = Environment(loader=FileSystemLoader(card_dir))
-  template = env.get_template('weather.j2')
-
   data = get_weather_data()
   if data is None:
     return None
 
-  rendered = template.render(data)
-  content = json.loads(rendered)
+  # slots are filled into the serialized card, no render and json.loads round trip
+  builder = get_builder('weather.j2')
+  if builder is not None:
+    return builder.build_attachment_bytes(data)
+
+  # template with jinja2 syntax which the builder does not support
+  content = get_engine().render_json('weather.j2', data)
 
   return {
     'contentType': "application/vnd.microsoft.card.adaptive",
@@ -144,54 +172,10 @@ def get_weather_data():
   http://weather.livedoor.com/weather_hacks/webservice
 
   """
-  # pylint: disable=broad-except
-
   city = '140010'  # Yokohama
 
-  api_path = 'http://weather.livedoor.com/forecast/webservice/json/v1?city={}'.format(city)
-
-  get_result = None
-  try:
-    get_result = requests.get(api_path)
-  except Exception:
-    pass
-
-  if get_result is None or not get_result.ok:
-    print("failed")
-    return None
-
-  json_data = get_result.json()
-  # data structures are described in http://weather.livedoor.com/weather_hacks/webservice
-
-  def normalize(fcst):
-    r = {}
-    r['dateLabel'] = fcst.get('dateLabel', '-')
-    r['date'] = fcst.get('date', '1970-01-01')
-    r['telop'] = fcst.get('telop', '-')
-    temp = fcst.get('temperature', {})
-    r['temp_min'] = '-' if temp is None or temp.get('min') is None else temp.get('min', {}).get('celsius', '-')
-    r['temp_max'] = '-' if temp is None or temp.get('max') is None else temp.get('max', {}).get('celsius', '-')
-    image = fcst.get('image', {})
-    r['img_url'] = '' if image is None else image.get('url', '')
-    r['img_title'] = '-' if image is None else image.get('title', '-')
-    return r
-
-  fcst_today = json_data.get('forecasts', [{}, {}])[0]
-  fcst_today = normalize(fcst_today)
-  fcst_tomorrow = json_data.get('forecasts', [{}, {}])[1]
-  fcst_tomorrow = normalize(fcst_tomorrow)
-
-  city = json_data.get('location', {}).get('city', '-')
-  title = json_data.get('title', '-')
-  description = json_data.get('description', {}).get('text', '-')
-
-  return {
-    'city': city,                # "横浜"
-    'title': title,              # "神奈川県 横浜 の天気"
-    'description': description,
-    'today': fcst_today,
-    'tomorrow': fcst_tomorrow
-  }
+  # cached for weather_ttl seconds, concurrent requests of the same city share one fetch
+  return get_forecast_cache().get(city)
   # {
   #   "city": "横浜",
   #   "title": "神奈川県 横浜 の天気",
@@ -223,6 +207,35 @@ if __name__ == '__main__':
 
   def main():
 
+    parser = argparse.ArgumentParser(description='send messages from the bot.')
+    parser.add_argument('-b', '--bulk', metavar='PATH', help='CSV or JSONL of the recipients, with to_person_email, email, to_person_id or room_id')
+    parser.add_argument('-t', '--text', help='text of the message, {{ name }} is filled with the column of the recipient')
+    parser.add_argument('-c', '--card', help='card in static/cards, e.g. weather.json or weather.j2')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl'], help='format of the file, guessed by the extension by default')
+    parser.add_argument('-n', '--concurrency', type=int, default=8, help='messages sent at the same time (default: 8)')
+    parser.add_argument('-r', '--retries', type=int, default=3, help='retries of a failed message (default: 3)')
+    parser.add_argument('--restart', action='store_true', default=False, help='ignore the checkpoint and send from the beginning')
+    parser.add_argument('--broadcast', choices=['enable', 'disable', 'status'], help='enable or disable the morning weather broadcast for all hosts')
+    parser.add_argument('--cron', help='cron expression of a new broadcast job (default: bot_broadcast_cron or 0 7 * * *)')
+    args = parser.parse_args()
+
+    if args.broadcast:
+      job = set_broadcast(args.broadcast, cron=args.cron)
+      print(json.dumps(job, ensure_ascii=False, indent=2))
+      return 0 if job is not None else 1
+
+    if args.bulk:
+      if not (args.text or args.card):
+        parser.error('--text or --card is required')
+      try:
+        stats = send_bulk(args.bulk, text=args.text, card_name=args.card, file_format=args.format,
+                          concurrency=args.concurrency, retries=args.retries, restart=args.restart)
+      except KeyboardInterrupt:
+        print('interrupted, run the same command again to resume')
+        return 1
+      print(json.dumps(stats, indent=2))
+      return 0 if stats['failed'] == 0 else 1
+
     to_person_email = os.environ.get('to_person_email')
     if to_person_email is None:
       sys.exit('failed to read to_person_email from os.environ')
@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=missing-docstring
 
+import atexit
+import concurrent.futures
+import functools
 import logging
 import os
 import subprocess
@@ -14,7 +17,7 @@ import pytz
 # redis client for python
 import redis
 
-from flask import Flask, request
+from flask import Flask, jsonify, request
 
 
 def here(path=''):
@@ -24,10 +27,31 @@ if not here('./lib') in sys.path:
   sys.path.append(here('./lib'))
 
 # this is ./lib/teams/v1/bot.py Bot class instance
-from botscript import bot, redis_port, redis_url
+from botscript import bot, card_state, get_redis, redis_pool, redis_port
 
 # ./lib/plugins/__init__.py
-from plugins import get_plugin_map
+from plugins import LazyCommand, get_plugin_map, get_registry, plugin_dir, reload_plugins
+
+# ./lib/pluginwatch.py
+from pluginwatch import PluginWatcher
+
+# ./lib/sandbox.py
+from sandbox import PluginSandbox, SandboxRejected
+
+# ./lib/router.py
+from router import Match, build_router
+
+# ./lib/workerpool.py
+from workerpool import WorkerPool
+
+# ./lib/eventstream.py
+from eventstream import RedisEventStream
+
+# ./lib/broadcast.py
+from broadcast import get_broadcast_scheduler
+
+# ./lib/cardstore.py
+from cardstore import get_repository
 
 DEBUG = True
 
@@ -47,11 +71,87 @@ logger.setLevel(logging.INFO)
 
 app = Flask(app_name)
 
+# commands of plugins and decorated functions of the bot, compiled into one matcher
+def create_router():
+  return build_router(bot, plugin_map=get_plugin_map(), case_sensitive=os.environ.get('bot_case_sensitive', '0') == '1')
+
+router = create_router()
+
+# load and validate the cards now, broken cards are logged at boot instead of on the first /tenki
+card_repository = get_repository()
+logger.info("cards loaded: %d, invalid: %s", card_repository.get_stats()['cards'], sorted(card_repository.errors) or 'none')
+
+
+def reload_router(module_names):
+  """reload the changed plugins and replace the router,
+  requests in flight keep the router they already got"""
+  # pylint: disable=global-statement
+  global router
+  if reload_plugins(module_names) is None:
+    return
+  router = create_router()
+
+
+# every plugin runs in its own executor with timeout, concurrency limit and circuit breaker
+plugin_sandbox = PluginSandbox(
+  defaults={
+    'executor': os.environ.get('bot_plugin_executor', 'thread'),
+    'timeout': float(os.environ.get('bot_plugin_timeout', 30.0)),
+    'concurrency': int(os.environ.get('bot_plugin_concurrency', 4))
+  },
+  bot_factory=functools.partial(type(bot), bot_name=bot.bot_name))
+
+
+# reload plugins changed on disk, every worker follows via redis pub/sub
+plugin_watcher = PluginWatcher(
+  plugin_dir,
+  reload_router,
+  conn=get_redis(),
+  interval=float(os.environ.get('bot_plugin_watch_interval', 2.0)))
+if os.environ.get('bot_plugin_watch', '0') == '1':
+  plugin_watcher.start()
+
+# scheduled weather broadcast, one worker fires each job
+# bot_broadcast only tells whether this process runs the scheduler,
+# the job is enabled or disabled for all hosts by ./msg.py --broadcast
+broadcast_scheduler = get_broadcast_scheduler()
+if os.environ.get('bot_broadcast', '0') == '1':
+  broadcast_scheduler.add_job('morning', os.environ.get('bot_broadcast_cron', '0 7 * * *'))
+  broadcast_scheduler.start()
+  # stop sending on shutdown, the rest of the rooms are resumed by another worker
+  atexit.register(broadcast_scheduler.stop, 10.0)
+
+# webhook mode
+#   'inline': handle the event in the request (default)
+#   'pool': enqueue the event and return immediately, background workers handle it
+#   'stream': append the event to redis stream, consumers in every worker process handle it
+webhook_mode = os.environ.get('bot_webhook_mode', 'inline')
+
+# background workers for 'pool' mode
+worker_pool = WorkerPool(
+  concurrency=int(os.environ.get('bot_worker_concurrency', 4)),
+  maxsize=int(os.environ.get('bot_worker_queue_size', 1000)),
+  put_timeout=float(os.environ.get('bot_worker_put_timeout', 1.0)),
+  name='webhook')
+
+# durable event queue for 'stream' mode
+event_stream = RedisEventStream(
+  get_redis(),
+  stream=os.environ.get('bot_stream_key', 'bot:events'),
+  group=os.environ.get('bot_stream_group', 'bot'),
+  batch_size=int(os.environ.get('bot_stream_batch_size', 10)),
+  claim_idle_ms=int(os.environ.get('bot_stream_claim_idle_ms', 60000)))
+
+
 @app.route('/', methods=['POST'])
 def webhook():
 
   # get the json data from request
-  data = request.get_json().get('data')
+  json_data = request.get_json(silent=True)
+  data = json_data.get('data') if isinstance(json_data, dict) else None
+  if not isinstance(data, dict):
+    logger.info("receive data: no data found ... ignoring it")
+    return 'OK'
 
   # print(json.dumps(data, ensure_ascii=False, indent=2))
 
@@ -79,18 +179,57 @@ def webhook():
     logger.info("receive data: this is not created event ... ignoring it")
     return 'OK'
 
+  if webhook_mode == 'pool':
+    if not worker_pool.submit(on_receive_event, data):
+      # queue is full, webex retries later
+      return 'Service Unavailable', 503
+    return 'OK'
+
+  if webhook_mode == 'stream':
+    try:
+      event_stream.publish(data)
+    except redis.exceptions.RedisError as e:
+      logger.error("failed to publish event: %s", e)
+      return 'Service Unavailable', 503
+    return 'OK'
+
+  on_receive_event(data)
+  return 'OK'
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+  result = {
+    'webhook_mode': webhook_mode,
+    'worker_pool': worker_pool.get_stats(),
+    'session': bot.get_session_stats(),
+    'rate_limit': bot.get_rate_limit_stats(),
+    'cache': bot.get_cache_stats(),
+    'redis': redis_pool.get_stats(),
+    'router': router.get_stats(),
+    'cards': card_repository.get_stats(),
+    'plugins': get_registry().get_stats(),
+    'plugin_watcher': plugin_watcher.get_stats(),
+    'plugin_sandbox': plugin_sandbox.get_stats(),
+    'broadcast': broadcast_scheduler.get_stats()
+  }
+  if webhook_mode == 'stream':
+    result['event_stream'] = event_stream.get_stats()
+  return jsonify(result)
+
+
+def on_receive_event(data):
   if 'type' in data and data.get('type') == 'submit':
     logger.info("submit received")
     on_receive_submit(data)
-    return 'OK'
+    return
 
   person_id = data.get('personId', '')
   if person_id == bot.get_bot_id():
     logger.info("receive data: my own message ... ignoring it")
-    return 'OK'
+    return
 
   on_receive_message(data)
-  return 'OK'
 
 
 def on_receive_submit(data):
@@ -115,14 +254,13 @@ def on_receive_submit(data):
     print('attachment_data')
     print(json.dumps(attachment_data, ensure_ascii=False, indent=2))
 
-  conn = redis.StrictRedis.from_url(redis_url, decode_responses=True)
-  redis_data = conn.hgetall(message_id)
-  if redis_data:
-    print("data found in redis")
-    if redis_data.get('submitted_by') is None:
-      conn.hset(message_id, 'submitted_by', person_id)
-    else:
-      print("already submitted by {}".format(redis_data.get('submitted_by')))
+  # only the first submission wins, even if two people submit at once
+  status, owner = card_state.claim_submission(
+    message_id, person_id, inputs=attachment_data.get('inputs'), submitted_at=attachment_data.get('created'))
+  if status == card_state.CLAIMED:
+    print("submitted by {}".format(owner))
+  elif status == card_state.ALREADY_SUBMITTED:
+    print("already submitted by {}".format(owner))
   else:
     print("no data found in redis")
 
@@ -150,31 +288,33 @@ def on_receive_message(data):
   if message == '':
     return
 
-  mention = '@{} '.format(bot.bot_name)
-  if message.startswith(mention):
-    message = message.replace(mention, '')
-
-  # command match
-  if message.startswith('/'):
-    parts = message.split()
-    cmd = parts[0]
-    args = parts[1:]
-    plugin_map = get_plugin_map()
-    if cmd in plugin_map:
-      func = plugin_map.get(cmd)
-    else:
-      func = plugin_map.get('/')  # default is '/'
-    func(bot=bot, room_id=room_id, args=args)
-
-  # message match
-  elif message in bot.on_message_functions:
-    func = bot.on_message_functions.get(message)
-    func(room_id=room_id)
-
-  # unknown message
-  elif message not in bot.on_message_functions:
-    func = bot.on_message_functions.get('*')
-    func(room_id=room_id)
+  match = router.match(message)
+  if match is None:
+    return
+
+  if match.kind == Match.COMMAND and isinstance(match.func, LazyCommand):
+    call_plugin(match, room_id)
+  elif match.kind == Match.COMMAND:
+    match.func(bot=bot, room_id=room_id, args=match.args)
+  elif match.kind == Match.REGEX:
+    match.func(room_id=room_id, match=match.match)
+  else:
+    match.func(room_id=room_id)
+
+
+def call_plugin(match, room_id):
+  # pylint: disable=broad-except
+  name = match.func.module_name
+  try:
+    plugin_sandbox.call(name, match.func, options=get_registry().get_options(name), bot=bot, room_id=room_id, args=match.args)
+  except SandboxRejected as e:
+    logger.warning("plugin rejected: %s", e)
+    bot.send_message(room_id=room_id, text="{} is busy now, please try again later".format(match.route))
+  except concurrent.futures.TimeoutError:
+    logger.warning("plugin timed out: %s", name)
+  except Exception as e:
+    logger.error("plugin failed: %s", name)
+    logger.exception(e)
 
 
 def from_iso8601(iso_str=None):
@@ -199,6 +339,11 @@ def run_redis_server(config_path):
     subprocess.Popen(['redis-server', config_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
+# each gunicorn worker process joins the consumer group
+if webhook_mode == 'stream':
+  event_stream.start(on_receive_event, consumers=int(os.environ.get('bot_stream_consumers', 4)))
+
+
 if __name__ == '__main__':
 
   assert bot.has_webhooks(), sys.exit("no webhook found for this bot. please run webhook.py --start")